@@ -1,11 +1,31 @@
+import asyncio
+import atexit
+import base64
+import dataclasses
+import fnmatch
+import hashlib
+import inspect
+import itertools
 import json
+import logging
+import os
+import random
+import re
+import signal
+import socket
+import struct
+import sys
+import threading
 import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
 from copy import deepcopy
+from functools import cache, partial, wraps
 from pathlib import Path
 from typing import Literal, Optional, Union
 
 import click
-import httpx
 import llm
 from llm.default_plugins.openai_models import (
     AsyncChat,
@@ -14,19 +34,61 @@ from llm.default_plugins.openai_models import (
     ReasoningEffortEnum,
     Responses,
 )
-from llm.parts import StreamEvent
+from llm.parts import Message, StreamEvent, TextPart, ToolResultPart
 from pydantic import Field, field_validator
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
-def get_openrouter_models(skip_cache=False):
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_API_BASE = "https://openrouter.ai/api/v1"
+
+
+def get_api_base():
+    "The OpenRouter API URL, which OPENROUTER_API_BASE can point elsewhere"
+    return os.environ.get("OPENROUTER_API_BASE", DEFAULT_API_BASE).rstrip("/")
+
+
+def _catalog_location(api_base):
+    "The URL of the models catalog and the path to cache it at"
+    api_base = (api_base or get_api_base()).rstrip("/")
+    filename = "openrouter_models.json"
+    if api_base != DEFAULT_API_BASE:
+        # Keep catalogs from other API bases out of the main cache
+        filename = "openrouter_models-{}.json".format(
+            hashlib.sha256(api_base.encode()).hexdigest()[:8]
+        )
+    return api_base + "/models", llm.user_dir() / filename
+
+
+def get_openrouter_models(skip_cache=False, api_base=None):
+    url, path = _catalog_location(api_base)
     models = fetch_cached_json(
-        url="https://openrouter.ai/api/v1/models",
-        path=llm.user_dir() / "openrouter_models.json",
+        url=url,
+        path=path,
         cache_timeout=0 if skip_cache else 3600,
     )["data"]
     return models
 
 
+async def aget_openrouter_models(skip_cache=False, api_base=None):
+    "Async version of ``get_openrouter_models`` that never blocks the event loop"
+    url, path = _catalog_location(api_base)
+    models = (
+        await afetch_cached_json(
+            url=url,
+            path=path,
+            cache_timeout=0 if skip_cache else 3600,
+        )
+    )["data"]
+    return models
+
+
 def get_model_ids(skip_cache=False):
     return [model["id"] for model in get_openrouter_models(skip_cache=skip_cache)]
 
@@ -38,6 +100,13 @@ def get_supports_images(model_definition):
         return False
 
 
+def is_embedding_model(model_definition):
+    try:
+        return "embeddings" in model_definition["architecture"]["output_modalities"]
+    except KeyError:
+        return False
+
+
 def has_parameter(model_definition, parameter):
     try:
         return parameter in model_definition["supported_parameters"]
@@ -45,7 +114,52 @@ def has_parameter(model_definition, parameter):
         return False
 
 
+def _model_summaries(api_base=None):
+    """The ID and capabilities of each model in the catalog, to register them.
+
+    They are saved next to the cached catalog along with its modification
+    time and size, so that registering models for every ``llm`` command
+    reads a short list rather than loading the whole catalog.
+    """
+    _, path = _catalog_location(api_base)
+    summary_path = path.with_name(path.stem + "-summary.json")
+    try:
+        stat = path.stat()
+    except OSError:
+        stat = None
+    if stat is not None and time.time() - stat.st_mtime < 3600:
+        try:
+            summary = _read_json(summary_path)
+            if summary["catalog"] == [stat.st_mtime_ns, stat.st_size]:
+                return summary["models"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    models = [
+        {
+            "id": model_definition["id"],
+            "embedding": is_embedding_model(model_definition),
+            "vision": get_supports_images(model_definition),
+            "reasoning": has_parameter(model_definition, "reasoning"),
+            "verbosity": has_parameter(model_definition, "verbosity"),
+            "supports_schema": has_parameter(model_definition, "structured_outputs"),
+            "supports_tools": has_parameter(model_definition, "tools"),
+        }
+        for model_definition in get_openrouter_models(api_base=api_base)
+    ]
+    try:
+        stat = path.stat()
+        catalog = [stat.st_mtime_ns, stat.st_size]
+        _write_json(summary_path, {"catalog": catalog, "models": models})
+    except OSError:
+        # Without a summary the catalog is loaded again next time
+        pass
+    return models
+
+
+@cache
 def build_openrouter_options(base_options):
+    # Cached because building a pydantic model is slow, and every model
+    # registered from the catalog would otherwise build its own
     class Options(base_options):
         provider: Optional[Union[dict, str]] = Field(
             description=("JSON object to control provider routing"),
@@ -70,6 +184,73 @@ def build_openrouter_options(base_options):
             description="Set to true to enable reasoning with default parameters",
             default=None,
         )
+        coalesce: Optional[bool] = Field(
+            description=(
+                "Share one request between identical prompts running at the "
+                "same time (async models only)"
+            ),
+            default=None,
+        )
+        image_max_edge: Optional[int] = Field(
+            description=(
+                "Downscale image attachments so their longest edge is at most "
+                "this many pixels before uploading (requires Pillow)"
+            ),
+            ge=1,
+            default=None,
+        )
+        schema_abort: Optional[bool] = Field(
+            description=(
+                "Stop a schema response as soon as its JSON can no longer "
+                "match the schema, raising an error"
+            ),
+            default=None,
+        )
+        schema_retries: Optional[int] = Field(
+            description=(
+                "Retry a schema response that breaks its schema up to this "
+                "many times, holding back output until its JSON is complete"
+            ),
+            ge=0,
+            default=None,
+        )
+        parallel_tool_calls: Optional[bool] = Field(
+            description=(
+                "Allow the model to request several tool calls in one turn - "
+                "set to false for at most one"
+            ),
+            default=None,
+        )
+        tool_concurrency: Optional[int] = Field(
+            description=(
+                "Run up to this many of a turn's tool calls at once, plain "
+                "functions in worker threads (async models only)"
+            ),
+            ge=1,
+            default=None,
+        )
+        tool_timeout: Optional[float] = Field(
+            description=(
+                "Fail tool calls that take longer than this many seconds "
+                "(async models only)"
+            ),
+            gt=0,
+            default=None,
+        )
+        speculative_tools: Optional[bool] = Field(
+            description=(
+                "Start tools marked idempotent as soon as their arguments "
+                "have streamed, before the response ends (async models only)"
+            ),
+            default=None,
+        )
+        fallback_models: Optional[Union[list, str]] = Field(
+            description=(
+                "Models for OpenRouter to try, in order, if this one is "
+                "unavailable - a JSON list or comma-separated IDs"
+            ),
+            default=None,
+        )
 
         @field_validator("provider")
         def validate_provider(cls, provider):
@@ -83,9 +264,80 @@ def build_openrouter_options(base_options):
                     raise ValueError("Invalid JSON in provider string")
             return provider
 
+        @field_validator("fallback_models")
+        def validate_fallback_models(cls, fallback_models):
+            return _model_id_list("fallback_models", fallback_models)
+
     return Options
 
 
+# Dated versions such as -2024-08-06 or -20240806. Shorter suffixes such as
+# -0613 or -1106 are left alone, as they name models of their own
+_VERSION_SUFFIX = re.compile(
+    r"-(?:19|20)\d{2}(-?)(?:0[1-9]|1[0-2])\1(?:0[1-9]|[12]\d|3[01])$"
+)
+
+
+def _without_version(model_id):
+    "A model ID without any dated version suffix"
+    return _VERSION_SUFFIX.sub("", model_id)
+
+
+def _model_id_list(name, model_ids):
+    "Parse an option holding a JSON list or comma-separated model IDs"
+    if model_ids is None:
+        return None
+    if isinstance(model_ids, str):
+        if model_ids.strip().startswith("["):
+            try:
+                model_ids = json.loads(model_ids)
+            except json.JSONDecodeError:
+                raise ValueError("Invalid JSON in {} string".format(name))
+        else:
+            model_ids = model_ids.split(",")
+    if not isinstance(model_ids, list) or any(
+        not isinstance(model_id, str) for model_id in model_ids
+    ):
+        raise ValueError("{} must be a list of model IDs".format(name))
+    # Accept the same openrouter/ prefixed IDs used with llm -m
+    return [
+        model_id.strip().removeprefix("openrouter/")
+        for model_id in model_ids
+        if model_id.strip()
+    ] or None
+
+
+def _attachment_modality(attachment):
+    "The catalog input modality needed to send an attachment"
+    kind = (attachment.resolve_type() or "").partition("/")[0]
+    return kind if kind in ("image", "audio", "video") else "file"
+
+
+def get_missing_capabilities(model_definition, prompt):
+    """Return capabilities a prompt needs that this model definition lacks."""
+    from llm.parts import AttachmentPart
+
+    missing = []
+    if any(isinstance(tool, llm.Tool) for tool in prompt.tools) and not (
+        has_parameter(model_definition, "tools")
+    ):
+        missing.append("tools")
+    if prompt.schema and not has_parameter(model_definition, "structured_outputs"):
+        missing.append("schema")
+    architecture = model_definition.get("architecture") or {}
+    modalities = set(architecture.get("input_modalities") or ["text"])
+    needed = {
+        _attachment_modality(part.attachment)
+        for message in prompt.messages
+        for part in message.parts
+        if isinstance(part, AttachmentPart) and part.attachment is not None
+    }
+    missing.extend(
+        "{} attachments".format(modality) for modality in sorted(needed - modalities)
+    )
+    return missing
+
+
 def _validate_integer(name, value, minimum, maximum=None):
     if value is None:
         return
@@ -246,6 +498,7 @@ class Shell(llm.ServerSideTool):
         engine: Literal["auto", "openrouter"] | None = None,
         environment: dict | None = None,
         sleep_after_seconds: int | None = None,
+        reuse_container: bool = False,
     ):
         super().__init__()
         if engine is not None and engine not in self._engines:
@@ -265,6 +518,11 @@ class Shell(llm.ServerSideTool):
                     raise ValueError(
                         "container_reference environment requires a container_id"
                     )
+                if reuse_container:
+                    raise ValueError(
+                        "reuse_container cannot be used with a container_reference "
+                        "environment"
+                    )
         _validate_integer(
             "sleep_after_seconds",
             sleep_after_seconds,
@@ -274,6 +532,31 @@ class Shell(llm.ServerSideTool):
         self.engine = engine
         self.environment = environment
         self.sleep_after_seconds = sleep_after_seconds
+        self.reuse_container = reuse_container
+        # The container_auto settings of the tool a pooled container is for
+        self.pooled_environment = environment
+
+    def pool_key(self, key):
+        "Containers can be reused by Shell tools with the same key and settings"
+        return json.dumps(
+            [
+                hashlib.sha256((key or "").encode()).hexdigest()[:16],
+                self.engine,
+                self.sleep_after_seconds,
+                self.pooled_environment,
+            ],
+            sort_keys=True,
+        )
+
+    def with_container(self, container_id):
+        "A copy of this tool that runs in an existing container"
+        tool = Shell(
+            engine=self.engine,
+            environment={"type": "container_reference", "container_id": container_id},
+            sleep_after_seconds=self.sleep_after_seconds,
+        )
+        tool.pooled_environment = self.pooled_environment
+        return tool
 
     def tool_spec(self, model):
         parameters = {}
@@ -321,189 +604,3271 @@ def _response_item_key(item):
     return None
 
 
-class _PromptMessagesProxy:
-    def __init__(self, prompt, messages):
-        self._prompt = prompt
-        self.messages = messages
+class KeyPool:
+    """Spread requests across several OpenRouter keys.
 
-    def __getattr__(self, name):
-        return getattr(self._prompt, name)
+    Keys that receive a 429 response are rested until their ``Retry-After``
+    period has passed, or for ``cooldown`` seconds if no period was given.
 
+    ``select()`` reserves the key it returns until ``track()`` starts the
+    request, so prompts selecting keys at the same time are spread across
+    the pool. Reservations that are never used lapse after
+    ``reservation_timeout`` seconds.
+    """
 
-class _mixin:
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.Options = build_openrouter_options(self.Options)
+    strategies = ("least-loaded", "round-robin")
+    reservation_timeout = 30.0
 
-    def build_kwargs(self, prompt, stream):
-        kwargs = super().build_kwargs(prompt, stream)
-        kwargs.pop("provider", None)
-        kwargs.pop("reasoning_effort", None)
-        kwargs.pop("reasoning_max_tokens", None)
-        kwargs.pop("reasoning_enabled", None)
-        extra_body = {}
-        if prompt.options.provider:
-            extra_body["provider"] = prompt.options.provider
-        reasoning = {}
-        if prompt.options.reasoning_effort:
-            reasoning["effort"] = prompt.options.reasoning_effort
-        if prompt.options.reasoning_max_tokens:
-            reasoning["max_tokens"] = prompt.options.reasoning_max_tokens
-        if prompt.options.reasoning_enabled is not None:
-            reasoning["enabled"] = prompt.options.reasoning_enabled
-        if reasoning:
-            extra_body["reasoning"] = reasoning
-        if extra_body:
-            kwargs["extra_body"] = extra_body
-        return kwargs
+    def __init__(self, keys, strategy="least-loaded", cooldown=10):
+        if not keys:
+            raise ValueError("KeyPool needs at least one key")
+        if strategy not in self.strategies:
+            raise ValueError("strategy must be least-loaded or round-robin")
+        self.keys = list(dict.fromkeys(keys))
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self._stats = {
+            key: {
+                "in_flight": 0,
+                "requests": 0,
+                "errors": 0,
+                "rate_limited": 0,
+                "cooldown_until": 0.0,
+            }
+            for key in self.keys
+        }
+        self._reservations = {key: deque() for key in self.keys}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
 
-    def _build_responses_kwargs(self, prompt, stream):
-        reasoning_effort = prompt.options.reasoning_effort
-        reasoning_summary = getattr(prompt.options, "reasoning_summary", None)
-        reasoning_max_tokens = prompt.options.reasoning_max_tokens
-        reasoning_enabled = prompt.options.reasoning_enabled
-        provider = prompt.options.provider
+    def __contains__(self, key):
+        return key in self._stats
 
-        kwargs = super()._build_responses_kwargs(prompt, stream)
-        for key in (
-            "provider",
-            "reasoning_summary",
-            "reasoning_max_tokens",
-            "reasoning_enabled",
-        ):
-            kwargs.pop(key, None)
+    def _load(self, key, now):
+        "Requests in flight with ``key`` or about to be, holding ``self._lock``"
+        reservations = self._reservations[key]
+        while reservations and reservations[0] < now - self.reservation_timeout:
+            reservations.popleft()
+        return self._stats[key]["in_flight"] + len(reservations)
 
-        unsupported = [
-            key
-            for key in ("stop", "logit_bias", "seed")
-            if kwargs.pop(key, None) is not None
-        ]
-        if unsupported:
-            raise ValueError(
-                "The OpenRouter Responses API does not support these options: {}".format(
-                    ", ".join(unsupported)
+    def select(self, reserve=True):
+        "Return the key to use for the next request"
+        key = self._select()
+        if reserve:
+            with self._lock:
+                self._reservations[key].append(time.monotonic())
+        return key
+
+    def release(self, key):
+        "Drop a reservation made by ``select()`` for a request never made"
+        with self._lock:
+            if self._reservations[key]:
+                self._reservations[key].popleft()
+
+    def _select(self):
+        with self._lock:
+            now = time.monotonic()
+            healthy = [
+                key for key in self.keys if self._stats[key]["cooldown_until"] <= now
+            ]
+            if not healthy:
+                # Every key is resting - use the one that recovers soonest
+                return min(
+                    self.keys, key=lambda key: self._stats[key]["cooldown_until"]
                 )
-            )
+            start = next(self._counter) % len(healthy)
+            if self.strategy == "round-robin":
+                return healthy[start]
+            # Rotating first spreads ties evenly instead of favoring one key
+            rotated = healthy[start:] + healthy[:start]
+            return min(rotated, key=lambda key: self._load(key, now))
 
-        reasoning = dict(kwargs.get("reasoning") or {})
-        if reasoning_summary is None or getattr(prompt, "hide_reasoning", False):
-            reasoning.pop("summary", None)
-        else:
-            reasoning["summary"] = reasoning_summary
-        if reasoning_effort:
-            reasoning["effort"] = reasoning_effort
-        if reasoning_max_tokens is not None:
-            reasoning["max_tokens"] = reasoning_max_tokens
-        if reasoning_enabled is not None:
-            reasoning["enabled"] = reasoning_enabled
-        if reasoning:
-            kwargs["reasoning"] = reasoning
-        else:
-            kwargs.pop("reasoning", None)
+    @contextmanager
+    def track(self, key):
+        "Record an in-flight request made with ``key``, and its outcome"
+        stats = self._stats[key]
+        with self._lock:
+            if self._reservations[key]:
+                self._reservations[key].popleft()
+            stats["in_flight"] += 1
+            stats["requests"] += 1
+        try:
+            yield
+        except Exception as ex:
+            with self._lock:
+                stats["errors"] += 1
+                if getattr(ex, "status_code", None) == 429:
+                    stats["rate_limited"] += 1
+                    stats["cooldown_until"] = time.monotonic() + _retry_after(
+                        ex, self.cooldown
+                    )
+            raise
+        finally:
+            with self._lock:
+                stats["in_flight"] -= 1
 
-        extra_body = dict(kwargs.pop("extra_body", {}) or {})
-        for key in ("frequency_penalty", "presence_penalty"):
-            value = kwargs.pop(key, None)
-            if value is not None:
-                extra_body[key] = value
-        if provider:
-            extra_body["provider"] = provider
-        if extra_body:
-            kwargs["extra_body"] = extra_body
-        return kwargs
+    def stats(self):
+        "Return a copy of the per-key counters, keyed by redacted key"
+        now = time.monotonic()
+        with self._lock:
+            return {
+                redact_key(key): {
+                    **{k: v for k, v in stats.items() if k != "cooldown_until"},
+                    "healthy": stats["cooldown_until"] <= now,
+                }
+                for key, stats in self._stats.items()
+            }
 
-    def _build_responses_input(self, prompt, image_detail=None):
-        """Replay raw OpenRouter server-tool items in conversation history."""
-        from llm.parts import Message
 
-        base_builder = super()._build_responses_input
-        messages = prompt.messages
-        if not any(
-            _openrouter_response_item(part) is not None
-            for message in messages
-            for part in message.parts
-        ):
-            return base_builder(prompt, image_detail=image_detail)
+def _retry_after(ex, default):
+    response = getattr(ex, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return default
 
-        items = []
-        instructions = None
-        response_item_indexes = {}
 
-        def append_ordinary_parts(message, parts):
-            # Delegate ordinary text, attachments and local tools back to LLM
-            # in segments so raw server-tool items retain their exact position.
-            nonlocal instructions
-            if not parts:
-                return
-            segment = Message(
-                role=message.role,
-                parts=parts,
-                provider_metadata=message.provider_metadata,
-            )
-            segment_items, segment_instructions = base_builder(
-                _PromptMessagesProxy(prompt, [segment]),
-                image_detail=image_detail,
-            )
-            items.extend(segment_items)
-            if segment_instructions is not None:
-                instructions = segment_instructions
+def redact_key(key):
+    return "{}...{}".format(key[:11], key[-3:]) if len(key) > 20 else "..."
 
-        for message in messages:
-            ordinary_parts = []
-            for part in message.parts:
-                response_item = _openrouter_response_item(part)
-                if response_item is None:
-                    ordinary_parts.append(part)
-                    continue
-                response_item = deepcopy(_response_item_dict(response_item))
-                response_item_key = _response_item_key(response_item)
 
-                if (
-                    response_item_key is not None
-                    and response_item_key in response_item_indexes
-                ):
-                    items[response_item_indexes[response_item_key]] = response_item
-                    continue
+_key_pools = {}
+# The pool for the current configuration, keyed by the settings it came from
+_key_pool_lookup = {}
 
-                if ordinary_parts:
-                    append_ordinary_parts(message, ordinary_parts)
-                    ordinary_parts = []
 
-                if response_item_key is not None:
-                    response_item_indexes[response_item_key] = len(items)
-                items.append(response_item)
+def get_key_pool():
+    """Return the shared KeyPool, or None if no pool of keys is configured.
 
-            append_ordinary_parts(message, ordinary_parts)
+    Keys are read from the comma-separated ``OPENROUTER_KEYS`` environment
+    variable, falling back to the ``openrouter_keys`` stored key. Entries can
+    be keys or the names of other keys saved using ``llm keys set``.
 
-        return items, instructions
+    The answer is cached until those settings or ``keys.json`` change.
+    """
+    keys_path = llm.user_dir() / "keys.json"
+    try:
+        modified = keys_path.stat().st_mtime_ns
+    except OSError:
+        modified = None
+    lookup = (
+        os.environ.get("OPENROUTER_KEYS"),
+        os.environ.get("OPENROUTER_KEYS_STRATEGY"),
+        str(keys_path),
+        modified,
+    )
+    if lookup not in _key_pool_lookup:
+        _key_pool_lookup.clear()
+        _key_pool_lookup[lookup] = _load_key_pool()
+    return _key_pool_lookup[lookup]
 
-    def _server_tool_events(self, item, message_index):
-        events = super()._server_tool_events(item, message_index)
-        if events:
-            response_item = _response_item_dict(item)
-            events[0].provider_metadata = {
-                **(events[0].provider_metadata or {}),
-                "openrouter": {"response_item": response_item},
-            }
-            return events
 
-        item_type = getattr(item, "type", None)
-        if item_type not in (
-            "openrouter:web_search",
-            "openrouter:web_fetch",
-            "openrouter:shell",
-            "shell_call",
-            "shell_call_output",
-        ):
-            return []
-        response_item = _response_item_dict(item)
-        if item_type == "shell_call":
-            call_id = response_item.get("call_id") or response_item.get("id")
-            return [
-                StreamEvent(
-                    type="tool_call_name",
-                    chunk="shell",
-                    tool_call_id=call_id,
+def _load_key_pool():
+    value = os.environ.get("OPENROUTER_KEYS") or llm.get_key(alias="openrouter_keys")
+    if not value:
+        return None
+    keys = tuple(
+        llm.get_key(input=entry.strip()) for entry in value.split(",") if entry.strip()
+    )
+    if not keys:
+        return None
+    strategy = os.environ.get("OPENROUTER_KEYS_STRATEGY") or "least-loaded"
+    pool = _key_pools.get((keys, strategy))
+    if pool is None:
+        pool = _key_pools[(keys, strategy)] = KeyPool(keys, strategy=strategy)
+    return pool
+
+
+def _lock_file(fd, blocking=True):
+    "Take an exclusive lock on an open file, returning False if unavailable"
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        return True
+    while True:
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(0.001)
+        else:
+            return True
+
+
+def _unlock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class HostLimiter:
+    """Rate and concurrency limits shared by every process on this host.
+
+    State lives in lock files in ``directory``. Each key gets a token bucket
+    allowing ``requests`` per ``interval`` seconds, and at most
+    ``max_in_flight`` requests run at once across all keys. An in-flight slot
+    is an exclusive lock on one of ``max_in_flight`` slot files, so slots
+    held by a process that crashes are released by the operating system.
+
+    A request that finds its bucket empty reserves the next token anyway,
+    taking the bucket below zero, and waits until that token is due. Queued
+    requests therefore go in turn instead of all retrying at once.
+    """
+
+    _bucket = struct.Struct("dd")
+
+    def __init__(self, directory, requests=None, interval=None, max_in_flight=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.requests = requests
+        self.interval = interval
+        self.max_in_flight = max_in_flight
+        self._bucket_fds = {}
+        self._slot_fds = []
+        self._held_slots = set()
+        # Separate locks, so taking a slot never waits on a bucket's file lock
+        self._bucket_lock = threading.Lock()
+        self._slot_lock = threading.Lock()
+
+    def _open(self, name):
+        return os.open(self.directory / name, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _take_token(self, key):
+        "Take a token from this key's bucket, returning the seconds until it is due"
+        if not self.requests:
+            return 0
+        name = "rate-{}.bin".format(hashlib.sha256(key.encode()).hexdigest()[:16])
+        with self._bucket_lock:
+            fd = self._bucket_fds.get(name)
+            if fd is None:
+                fd = self._bucket_fds[name] = self._open(name)
+            _lock_file(fd)
+            try:
+                now = time.time()
+                os.lseek(fd, 0, os.SEEK_SET)
+                data = os.read(fd, self._bucket.size)
+                if len(data) == self._bucket.size:
+                    tokens, updated = self._bucket.unpack(data)
+                    tokens = min(
+                        self.requests,
+                        tokens + (now - updated) * self.requests / self.interval,
+                    )
+                else:
+                    tokens = self.requests
+                # Reserve the token even if it is not due yet
+                tokens -= 1
+                wait = max(0, -tokens * self.interval / self.requests)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, self._bucket.pack(tokens, now))
+                return wait
+            finally:
+                _unlock_file(fd)
+
+    def _take_slot(self):
+        "Take an in-flight slot, returning its index or None if all are busy"
+        if not self.max_in_flight:
+            return -1
+        with self._slot_lock:
+            while len(self._slot_fds) < self.max_in_flight:
+                self._slot_fds.append(
+                    self._open("slot-{}.lock".format(len(self._slot_fds)))
+                )
+            for index, fd in enumerate(self._slot_fds):
+                if index not in self._held_slots and _lock_file(fd, blocking=False):
+                    self._held_slots.add(index)
+                    return index
+        return None
+
+    def _release_slot(self, index):
+        if index < 0:
+            return
+        with self._slot_lock:
+            _unlock_file(self._slot_fds[index])
+            self._held_slots.discard(index)
+
+    @contextmanager
+    def acquire(self, key):
+        "Block until a request using ``key`` is allowed, holding a slot while open"
+        wait = self._take_token(key)
+        if wait:
+            time.sleep(wait)
+        delay = 0.005
+        while (slot := self._take_slot()) is None:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+        try:
+            yield
+        finally:
+            self._release_slot(slot)
+
+    @asynccontextmanager
+    async def acquire_async(self, key):
+        "Asynchronous version of acquire() that waits without blocking the loop"
+        if self.requests:
+            # The bucket's file lock can block, so it is taken in a thread
+            wait = await asyncio.to_thread(self._take_token, key)
+            if wait:
+                await asyncio.sleep(wait)
+        delay = 0.005
+        while (slot := self._take_slot()) is None:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.25)
+        try:
+            yield
+        finally:
+            self._release_slot(slot)
+
+
+def parse_rate_limit(value):
+    """Parse a rate limit such as ``40/10s``, ``100/m`` or ``5/s``.
+
+    Returns a ``(requests, interval_in_seconds)`` tuple.
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+(?:\.\d+)?)?\s*([smh])\s*", value)
+    if not match or int(match.group(1)) < 1:
+        raise ValueError(f"Invalid rate limit {value!r}, expected e.g. 40/10s")
+    units = {"s": 1, "m": 60, "h": 3600}
+    interval = float(match.group(2) or 1) * units[match.group(3)]
+    if interval <= 0:
+        raise ValueError(f"Invalid rate limit {value!r}, expected e.g. 40/10s")
+    return int(match.group(1)), interval
+
+
+_host_limiters = {}
+
+
+def get_host_limiter():
+    """Return the HostLimiter configured by environment variables, if any.
+
+    ``OPENROUTER_RATE_LIMIT`` sets a per-key request rate such as ``40/10s``
+    and ``OPENROUTER_MAX_IN_FLIGHT`` caps concurrent requests on this host.
+    """
+    rate_limit = os.environ.get("OPENROUTER_RATE_LIMIT")
+    max_in_flight = os.environ.get("OPENROUTER_MAX_IN_FLIGHT")
+    if not rate_limit and not max_in_flight:
+        return None
+    directory = llm.user_dir() / "openrouter-limits"
+    config = (str(directory), rate_limit, max_in_flight)
+    limiter = _host_limiters.get(config)
+    if limiter is None:
+        requests, interval = (
+            parse_rate_limit(rate_limit) if rate_limit else (None, None)
+        )
+        limiter = _host_limiters[config] = HostLimiter(
+            directory,
+            requests=requests,
+            interval=interval,
+            max_in_flight=int(max_in_flight) if max_in_flight else None,
+        )
+    return limiter
+
+
+class CircuitOpenError(llm.ModelError):
+    "A model is failing, so requests to it fail at once for now"
+
+    def __init__(self, model, retry_after):
+        super().__init__(
+            "{} is failing - not sending requests to it for {:.0f} more "
+            "seconds".format(model, max(retry_after, 1))
+        )
+        self.model = model
+        self.retry_after = retry_after
+
+
+def _upstream_failure(error):
+    """Whether an error says the model or provider is unhealthy.
+
+    Timeouts, connection errors and 408, 429 and 5xx responses count, but
+    not errors caused by the request itself, such as a 400 or 401.
+    """
+    import openai
+
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status = getattr(error, "status_code", None)
+    return status in (408, 429) or (status is not None and status >= 500)
+
+
+def _error_provider(error):
+    "The provider OpenRouter blamed for an error, if it said"
+    body = getattr(error, "body", None)
+    if isinstance(body, dict):
+        return (body.get("metadata") or {}).get("provider_name")
+    return None
+
+
+class CircuitBreaker:
+    """Circuit breakers for each model and provider, shared by every process.
+
+    Each model's state lives in a JSON file in ``directory``, read and
+    written under an exclusive lock. Request and failure counts decay with
+    a half-life of ``window`` seconds. A failure is an error from
+    ``_upstream_failure`` or a response whose first output took longer
+    than ``slow`` seconds.
+
+    Once at least ``min_requests`` have been counted and ``failure_rate``
+    of them failed, a circuit opens for ``cooldown`` seconds. While a
+    model's circuit is open its requests raise ``CircuitOpenError`` at
+    once. Providers with open circuits are added to the request's
+    ``provider.ignore`` list, so OpenRouter routes around them. When the
+    cooldown is over a model's circuit is half-open: one request at a time
+    is let through as a probe, for at most ``probe_timeout`` seconds.
+    Success closes the circuit and failure opens it again. A provider's
+    circuit is no longer ignored after its cooldown, and its next result
+    closes or reopens it.
+    """
+
+    def __init__(
+        self,
+        directory,
+        *,
+        failure_rate=0.5,
+        min_requests=5,
+        window=60.0,
+        cooldown=30.0,
+        slow=None,
+        probe_timeout=60.0,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.cooldown = cooldown
+        self.slow = slow
+        self.probe_timeout = probe_timeout
+        self._fds = {}
+        self._lock = threading.Lock()
+
+    def _path(self, model):
+        return self.directory / "breaker-{}.json".format(
+            hashlib.sha256(model.encode()).hexdigest()[:16]
+        )
+
+    def _fd(self, path, create=True):
+        "An open descriptor for ``path``, which must hold ``self._lock``"
+        fd = self._fds.get(path)
+        if fd is None:
+            flags = os.O_RDWR | (os.O_CREAT if create else 0)
+            fd = self._fds[path] = os.open(path, flags, 0o600)
+        return fd
+
+    @contextmanager
+    def _state(self, model):
+        """Yield the state for ``model``, holding its file's lock until done.
+
+        The file is only written if the state was changed.
+        """
+        path = self._path(model)
+        with self._lock:
+            fd = self._fd(path)
+            _lock_file(fd)
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                data = os.read(fd, os.fstat(fd).st_size)
+                try:
+                    state = json.loads(data)
+                except ValueError:
+                    state = {"model": model, "circuit": {}, "providers": {}}
+                yield state
+                encoded = json.dumps(state).encode("utf-8")
+                if encoded != data:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.ftruncate(fd, 0)
+                    os.write(fd, encoded)
+            finally:
+                _unlock_file(fd)
+
+    def check(self, model):
+        """Raise ``CircuitOpenError`` if requests to ``model`` should fail fast.
+
+        Returns whether this request is the probe of a half-open circuit,
+        and the providers of ``model`` whose circuits are open.
+        """
+        now = time.time()
+        with self._state(model) as state:
+            providers = sorted(
+                provider
+                for provider, circuit in state["providers"].items()
+                if circuit.get("state") == "open" and now < circuit["open_until"]
+            )
+            circuit = state["circuit"]
+            if circuit.get("state", "closed") == "closed":
+                return False, providers
+            if now < circuit["open_until"]:
+                raise CircuitOpenError(model, circuit["open_until"] - now)
+            if now < circuit.get("probe_until", 0):
+                # Another request is already probing
+                raise CircuitOpenError(model, circuit["probe_until"] - now)
+            circuit["state"] = "half-open"
+            circuit["probe_until"] = now + self.probe_timeout
+            return True, providers
+
+    def record(self, model, provider=None, *, failed, probe=False):
+        "Record the outcome of a request to ``model``, served by ``provider``"
+        now = time.time()
+        with self._state(model) as state:
+            self._record(state["circuit"], now, failed, probe)
+            if provider:
+                circuit = state["providers"].setdefault(provider, {})
+                self._record(circuit, now, failed, probe=False)
+
+    def _record(self, circuit, now, failed, probe):
+        status = circuit.get("state", "closed")
+        if status == "closed":
+            decay = 0.5 ** ((now - circuit.get("updated", now)) / self.window)
+            circuit["requests"] = circuit.get("requests", 0) * decay + 1
+            circuit["failures"] = circuit.get("failures", 0) * decay + failed
+            circuit["updated"] = now
+            if (
+                round(circuit["requests"]) >= self.min_requests
+                and circuit["failures"] / circuit["requests"] >= self.failure_rate
+            ):
+                self._open(circuit, now)
+        elif probe or (status == "open" and now >= circuit["open_until"]):
+            if failed:
+                self._open(circuit, now)
+            else:
+                circuit.clear()
+                circuit.update(state="closed", requests=0, failures=0, updated=now)
+        # Otherwise this request started before the circuit opened
+
+    def _open(self, circuit, now):
+        circuit["state"] = "open"
+        circuit["open_until"] = now + self.cooldown
+        circuit["probe_until"] = 0
+
+    def status(self):
+        "The state of every model and provider circuit, keyed by model"
+        now = time.time()
+        models = {}
+        for path in sorted(self.directory.glob("breaker-*.json")):
+            try:
+                state = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            models[state["model"]] = {
+                "circuit": self._describe(state["circuit"], now),
+                "providers": {
+                    provider: self._describe(circuit, now)
+                    for provider, circuit in sorted(state["providers"].items())
+                },
+            }
+        return models
+
+    def _describe(self, circuit, now):
+        decay = 0.5 ** ((now - circuit.get("updated", now)) / self.window)
+        status = circuit.get("state", "closed")
+        if status == "open" and now >= circuit["open_until"]:
+            status = "half-open"
+        return {
+            "state": status,
+            "requests": round(circuit.get("requests", 0) * decay, 2),
+            "failures": round(circuit.get("failures", 0) * decay, 2),
+            "open_for": (
+                round(circuit["open_until"] - now, 1) if status == "open" else None
+            ),
+        }
+
+    def reset(self):
+        "Close every circuit"
+        with self._lock:
+            for path in self.directory.glob("breaker-*.json"):
+                # Emptied rather than deleted, as other processes have it open
+                fd = self._fd(path, create=False)
+                _lock_file(fd)
+                try:
+                    os.ftruncate(fd, 0)
+                finally:
+                    _unlock_file(fd)
+
+
+class _CircuitRequest:
+    """Records the outcome of one request with a ``CircuitBreaker``.
+
+    ``ignored`` are the providers to route the request around. Unless
+    ``providers`` is true, outcomes only count towards the model's circuit.
+    """
+
+    def __init__(self, breaker, model, probe, response, ignored=(), providers=True):
+        self.breaker = breaker
+        self.model = model
+        self.probe = probe
+        self.response = response
+        self.ignored = ignored
+        self.providers = providers
+        self.start = time.monotonic()
+        self.ttft = None
+
+    def routed_prompt(self, prompt):
+        "``prompt``, adding providers with open circuits to its ignore list"
+        if not self.ignored:
+            return prompt
+        provider = dict(prompt.options.provider or {})
+        provider["ignore"] = list(
+            dict.fromkeys([*(provider.get("ignore") or []), *self.ignored])
+        )
+        options = prompt.options.model_copy(update={"provider": provider})
+        return _PromptOptionsProxy(prompt, options)
+
+    def observe(self, events):
+        try:
+            for event in events:
+                if self.ttft is None:
+                    self.ttft = time.monotonic() - self.start
+                yield event
+        except Exception as ex:
+            self.finish(ex)
+            raise
+        self.finish()
+
+    async def aobserve(self, events):
+        try:
+            async for event in events:
+                if self.ttft is None:
+                    self.ttft = time.monotonic() - self.start
+                yield event
+        except Exception as ex:
+            await asyncio.to_thread(self.finish, ex)
+            raise
+        await asyncio.to_thread(self.finish)
+
+    def finish(self, error=None):
+        if error is not None:
+            if not _upstream_failure(error):
+                if self.probe:
+                    # Says nothing about the model's health, so probe again
+                    self.breaker.record(self.model, failed=False, probe=True)
+                return
+            provider = _error_provider(error)
+            failed = True
+        else:
+            provider = (self.response.response_json or {}).get("provider")
+            slow = self.breaker.slow
+            failed = bool(slow and self.ttft is not None and self.ttft > slow)
+        if not self.providers:
+            provider = None
+        self.breaker.record(self.model, provider, failed=failed, probe=self.probe)
+
+
+_circuit_breakers = {}
+
+
+def get_circuit_breaker():
+    """Return the CircuitBreaker configured by ``OPENROUTER_CIRCUIT_BREAKER``.
+
+    Set it to ``1`` for the defaults, or to comma-separated settings such
+    as ``failure_rate=0.5,min_requests=5,window=60,cooldown=30,slow=20``.
+    Returns None if it is not set.
+    """
+    value = os.environ.get("OPENROUTER_CIRCUIT_BREAKER")
+    if not value or value == "0":
+        return None
+    directory = llm.user_dir() / "openrouter-breakers"
+    breaker = _circuit_breakers.get((str(directory), value))
+    if breaker is None:
+        breaker = _circuit_breakers[(str(directory), value)] = CircuitBreaker(
+            directory, **parse_circuit_breaker(value)
+        )
+    return breaker
+
+
+def parse_circuit_breaker(value):
+    "Parse ``OPENROUTER_CIRCUIT_BREAKER`` settings into keyword arguments"
+    settings = {}
+    if value.strip() in ("1", "true"):
+        return settings
+    names = (
+        "failure_rate",
+        "min_requests",
+        "window",
+        "cooldown",
+        "slow",
+        "probe_timeout",
+    )
+    for setting in value.split(","):
+        name, _, number = setting.partition("=")
+        name = name.strip()
+        if name not in names:
+            raise ValueError(
+                "Invalid circuit breaker setting {!r}, expected one of: {}".format(
+                    name, ", ".join(names)
+                )
+            )
+        try:
+            settings[name] = float(number)
+        except ValueError:
+            raise ValueError(
+                "Invalid circuit breaker setting {}={!r}".format(name, number)
+            )
+    return settings
+
+
+# Assumed idle lifetime of a container when sleep_after_seconds is not set
+SHELL_CONTAINER_TTL = 600
+
+
+class ShellContainerPool:
+    """Warm Shell containers, shared between processes through a JSON file.
+
+    Containers are grouped by ``Shell.pool_key()`` and forgotten once they
+    expire. A container is removed from the pool while a prompt is using it,
+    so concurrent prompts never share one.
+    """
+
+    def __init__(self, path, max_size=4, margin=30):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.margin = margin
+
+    @contextmanager
+    def _pools(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a+") as fp:
+            _lock_file(fp.fileno())
+            try:
+                fp.seek(0)
+                try:
+                    pools = json.loads(fp.read() or "{}")
+                except json.JSONDecodeError:
+                    pools = {}
+                # Skip containers likely to expire before a request reaches them
+                cutoff = time.time() + self.margin
+                pools = {
+                    pool_key: [entry for entry in entries if entry[1] > cutoff]
+                    for pool_key, entries in pools.items()
+                }
+                yield pools
+                fp.seek(0)
+                fp.truncate()
+                json.dump({k: v for k, v in pools.items() if v}, fp)
+            finally:
+                _unlock_file(fp.fileno())
+
+    def checkout(self, pool_key):
+        "Take the most recently used container, as ``(id, expires_at)`` or None"
+        with self._pools() as pools:
+            entries = pools.get(pool_key)
+            return tuple(entries.pop()) if entries else None
+
+    def checkin(self, pool_key, container_id, expires_at):
+        with self._pools() as pools:
+            entries = [
+                entry for entry in pools.get(pool_key, []) if entry[0] != container_id
+            ]
+            entries.append([container_id, expires_at])
+            pools[pool_key] = entries[-self.max_size :]
+
+
+def _reuses_containers(prompt):
+    return any(getattr(tool, "reuse_container", False) for tool in prompt.tools or [])
+
+
+def get_shell_container_pool():
+    return ShellContainerPool(llm.user_dir() / "openrouter-shell-containers.json")
+
+
+def _shell_container_id(item):
+    container_id = item.get("container_id")
+    if container_id is None:
+        container_id = (item.get("environment") or {}).get("container_id")
+    return container_id
+
+
+class _SharedStream:
+    """Fan a single upstream call out to any number of readers.
+
+    The events of a streaming call are passed on as they arrive, while the
+    result of any other call is its only event. The call is made inside
+    ``guard()``, and cancelled if every reader stops before it is done.
+    """
+
+    def __init__(self, call, stream=True, guard=nullcontext):
+        self.events = []
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self._readers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(call, stream, guard))
+
+    async def _pump(self, call, stream, guard):
+        try:
+            async with guard():
+                result = await call
+                if not stream:
+                    self.events.append(result)
+                    return
+                async for event in result:
+                    self.events.append(event)
+                    self._notify()
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def read(self):
+        self._readers += 1
+        try:
+            index = 0
+            while True:
+                if index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self._readers -= 1
+            if not self._readers and not self.done:
+                self.cancelled = True
+                self.task.cancel()
+
+
+_in_flight_requests = {}
+
+
+class _CoalescingResponses:
+    """Wrap ``client.responses`` so identical concurrent requests share one call.
+
+    Only requests marked with a ``_coalesce`` keyword argument are shared.
+    They are keyed on their complete payload along with ``scope`` - the API
+    key or key pool, and base URL - and shared only while the original
+    request is still in flight.
+
+    The request that is made waits for ``guard()``, while requests that share
+    it call ``release()`` instead.
+    """
+
+    def __init__(self, responses, scope, guard=nullcontext, release=None):
+        self._responses = responses
+        self._scope = scope
+        self._guard = guard
+        self._release = release
+
+    async def create(self, **kwargs):
+        if not kwargs.pop("_coalesce", False):
+            return await self._responses.create(**kwargs)
+        payload = json.dumps(kwargs, sort_keys=True, default=str)
+        request_key = (
+            asyncio.get_running_loop(),
+            self._scope,
+            hashlib.sha256(payload.encode("utf-8")).hexdigest(),
+        )
+        shared = _in_flight_requests.get(request_key)
+        if shared is None or shared.cancelled:
+            shared = _SharedStream(
+                self._responses.create(**kwargs),
+                stream=bool(kwargs.get("stream")),
+                guard=self._guard,
+            )
+            _in_flight_requests[request_key] = shared
+
+            def forget(_, shared=shared):
+                # A cancelled request may have been replaced already
+                if _in_flight_requests.get(request_key) is shared:
+                    del _in_flight_requests[request_key]
+
+            shared.task.add_done_callback(forget)
+        elif self._release is not None:
+            self._release()
+        if kwargs.get("stream"):
+            return shared.read()
+        async for result in shared.read():
+            return result
+
+
+class _CoalescingClient:
+    def __init__(self, client, scope, guard=nullcontext, release=None):
+        self._client = client
+        self.responses = _CoalescingResponses(client.responses, scope, guard, release)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class _AttachmentCache:
+    "Least recently used cache of encoded attachments, capped by total size"
+
+    # Counted towards the size of each entry, so that many small or empty
+    # values cannot grow the cache without limit
+    entry_overhead = 100
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) + self.entry_overhead > self.max_size:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous) + self.entry_overhead
+            self._items[key] = value
+            self.size += len(value) + self.entry_overhead
+            while self.size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted) + self.entry_overhead
+
+
+attachment_cache = _AttachmentCache(max_size=256 * 1024 * 1024)
+# Content hashes of files by path, size and modification time - around six
+# thousand of them
+_path_hashes = _AttachmentCache(max_size=1024 * 1024)
+# Files are read in chunks of this many bytes - a multiple of 3 so each
+# chunk base64 encodes without padding
+_READ_CHUNK_SIZE = 3 * 1024 * 1024
+
+
+def _attachment_id(attachment):
+    """Content hash of an attachment, as returned by ``attachment.id()``.
+
+    Files are hashed in chunks rather than read into memory in full, and the
+    hash is remembered until the file's size or modification time changes.
+    """
+    if attachment._id is None and attachment.path and not attachment.content:
+        stat = os.stat(attachment.path)
+        path_key = (os.path.abspath(attachment.path), stat.st_size, stat.st_mtime_ns)
+        digest = _path_hashes.get(path_key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with open(attachment.path, "rb") as fp:
+                while chunk := fp.read(_READ_CHUNK_SIZE):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+            _path_hashes.set(path_key, digest)
+        attachment._id = digest
+    return attachment.id()
+
+
+def _encode_base64(attachment, prefix=""):
+    """Return ``prefix`` followed by the base64 encoded attachment.
+
+    The content is encoded a chunk at a time, straight after the prefix, so
+    no full size copy of it is made along the way.
+    """
+    import io
+
+    encoded = io.StringIO()
+    encoded.write(prefix)
+    if attachment.path and not attachment.content:
+        with open(attachment.path, "rb") as fp:
+            while chunk := fp.read(_READ_CHUNK_SIZE):
+                encoded.write(base64.b64encode(chunk).decode("ascii"))
+    else:
+        content = memoryview(attachment.content_bytes())
+        for start in range(0, len(content), _READ_CHUNK_SIZE):
+            chunk = content[start : start + _READ_CHUNK_SIZE]
+            encoded.write(base64.b64encode(chunk).decode("ascii"))
+    return encoded.getvalue()
+
+
+class _EncodedAttachment(llm.Attachment):
+    "An attachment with previously encoded base64 content"
+
+    def __init__(self, encoded, **kwargs):
+        super().__init__(**kwargs)
+        self._encoded = encoded
+
+    def base64_content(self):
+        return self._encoded
+
+
+def _downscale_image(attachment, max_edge):
+    """Resize an image so its longest edge is at most ``max_edge`` pixels.
+
+    Returns a ``data:`` URL for the re-encoded image, or None if the image
+    already fits or would not get any smaller.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise ValueError(
+            "image_max_edge requires Pillow - install it with: llm install Pillow"
+        )
+    import io
+
+    source = attachment.path or io.BytesIO(attachment.content_bytes())
+    with Image.open(source) as image:
+        if max(image.size) <= max_edge or getattr(image, "is_animated", False):
+            return None
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ("RGBA", "LA") or (
+            image.mode == "P" and "transparency" in image.info
+        )
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        output = io.BytesIO()
+        if has_alpha:
+            mimetype = "image/png"
+            image.save(output, format="PNG", optimize=True)
+        else:
+            # Photos and screenshots without transparency are far smaller as JPEG
+            mimetype = "image/jpeg"
+            image.convert("RGB").save(output, format="JPEG", quality=85)
+    data = output.getvalue()
+    if attachment.path:
+        original_size = os.path.getsize(attachment.path)
+    else:
+        original_size = len(attachment.content_bytes())
+    if len(data) >= original_size:
+        return None
+    return "data:{};base64,{}".format(mimetype, base64.b64encode(data).decode("ascii"))
+
+
+def _cached_attachment(attachment, image_max_edge=None):
+    """Return an equivalent attachment that uses ``attachment_cache``.
+
+    Images become ``data:`` URLs, which are sent as they are, downscaled
+    first if ``image_max_edge`` is set. Other types return their cached
+    encoding from ``base64_content()``.
+    """
+    mimetype = attachment.resolve_type()
+    is_image = mimetype.startswith("image/")
+    if is_image and attachment.url:
+        # Image URLs are passed to the model without being downloaded
+        return attachment
+    attachment_id = _attachment_id(attachment)
+    if is_image and image_max_edge:
+        key = (attachment_id, mimetype, image_max_edge)
+        encoded = attachment_cache.get(key)
+        if encoded is None:
+            # An empty string records that the original image is used
+            encoded = _downscale_image(attachment, image_max_edge) or ""
+            attachment_cache.set(key, encoded)
+        if encoded:
+            return llm.Attachment(
+                type=encoded[5 : encoded.index(";")], url=encoded, _id=attachment_id
+            )
+    key = (attachment_id, mimetype)
+    encoded = attachment_cache.get(key)
+    if encoded is None:
+        prefix = "data:{};base64,".format(mimetype) if is_image else ""
+        encoded = _encode_base64(attachment, prefix)
+        attachment_cache.set(key, encoded)
+    if is_image:
+        return llm.Attachment(type=mimetype, url=encoded, _id=attachment_id)
+    return _EncodedAttachment(
+        encoded, type=mimetype, url=attachment.url, _id=attachment_id
+    )
+
+
+class _PromptMessagesProxy:
+    def __init__(self, prompt, messages):
+        self._prompt = prompt
+        self.messages = messages
+
+    def __getattr__(self, name):
+        return getattr(self._prompt, name)
+
+
+class _PromptToolsProxy:
+    def __init__(self, prompt, tools):
+        self._prompt = prompt
+        self.tools = tools
+
+    def __getattr__(self, name):
+        return getattr(self._prompt, name)
+
+
+class SchemaViolation(ValueError):
+    "Streamed output is not valid JSON, or can no longer match its schema"
+
+    def __init__(self, message, path=()):
+        super().__init__(message)
+        self.path = tuple(path)
+
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_JSON_STRING_CHARS = re.compile(r'(?:[^"\\\x00-\x1f]|\\.)*')
+_JSON_NUMBER = re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+_JSON_NUMBER_CHARS = re.compile(r"[-+.eE0-9]*")
+_JSON_LITERALS = (("true", True), ("false", False), ("null", None))
+_JSON_COMBINATORS = ("$ref", "anyOf", "oneOf", "allOf", "not", "if")
+
+
+def _json_path(path):
+    return "$" + "".join(
+        "[{}]".format(key) if isinstance(key, int) else ".{}".format(key)
+        for key in path
+    )
+
+
+def _json_type_matches(value, type_name):
+    if type_name == "integer":
+        return (isinstance(value, int) and not isinstance(value, bool)) or (
+            isinstance(value, float) and value.is_integer()
+        )
+    if type_name == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    expected = {
+        "object": dict,
+        "array": list,
+        "string": str,
+        "boolean": bool,
+        "null": type(None),
+    }.get(type_name)
+    return expected is None or isinstance(value, expected)
+
+
+def _schema_violation(value, schema, path=(), deep=True):
+    """Describe how a complete value breaks a schema, or return None.
+
+    Checks ``type``, ``enum``, ``const``, ``required``, ``properties``,
+    ``additionalProperties`` and ``items``. Schemas using ``$ref`` or
+    combinators are assumed to match. With ``deep=False`` the properties and
+    items of objects and arrays are not checked.
+    """
+    if not isinstance(schema, dict) or any(k in schema for k in _JSON_COMBINATORS):
+        return None
+    types = schema.get("type")
+    if types is not None:
+        types = [types] if isinstance(types, str) else types
+        if not any(_json_type_matches(value, type_name) for type_name in types):
+            return "{}: expected {}".format(_json_path(path), " or ".join(types))
+    if "enum" in schema and value not in schema["enum"]:
+        return "{}: {!r} is not one of {!r}".format(
+            _json_path(path), value, schema["enum"]
+        )
+    if "const" in schema and value != schema["const"]:
+        return "{}: expected {!r}".format(_json_path(path), schema["const"])
+    if isinstance(value, dict):
+        for name in schema.get("required") or ():
+            if name not in value:
+                return "{}: missing required property {!r}".format(
+                    _json_path(path), name
+                )
+        for name, item in value.items() if deep else ():
+            try:
+                property_schema = _property_schema(schema, name, path)
+            except SchemaViolation as ex:
+                return str(ex)
+            violation = _schema_violation(item, property_schema, path + (name,))
+            if violation:
+                return violation
+    elif isinstance(value, list) and deep:
+        for index, item in enumerate(value):
+            violation = _schema_violation(item, _item_schema(schema), path + (index,))
+            if violation:
+                return violation
+    return None
+
+
+def _property_schema(schema, name, path):
+    """The schema for an object property, or None if it cannot be known.
+
+    Raises ``SchemaViolation`` for properties the schema does not allow.
+    """
+    if not isinstance(schema, dict) or any(k in schema for k in _JSON_COMBINATORS):
+        return None
+    properties = schema.get("properties") or {}
+    if name in properties:
+        return properties[name]
+    additional = schema.get("additionalProperties")
+    if additional is False:
+        raise SchemaViolation(
+            "{}: unexpected property {!r}".format(_json_path(path), name), path
+        )
+    return additional if isinstance(additional, dict) else None
+
+
+def _item_schema(schema):
+    if not isinstance(schema, dict) or any(k in schema for k in _JSON_COMBINATORS):
+        return None
+    items = schema.get("items")
+    return items if isinstance(items, dict) else None
+
+
+def _schema_items_path(schema):
+    """Where the items are in JSON matching a schema.
+
+    That is the top-level array, or the only property of a top-level object
+    if it is an array - the shape used by ``llm --schema-multi``.
+    """
+    if not isinstance(schema, dict) or schema.get("type") == "array":
+        return ()
+    properties = schema.get("properties") or {}
+    if schema.get("type") == "object" and len(properties) == 1:
+        (name, property_schema), *_ = properties.items()
+        if isinstance(property_schema, dict) and (
+            property_schema.get("type") == "array"
+        ):
+            return (name,)
+    return None
+
+
+class _JsonFrame:
+    __slots__ = ("container", "schema", "path", "key", "state")
+
+    def __init__(self, container, schema, path):
+        self.container = container
+        self.schema = schema
+        self.path = path
+        self.key = None
+        self.state = "first"
+
+
+class JSONStreamParser:
+    """Parse JSON incrementally as it streams in, checking it against a schema.
+
+    ``feed()`` takes the next chunk of text and returns the items it
+    completed - elements of the top-level array, or of the array a
+    ``--schema-multi`` style schema wraps in an object. ``value`` is the
+    document parsed so far, holding only completed strings and numbers.
+
+    ``feed()`` and ``close()`` raise ``SchemaViolation`` as soon as the text
+    is not valid JSON, or cannot match the schema whatever follows.
+    """
+
+    def __init__(self, schema=None):
+        self.schema = schema
+        self.items_path = _schema_items_path(schema)
+        self.value = None
+        self.done = False
+        self._buffer = ""
+        self._pos = 0
+        self._stack = []
+        # The chunks so far of a string that has not been closed yet, and
+        # whether the last of them ends with a backslash
+        self._string = None
+        self._escaped = False
+
+    def feed(self, text):
+        items = []
+        if self._string is not None:
+            if not text:
+                return items
+            # Only the new text is scanned, never the string so far again
+            end = self._scan_string(text, 1 if self._escaped else 0)
+            if end is None:
+                self._string.append(text)
+                return items
+            self._string.append(text[: end + 1])
+            string, self._string = "".join(self._string), None
+            self._handle(*self._string_token(string), items)
+            text = text[end + 1 :]
+        self._buffer = self._buffer[self._pos :] + text
+        self._pos = 0
+        while (token := self._next_token(final=False)) is not None:
+            self._handle(*token, items)
+        return items
+
+    def close(self):
+        "Parse whatever is left and return the complete value"
+        if self._string is not None:
+            raise SchemaViolation("Invalid JSON string")
+        items = []
+        while (token := self._next_token(final=True)) is not None:
+            self._handle(*token, items)
+        if not self.done:
+            raise SchemaViolation("Incomplete JSON")
+        return self.value
+
+    def _next_token(self, final):
+        buffer = self._buffer
+        pos = _JSON_WHITESPACE.match(buffer, self._pos).end()
+        self._pos = pos
+        if pos == len(buffer):
+            return None
+        char = buffer[pos]
+        if char in "{}[]:,":
+            self._pos = pos + 1
+            return char, None
+        if char == '"':
+            end = self._scan_string(buffer, pos + 1)
+            if end is None:
+                if final:
+                    raise SchemaViolation("Invalid JSON string")
+                # Kept aside, so the rest is scanned as it arrives
+                self._string = [buffer[pos:]]
+                self._buffer = ""
+                self._pos = 0
+                return None
+            self._pos = end + 1
+            return self._string_token(buffer[pos : end + 1])
+        if char == "-" or char.isdigit():
+            end = _JSON_NUMBER_CHARS.match(buffer, pos).end()
+            if end == len(buffer) and not final:
+                # The number may continue in the next chunk
+                return None
+            match = _JSON_NUMBER.fullmatch(buffer, pos, end)
+            if match is None:
+                raise SchemaViolation("Invalid JSON number")
+            self._pos = end
+            return "scalar", json.loads(match.group())
+        for literal, value in _JSON_LITERALS:
+            if buffer.startswith(literal, pos):
+                self._pos = pos + len(literal)
+                return "scalar", value
+            if not final and literal.startswith(buffer[pos:]):
+                return None
+        raise SchemaViolation("Invalid JSON: unexpected {!r}".format(char))
+
+    def _scan_string(self, text, start):
+        """The index in ``text`` of the quote closing a string, or None.
+
+        ``start`` is just inside the string. None means the string continues
+        past the end of ``text``, and sets ``_escaped`` if it ends mid-escape.
+        """
+        end = _JSON_STRING_CHARS.match(text, start).end()
+        if end == len(text):
+            self._escaped = False
+            return None
+        if text[end] == '"':
+            return end
+        if text[end] == "\\" and end == len(text) - 1:
+            self._escaped = True
+            return None
+        # A control character
+        raise SchemaViolation("Invalid JSON string")
+
+    def _string_token(self, text):
+        try:
+            return "string", json.loads(text)
+        except ValueError:
+            # Such as an invalid escape
+            raise SchemaViolation("Invalid JSON string")
+
+    def _handle(self, kind, value, items):
+        if not self._stack:
+            if self.done:
+                raise SchemaViolation("Unexpected data after the JSON value")
+            self._start_value(kind, value, self.schema, (), items)
+            return
+        frame = self._stack[-1]
+        if isinstance(frame.container, dict):
+            if frame.state in ("first", "key") and kind == "string":
+                _property_schema(frame.schema, value, frame.path)
+                frame.key = value
+                frame.state = "colon"
+                return
+            if frame.state == "colon" and kind == ":":
+                frame.state = "value"
+                return
+            if frame.state == "value":
+                frame.state = "next"
+                self._start_value(
+                    kind,
+                    value,
+                    _property_schema(frame.schema, frame.key, frame.path),
+                    frame.path + (frame.key,),
+                    items,
+                )
+                return
+            if frame.state == "next" and kind == ",":
+                frame.state = "key"
+                return
+            if frame.state in ("first", "next") and kind == "}":
+                self._end(items)
+                return
+        else:
+            if frame.state in ("first", "next") and kind == "]":
+                self._end(items)
+                return
+            if frame.state in ("first", "value"):
+                frame.state = "next"
+                self._start_value(
+                    kind,
+                    value,
+                    _item_schema(frame.schema),
+                    frame.path + (len(frame.container),),
+                    items,
+                )
+                return
+            if frame.state == "next" and kind == ",":
+                frame.state = "value"
+                return
+        raise SchemaViolation(
+            "Invalid JSON: unexpected {!r} at {}".format(
+                value if kind in ("string", "scalar") else kind,
+                _json_path(frame.path),
+            ),
+            frame.path,
+        )
+
+    def _start_value(self, kind, value, schema, path, items):
+        if kind in ("{", "["):
+            container = {} if kind == "{" else []
+            # Only the type can be checked until the container is complete
+            violation = isinstance(schema, dict) and _schema_violation(
+                container,
+                {k: v for k, v in schema.items() if k in ("type", *_JSON_COMBINATORS)},
+                path,
+            )
+            if violation:
+                raise SchemaViolation(violation, path)
+            self._attach(container, path)
+            self._stack.append(_JsonFrame(container, schema, path))
+        elif kind in ("string", "scalar"):
+            violation = _schema_violation(value, schema, path)
+            if violation:
+                raise SchemaViolation(violation, path)
+            self._attach(value, path)
+            self._completed(value, path, items)
+        else:
+            raise SchemaViolation(
+                "Invalid JSON: unexpected {!r} at {}".format(kind, _json_path(path)),
+                path,
+            )
+
+    def _attach(self, value, path):
+        if not self._stack:
+            self.value = value
+        elif isinstance(self._stack[-1].container, dict):
+            self._stack[-1].container[path[-1]] = value
+        else:
+            self._stack[-1].container.append(value)
+
+    def _end(self, items):
+        frame = self._stack.pop()
+        violation = _schema_violation(
+            frame.container, frame.schema, frame.path, deep=False
+        )
+        if violation:
+            raise SchemaViolation(violation, frame.path)
+        self._completed(frame.container, frame.path, items)
+
+    def _completed(self, value, path, items):
+        if not path:
+            self.done = True
+        elif self.items_path is not None and path[:-1] == self.items_path:
+            if isinstance(path[-1], int):
+                items.append(value)
+
+
+def schema_items(response):
+    """Yield each item of a schema response as soon as it has streamed.
+
+    Items are the elements of a top-level array, or of the array that
+    ``--schema-multi`` style schemas wrap in an object.
+    """
+    parser = JSONStreamParser(response.prompt.schema)
+    for chunk in response:
+        yield from parser.feed(chunk)
+    parser.close()
+
+
+async def aschema_items(response):
+    "Async version of ``schema_items`` for responses from async models"
+    parser = JSONStreamParser(response.prompt.schema)
+    async for chunk in response:
+        for item in parser.feed(chunk):
+            yield item
+    parser.close()
+
+
+_current_span = ContextVar("openrouter_span", default=None)
+_current_request_trace = ContextVar("openrouter_request_trace", default=None)
+
+
+def _reset_context_var(var, token):
+    """Undo ``var.set()`` with the token it returned.
+
+    A generator can be closed in a different context from the one it set the
+    variable in, where ``reset()`` is not allowed. There the old value is set
+    instead.
+    """
+    try:
+        var.reset(token)
+    except ValueError:
+        old_value = token.old_value
+        var.set(None if old_value is token.MISSING else old_value)
+
+
+class _Span:
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start",
+        "attributes",
+        "error",
+        "otel",
+    )
+
+    def __init__(self, name, parent, attributes, start=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.start = start or time.time_ns()
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self.error = None
+        self.otel = None
+
+
+class _Tracer:
+    @contextmanager
+    def span(self, name, attributes=None):
+        span = self.start_span(name, attributes, _current_span.get())
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as ex:
+            span.error = repr(ex)
+            raise
+        finally:
+            _reset_context_var(_current_span, token)
+            self.end_span(span)
+
+
+class JsonlTracer(_Tracer):
+    """Append each finished span to a JSON lines file.
+
+    Every line has ``name``, ``trace_id``, ``span_id``, ``parent_id``,
+    ``start`` and ``end`` (nanoseconds since the epoch), ``duration_ms``,
+    ``attributes`` and ``error``.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def start_span(self, name, attributes=None, parent=None, start=None):
+        return _Span(name, parent, attributes or {}, start)
+
+    def end_span(self, span, end=None):
+        end = end or time.time_ns()
+        line = json.dumps(
+            {
+                "name": span.name,
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "start": span.start,
+                "end": end,
+                "duration_ms": (end - span.start) / 1e6,
+                "attributes": span.attributes,
+                "error": span.error,
+            },
+            default=str,
+        )
+        with self._lock, self.path.open("a", encoding="utf-8") as fp:
+            fp.write(line + "\n")
+
+
+class OtelTracer(_Tracer):
+    "Send spans to whatever OpenTelemetry tracer provider is configured"
+
+    def __init__(self):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ValueError(
+                "OPENROUTER_TRACE=otel requires opentelemetry-api - "
+                "install it with: llm install opentelemetry-api"
+            )
+        self._trace = trace
+        self._tracer = trace.get_tracer("llm-openrouter")
+
+    def start_span(self, name, attributes=None, parent=None, start=None):
+        span = _Span(name, parent, attributes or {}, start)
+        # Without a parent span this nests under the application's current span
+        context = (
+            self._trace.set_span_in_context(parent.otel) if parent is not None else None
+        )
+        span.otel = self._tracer.start_span(
+            name, context=context, attributes=span.attributes, start_time=span.start
+        )
+        return span
+
+    def end_span(self, span, end=None):
+        span.otel.set_attributes(span.attributes)
+        if span.error:
+            span.otel.set_status(
+                self._trace.Status(self._trace.StatusCode.ERROR, span.error)
+            )
+        span.otel.end(end_time=end)
+
+
+def get_tracer():
+    """Return the tracer configured by ``OPENROUTER_TRACE``, or None.
+
+    ``OPENROUTER_TRACE=otel`` sends spans to OpenTelemetry, any other value
+    is the path of a JSON lines file to append spans to.
+    """
+    value = os.environ.get("OPENROUTER_TRACE")
+    return _get_tracer(value) if value else None
+
+
+@cache
+def _get_tracer(value):
+    if value == "otel":
+        return OtelTracer()
+    return JsonlTracer(value)
+
+
+def _traced(name):
+    "Run the decorated method inside a span named ``name`` when tracing is on"
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = get_tracer()
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _RequestTrace:
+    """Child spans for one request: HTTP phases, server tools and completion.
+
+    ``http`` is an httpcore ``trace`` extension callback, ``observe`` watches
+    the events the model yields for server-side tool calls and results.
+    """
+
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+        self.connect = None
+        self.first_byte = None
+        self.completion = None
+        self.tools = {}
+
+    def _start(self, name, attributes=None):
+        return self.tracer.start_span(name, attributes, self.span)
+
+    def _end(self, span, error=None, **attributes):
+        if span is not None:
+            span.attributes.update(attributes)
+            span.error = error
+            self.tracer.end_span(span)
+
+    def http(self, name, info):
+        event = name.split(".", 1)[-1]
+        if event == "connect_tcp.started":
+            self.connect = self._start("openrouter.http.connect")
+        elif event == "send_request_headers.started":
+            # Any TLS handshake is done by now, so the connection is ready
+            self._end(self.connect)
+            self.connect = None
+            self.first_byte = self._start("openrouter.http.first_byte")
+        elif event == "receive_response_headers.complete":
+            value = info.get("return_value") or ()
+            status = next((v for v in value if isinstance(v, int)), None)
+            self._end(self.first_byte, **{"http.status_code": status})
+            self.first_byte = None
+            if status is not None and status < 400:
+                # A retried request replaces the completion span
+                self._end(self.completion)
+                self.completion = self._start("openrouter.completion")
+        elif event.endswith(".failed"):
+            error = repr(info.get("exception"))
+            self._end(self.connect, error)
+            self._end(self.first_byte, error)
+            self.connect = self.first_byte = None
+
+    async def ahttp(self, name, info):
+        self.http(name, info)
+
+    def on_request(self, request):
+        request.extensions["trace"] = self.http
+
+    async def on_async_request(self, request):
+        request.extensions["trace"] = self.ahttp
+
+    def _observe(self, event):
+        if not event.server_executed:
+            return
+        if event.type == "tool_call_name":
+            self.tools[event.tool_call_id] = self._start(
+                "openrouter.server_tool",
+                {
+                    "openrouter.tool_name": event.chunk,
+                    "openrouter.tool_call_id": event.tool_call_id,
+                },
+            )
+        elif event.type == "tool_result":
+            # Web search results arrive with their call, shell output later
+            span = self.tools.pop(event.tool_call_id, None)
+            self._end(span)
+
+    def observe(self, events):
+        for event in events:
+            self._observe(event)
+            yield event
+
+    async def aobserve(self, events):
+        async for event in events:
+            self._observe(event)
+            yield event
+
+    def finish(self, response, error=None):
+        error = repr(error) if error is not None else None
+        for span in (self.connect, self.first_byte, *self.tools.values()):
+            self._end(span, error)
+        response_json = response.response_json or {}
+        attributes = {
+            "openrouter.generation_id": response_json.get("id"),
+            "openrouter.resolved_model": response_json.get("model"),
+        }
+        if response_json.get("provider"):
+            attributes["openrouter.provider"] = response_json["provider"]
+        self.span.attributes.update(
+            {k: v for k, v in attributes.items() if v is not None}
+        )
+        self._end(self.completion, error, **self.span.attributes)
+        self.span.attributes.update(
+            {
+                key: value
+                for key, value in (
+                    ("openrouter.input_tokens", response.input_tokens),
+                    ("openrouter.output_tokens", response.output_tokens),
+                    ("openrouter.cost", _response_cost(response)),
+                )
+                if value is not None
+            }
+        )
+        self.span.error = error
+        self.tracer.end_span(self.span)
+
+
+def _response_cost(response):
+    "The cost OpenRouter reported for a response, if it reported one"
+    return ((response.response_json or {}).get("usage") or {}).get("cost")
+
+
+class _AbandonedUsage:
+    """Usage of attempts thrown away before a response's final attempt.
+
+    ``abandon()`` takes the usage of the attempt that just ended off the
+    response, and ``apply()`` adds it all to the final attempt's usage, so
+    the response accounts for every attempt that was billed.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0
+        self.attempts = 0
+
+    def abandon(self):
+        response = self.response
+        self.input_tokens += response.input_tokens or 0
+        self.output_tokens += response.output_tokens or 0
+        self.cost += _response_cost(response) or 0
+        self.attempts += 1
+        response.response_json = None
+        response.set_usage()
+
+    def apply(self):
+        if not self.attempts:
+            return
+        response = self.response
+        response.set_usage(
+            input=(response.input_tokens or 0) + self.input_tokens,
+            output=(response.output_tokens or 0) + self.output_tokens,
+            details=response.token_details,
+        )
+        if self.cost:
+            response.response_json = dict(response.response_json or {})
+            usage = dict(response.response_json.get("usage") or {})
+            usage["cost"] = (usage.get("cost") or 0) + self.cost
+            response.response_json["usage"] = usage
+
+
+def _http_observers():
+    "The trace and metrics observing the current request, if any"
+    return [
+        observer
+        for observer in (_current_request_trace.get(), _current_request_metrics.get())
+        if observer is not None
+    ]
+
+
+def _observe_http_request(request):
+    for observer in _http_observers():
+        observer.on_request(request)
+
+
+async def _aobserve_http_request(request):
+    for observer in _http_observers():
+        await observer.on_async_request(request)
+
+
+# Shared HTTP clients for observed requests: one sync client, keyed by None,
+# and an async client for each event loop, as (loop, client) pairs
+_observed_http_clients = {}
+
+
+def _observed_http_client(async_=False):
+    """The shared OpenAI HTTP client for requests that are being observed.
+
+    Its hooks call the observers of whichever request is current, so one
+    client, with its pool of connections, serves every request.
+    """
+    import openai
+
+    loop = asyncio.get_running_loop() if async_ else None
+    entry = _observed_http_clients.get(id(loop) if async_ else None)
+    if entry is not None and entry[0] is loop:
+        return entry[1]
+    for key, (other_loop, _) in list(_observed_http_clients.items()):
+        if other_loop is not None and other_loop.is_closed():
+            # Its connections went with the loop
+            del _observed_http_clients[key]
+    if async_:
+        client = openai.DefaultAsyncHttpxClient(
+            event_hooks={"request": [_aobserve_http_request]}
+        )
+    else:
+        client = openai.DefaultHttpxClient(
+            event_hooks={"request": [_observe_http_request]}
+        )
+    _observed_http_clients[id(loop) if async_ else None] = (loop, client)
+    return client
+
+
+class Metrics:
+    """In-process metrics for the requests made by OpenRouter models.
+
+    Labelled by model and provider: request, error, retry and in-flight
+    counts, input and output tokens, cost and histograms of time to first
+    token and request duration.
+
+    Requests append their samples to a queue without taking a lock. The
+    queue is folded into the totals when metrics are read, or when it grows
+    past ``max_pending`` samples.
+    """
+
+    DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+    _help = {
+        "openrouter_requests_total": ("counter", "Requests started"),
+        "openrouter_errors_total": ("counter", "Requests that failed, by status"),
+        "openrouter_retries_total": ("counter", "HTTP requests retried"),
+        "openrouter_in_flight": ("gauge", "Requests in progress"),
+        "openrouter_input_tokens_total": ("counter", "Input tokens"),
+        "openrouter_output_tokens_total": ("counter", "Output tokens"),
+        "openrouter_cost_total": ("counter", "Cost in credits reported"),
+        "openrouter_time_to_first_token_seconds": (
+            "histogram",
+            "Time until the first streamed event",
+        ),
+        "openrouter_request_duration_seconds": (
+            "histogram",
+            "Time until the response finished",
+        ),
+    }
+
+    def __init__(self, statsd=None, max_pending=1000):
+        self.enabled = False
+        self.statsd = statsd
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def enable(self, statsd=None):
+        """Start recording metrics.
+
+        ``statsd`` is a ``StatsdEmitter`` or a ``host:port`` address to also
+        send metrics to over UDP.
+        """
+        if isinstance(statsd, str):
+            statsd = StatsdEmitter.from_address(statsd)
+        if statsd is not None:
+            self.statsd = statsd
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+            self._values.clear()
+
+    def _record(self, sample):
+        self._pending.append(sample)
+        if len(self._pending) > self.max_pending:
+            self._fold()
+
+    def request_started(self, model, provider):
+        self._record(("start", model, provider))
+
+    def request_finished(
+        self,
+        model,
+        provider,
+        *,
+        duration,
+        ttft=None,
+        status=None,
+        retries=0,
+        input_tokens=None,
+        output_tokens=None,
+        cost=None,
+        served_by=None,
+    ):
+        sample = (
+            "finish",
+            model,
+            provider,
+            duration,
+            ttft,
+            status,
+            retries,
+            input_tokens,
+            output_tokens,
+            cost,
+            served_by,
+        )
+        self._record(sample)
+        if self.statsd is not None:
+            self.statsd.send(sample)
+
+    def _add(self, name, labels, amount):
+        key = (name, labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _observe(self, name, labels, buckets, value):
+        key = (name, labels)
+        histogram = self._values.get(key)
+        if histogram is None:
+            # One count per bucket, then +Inf, then the sum
+            histogram = self._values[key] = [0] * (len(buckets) + 2)
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[index] += 1
+                break
+        else:
+            histogram[len(buckets)] += 1
+        histogram[-1] += value
+
+    def _fold(self):
+        with self._lock:
+            while self._pending:
+                try:
+                    sample = self._pending.popleft()
+                except IndexError:
+                    break
+                kind, model, provider, *rest = sample
+                labels = (("model", model), ("provider", provider or ""))
+                if kind == "start":
+                    self._add("openrouter_requests_total", labels, 1)
+                    self._add("openrouter_in_flight", labels, 1)
+                else:
+                    self._fold_finished(labels, *rest)
+
+    def _fold_finished(
+        self,
+        labels,
+        duration,
+        ttft,
+        status,
+        retries,
+        input_tokens,
+        output_tokens,
+        cost,
+        served_by,
+    ):
+        self._add("openrouter_in_flight", labels, -1)
+        if served_by:
+            served = labels + (("served_by", served_by),)
+            self._add("openrouter_served_total", served, 1)
+        if status is not None:
+            self._add("openrouter_errors_total", labels + (("status", status),), 1)
+        if retries:
+            self._add("openrouter_retries_total", labels, retries)
+        if input_tokens:
+            self._add("openrouter_input_tokens_total", labels, input_tokens)
+        if output_tokens:
+            self._add("openrouter_output_tokens_total", labels, output_tokens)
+        if cost:
+            self._add("openrouter_cost_total", labels, cost)
+        if ttft is not None:
+            self._observe(
+                "openrouter_time_to_first_token_seconds",
+                labels,
+                self.TTFT_BUCKETS,
+                ttft,
+            )
+        self._observe(
+            "openrouter_request_duration_seconds",
+            labels,
+            self.DURATION_BUCKETS,
+            duration,
+        )
+
+    def get(self, name, **labels):
+        """Return the current value of a metric for one set of labels.
+
+        Histograms are returned as a dictionary of cumulative bucket
+        counts, plus ``sum`` and ``count``.
+        """
+        self._fold()
+        for (metric, metric_labels), value in list(self._values.items()):
+            if metric == name and dict(metric_labels) == {
+                "provider": "",
+                **labels,
+            }:
+                if isinstance(value, list):
+                    return self._histogram(name, value)
+                return value
+        return None
+
+    def _histogram(self, name, value):
+        buckets = (
+            self.TTFT_BUCKETS
+            if name == "openrouter_time_to_first_token_seconds"
+            else self.DURATION_BUCKETS
+        )
+        result = {}
+        count = 0
+        for bound, bucket_count in zip((*buckets, "+Inf"), value):
+            count += bucket_count
+            result[str(bound)] = count
+        result["sum"] = value[-1]
+        result["count"] = count
+        return result
+
+    def prometheus_text(self):
+        "All metrics in the Prometheus text exposition format"
+        self._fold()
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            kind, help_text = self._help[name]
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, kind))
+            if kind != "histogram":
+                lines.append("{}{} {}".format(name, _prometheus_labels(labels), value))
+                continue
+            histogram = self._histogram(name, value)
+            for bound, count in list(histogram.items())[:-2]:
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        name, _prometheus_labels(labels + (("le", bound),)), count
+                    )
+                )
+            for suffix in ("sum", "count"):
+                lines.append(
+                    "{}_{}{} {}".format(
+                        name, suffix, _prometheus_labels(labels), histogram[suffix]
+                    )
+                )
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def _prometheus_labels(labels):
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in labels
+        )
+    )
+
+
+class StatsdEmitter:
+    """Send a finished request's metrics to statsd as one UDP packet.
+
+    Metrics are tagged with the model, provider and error status in the
+    DogStatsD ``|#name:value`` format.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix="openrouter"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    @classmethod
+    def from_address(cls, address):
+        host, _, port = address.rpartition(":")
+        return cls(host or "127.0.0.1", int(port))
+
+    def send(self, sample):
+        (
+            _,
+            model,
+            provider,
+            duration,
+            ttft,
+            status,
+            retries,
+            input_tokens,
+            output_tokens,
+            cost,
+            served_by,
+        ) = sample
+        tags = "model:{},provider:{}".format(model, provider or "")
+        lines = [
+            "requests:1|c",
+            "duration:{:.3f}|ms".format(duration * 1000),
+        ]
+        if ttft is not None:
+            lines.append("ttft:{:.3f}|ms".format(ttft * 1000))
+        if status is not None:
+            lines.append("errors:1|c|#{},status:{}".format(tags, status))
+        if retries:
+            lines.append("retries:{}|c".format(retries))
+        if input_tokens:
+            lines.append("input_tokens:{}|c".format(input_tokens))
+        if output_tokens:
+            lines.append("output_tokens:{}|c".format(output_tokens))
+        if cost:
+            lines.append("cost:{}|c".format(cost))
+        if served_by:
+            lines.append("served:1|c|#{},served_by:{}".format(tags, served_by))
+        packet = "\n".join(
+            "{}.{}{}".format(self.prefix, line, "" if "|#" in line else "|#" + tags)
+            for line in lines
+        )
+        try:
+            self._socket.sendto(packet.encode("utf-8"), self.address)
+        except OSError:
+            # Metrics must never break a prompt
+            pass
+
+
+metrics = Metrics()
+
+
+def _active_metrics():
+    "The process-wide ``metrics``, or None if they are not being recorded"
+    if metrics.enabled:
+        return metrics
+    if os.environ.get("OPENROUTER_METRICS") or os.environ.get("OPENROUTER_STATSD"):
+        metrics.enable(statsd=os.environ.get("OPENROUTER_STATSD") or None)
+        return metrics
+    return None
+
+
+def start_metrics_server(port=9464, host="127.0.0.1"):
+    """Serve ``metrics`` for Prometheus at ``/metrics`` from a daemon thread.
+
+    Returns the ``ThreadingHTTPServer``, call ``shutdown()`` to stop it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class _RequestMetrics:
+    def __init__(self, metrics, model, provider):
+        self.metrics = metrics
+        self.model = model
+        self.provider = provider
+        self.start = time.monotonic()
+        self.ttft = None
+        self.attempts = 0
+        metrics.request_started(model, provider)
+
+    def on_request(self, request):
+        self.attempts += 1
+
+    async def on_async_request(self, request):
+        self.attempts += 1
+
+    def observe(self, events):
+        # Only the first event is timed, the rest pass straight through
+        for event in events:
+            self.ttft = time.monotonic() - self.start
+            yield event
+            break
+        yield from events
+
+    async def aobserve(self, events):
+        async for event in events:
+            if self.ttft is None:
+                self.ttft = time.monotonic() - self.start
+            yield event
+
+    def finish(self, response, error=None):
+        status = None
+        if error is not None:
+            status = str(getattr(error, "status_code", None) or type(error).__name__)
+        # Counted under the labels the request started with, so that the
+        # in-flight gauge goes back down for the same labels it went up for
+        self.metrics.request_finished(
+            self.model,
+            self.provider,
+            duration=time.monotonic() - self.start,
+            ttft=self.ttft,
+            status=status,
+            retries=max(self.attempts - 1, 0),
+            input_tokens=response.input_tokens,
+            output_tokens=response.output_tokens,
+            cost=_response_cost(response),
+            served_by=(response.response_json or {}).get("provider"),
+        )
+
+
+_current_request_metrics = ContextVar("openrouter_request_metrics", default=None)
+
+GENERATION_STATS_COLUMNS = (
+    "model",
+    "provider_name",
+    "finish_reason",
+    "latency",
+    "moderation_latency",
+    "generation_time",
+    "native_tokens_prompt",
+    "native_tokens_completion",
+    "native_tokens_reasoning",
+    "total_cost",
+)
+
+
+class GenerationStatsCollector:
+    """Look up ``/generation`` stats for finished responses in the background.
+
+    ``submit()`` returns immediately. Lookups run on an event loop in a
+    daemon thread, at most ``concurrency`` at a time, and are written to an
+    ``openrouter_generations`` table in the SQLite database at ``db_path``.
+    OpenRouter takes a moment to make stats available, so a lookup waits
+    ``initial_delay`` seconds and retries 404, 408, 429 and 5xx responses
+    with exponential backoff, up to ``max_attempts`` times.
+
+    The process does not wait for lookups at exit: any left pending are
+    retried by the next collector to start, using the same key if it is
+    still the default key or in the key pool. Pass ``exit_timeout`` to wait
+    up to that many seconds for lookups in progress instead.
+    """
+
+    def __init__(
+        self,
+        db_path,
+        api_base=None,
+        *,
+        concurrency=4,
+        max_attempts=6,
+        initial_delay=1.0,
+        max_delay=30.0,
+        exit_timeout=None,
+    ):
+        self.db_path = Path(db_path)
+        self.api_base = api_base or get_api_base()
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.exit_timeout = exit_timeout
+        self._lock = threading.Lock()
+        self._loop = None
+        self._tasks = set()
+        # Submitted IDs without a pending row yet, and the hashes of their
+        # keys, saved at exit if need be
+        self._unsaved = {}
+        # Created on the event loop's thread
+        self._db = None
+        self._client = None
+        self._semaphore = None
+
+    def submit(self, generation_id, key):
+        "Queue a generation ID to be looked up with ``key``"
+        with self._lock:
+            self._unsaved[generation_id] = _key_hash(key)
+            if self._loop is None:
+                self._start()
+        self._loop.call_soon_threadsafe(
+            self._spawn, generation_id, key, self.initial_delay
+        )
+
+    def _start(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self._loop.run_forever,
+            name="openrouter-generation-stats",
+            daemon=True,
+        ).start()
+        atexit.register(self._flush)
+        self._loop.call_soon_threadsafe(self._resume_pending)
+
+    def _spawn(self, generation_id, key, delay):
+        task = self._loop.create_task(self._lookup(generation_id, key, delay))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _table(self):
+        if self._db is None:
+            import sqlite_utils
+
+            self._db = sqlite_utils.Database(self.db_path)
+        return self._db["openrouter_generations"]
+
+    def _write(self, generation_id, status, attempts, stats=None, **extra):
+        row = {
+            "id": generation_id,
+            "status": status,
+            "attempts": attempts,
+            "error": None,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            **extra,
+        }
+        if stats is not None:
+            row.update(
+                {column: stats.get(column) for column in GENERATION_STATS_COLUMNS}
+            )
+            row["stats"] = json.dumps(stats)
+        try:
+            self._table().upsert(row, pk="id", alter=True)
+        except Exception:
+            # A locked or unwritable database must not end the lookups
+            logger.exception("Could not save generation stats for %s", generation_id)
+
+    def _resume_pending(self):
+        try:
+            table = self._table()
+            if not table.exists():
+                return
+            default = llm.get_key(alias="openrouter", env="OPENROUTER_KEY")
+            pool = get_key_pool()
+            keys = {_key_hash(key): key for key in (pool.keys if pool else ())}
+            if default:
+                keys.setdefault(_key_hash(default), default)
+            if "key_hash" not in table.columns_dict:
+                rows = table.rows_where("status = ?", ["pending"], select="id")
+            else:
+                rows = table.rows_where(
+                    "status = ?", ["pending"], select="id, key_hash"
+                )
+            for row in list(rows):
+                key = keys.get(row.get("key_hash"), default)
+                if key:
+                    self._spawn(row["id"], key, 0)
+        except Exception:
+            logger.exception("Could not resume pending generation stats lookups")
+
+    async def _lookup(self, generation_id, key, delay):
+        import httpx
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=30)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._write(generation_id, "pending", 0, key_hash=_key_hash(key))
+        with self._lock:
+            self._unsaved.pop(generation_id, None)
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            await asyncio.sleep(delay)
+            delay = min(self.initial_delay * 2**attempt, self.max_delay)
+            # Jitter keeps a burst of lookups from retrying in lockstep
+            delay *= random.uniform(0.5, 1)
+            async with self._semaphore:
+                try:
+                    response = await self._client.get(
+                        self.api_base + "/generation",
+                        params={"id": generation_id},
+                        headers={"Authorization": "Bearer {}".format(key)},
+                    )
+                except httpx.HTTPError as ex:
+                    error = repr(ex)
+                    continue
+            if response.status_code == 200:
+                stats = response.json()["data"]
+                self._write(generation_id, "done", attempt, stats=stats)
+                return
+            error = "HTTP {}: {}".format(response.status_code, response.text[:200])
+            if response.status_code not in (404, 408, 429) and (
+                response.status_code < 500
+            ):
+                break
+            try:
+                delay = max(delay, float(response.headers["retry-after"]))
+            except (KeyError, ValueError):
+                pass
+        self._write(generation_id, "failed", attempt, error=error)
+
+    def _flush(self):
+        "Save what the next process needs to resume, waiting only if asked to"
+        if self.exit_timeout:
+            try:
+                self.wait(timeout=self.exit_timeout)
+            except Exception:
+                pass
+        self._save_unsaved()
+
+    def _save_unsaved(self):
+        "Record lookups that never started, so a later process can retry them"
+        with self._lock:
+            unsaved = list(self._unsaved.items())
+        if not unsaved:
+            return
+        import sqlite_utils
+
+        try:
+            sqlite_utils.Database(self.db_path)["openrouter_generations"].insert_all(
+                [
+                    {
+                        "id": generation_id,
+                        "status": "pending",
+                        "attempts": 0,
+                        "key_hash": key_hash,
+                    }
+                    for generation_id, key_hash in unsaved
+                ],
+                pk="id",
+                ignore=True,
+                alter=True,
+            )
+        except Exception:
+            # Never let this stop the process from exiting
+            pass
+
+    def wait(self, timeout=None):
+        "Block until every lookup submitted so far has finished"
+        if self._loop is None:
+            return
+
+        async def wait_all():
+            while self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(wait_all(), self._loop).result(timeout)
+
+
+def get_generation_stats_collector():
+    """Return the collector enabled by ``OPENROUTER_GENERATION_STATS``, or None.
+
+    It writes to the LLM logs database.
+    """
+    if not os.environ.get("OPENROUTER_GENERATION_STATS"):
+        return None
+    from llm.cli import logs_db_path
+
+    return _generation_stats_collector(str(logs_db_path()), get_api_base())
+
+
+@cache
+def _generation_stats_collector(db_path, api_base):
+    return GenerationStatsCollector(db_path, api_base)
+
+
+def _key_hash(key):
+    "Identifies a key in the database without storing the key itself"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def idempotent(implementation):
+    """Mark a tool function as safe to run early, or without its result used.
+
+    With the ``speculative_tools`` option async models start these tools
+    while the rest of the response is still streaming.
+    """
+    implementation.idempotent = True
+    return implementation
+
+
+async def _call_tool(implementation, *args, **kwargs):
+    "Call a tool implementation, running plain functions in a worker thread"
+    if inspect.iscoroutinefunction(implementation):
+        return await implementation(*args, **kwargs)
+    result = await asyncio.to_thread(implementation, *args, **kwargs)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def _tool_wrapper(implementation, wrapper):
+    """Finish a ``wraps()`` wrapper around a tool implementation.
+
+    llm finds the Toolbox instance of a method through ``__self__``, and
+    ``_original`` lets the next prompt in a chain start from the unwrapped
+    implementation.
+    """
+    if hasattr(implementation, "__self__"):
+        wrapper.__self__ = implementation.__self__
+    wrapper._original = getattr(implementation, "_original", implementation)
+    return wrapper
+
+
+def _bounded_tool(implementation, name, limit, timeout):
+    """Wrap a tool implementation to run under ``limit`` with a timeout.
+
+    The wrapper is a coroutine function, so llm runs it concurrently with
+    the other calls of the same turn. Plain functions run in a worker
+    thread; one that times out is abandoned rather than interrupted.
+    """
+
+    @wraps(implementation)
+    async def bounded(*args, **kwargs):
+        async with limit:
+            try:
+                return await asyncio.wait_for(
+                    _call_tool(implementation, *args, **kwargs), timeout
+                )
+            except asyncio.TimeoutError:
+                raise TimeoutError(
+                    "Tool {} timed out after {} seconds".format(name, timeout)
+                ) from None
+
+    return _tool_wrapper(implementation, bounded)
+
+
+def _accepts_tool_call(implementation):
+    try:
+        return "llm_tool_call" in inspect.signature(implementation).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+class _SpeculativeTools:
+    """Start idempotent tools while the rest of a response streams.
+
+    ``observe()`` parses the arguments of each local tool call as they
+    stream and starts the tool as soon as they form a complete JSON object.
+    Once the response is done ``install()`` swaps in implementations that
+    await the started call with the same arguments, so llm still executes
+    and replays the calls in order. If the stream fails or is abandoned the
+    started calls are cancelled and their results discarded.
+    """
+
+    def __init__(self, tools):
+        self.tools = {
+            tool.name: tool
+            for tool in tools
+            if isinstance(tool, llm.Tool)
+            and getattr(tool.implementation, "idempotent", False)
+        }
+        self.parsers = {}
+        self.started = []
+
+    async def observe(self, events):
+        try:
+            async for event in events:
+                if event.tool_call_id and not event.server_executed:
+                    if event.type == "tool_call_name" and event.chunk in self.tools:
+                        self.parsers[event.tool_call_id] = (
+                            event.chunk,
+                            JSONStreamParser(),
+                        )
+                    elif (
+                        event.type == "tool_call_args"
+                        and event.tool_call_id in self.parsers
+                    ):
+                        self._feed(event.tool_call_id, event.chunk)
+                yield event
+        except BaseException:
+            self.discard()
+            raise
+
+    def _feed(self, tool_call_id, chunk):
+        name, parser = self.parsers[tool_call_id]
+        try:
+            parser.feed(chunk)
+        except SchemaViolation:
+            # Not JSON after all - llm reports that when it runs the call
+            del self.parsers[tool_call_id]
+            return
+        if parser.done:
+            del self.parsers[tool_call_id]
+            if isinstance(parser.value, dict):
+                self._start(tool_call_id, name, parser.value)
+
+    def _start(self, tool_call_id, name, arguments):
+        implementation = self.tools[name].implementation
+        kwargs = dict(arguments)
+        if _accepts_tool_call(implementation):
+            kwargs["llm_tool_call"] = llm.ToolCall(
+                name=name, arguments=arguments, tool_call_id=tool_call_id
+            )
+        task = asyncio.create_task(_call_tool(implementation, **kwargs))
+        # Retrieve the exception of a call whose result is never used
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        self.started.append((name, arguments, task))
+
+    def discard(self):
+        for _, _, task in self.started:
+            task.cancel()
+        self.started.clear()
+        self.parsers.clear()
+
+    def install(self, response):
+        if self.started:
+            response.prompt.tools = [
+                self._speculated(tool) if tool.name in self.tools else tool
+                for tool in response.prompt.tools
+            ]
+
+    def _speculated(self, tool):
+        implementation = tool.implementation
+        started = self.started
+
+        @wraps(implementation)
+        async def speculated(*args, **kwargs):
+            arguments = {k: v for k, v in kwargs.items() if k != "llm_tool_call"}
+            for index, (name, started_arguments, task) in enumerate(started):
+                if name == tool.name and started_arguments == arguments:
+                    del started[index]
+                    return await task
+            return await _call_tool(implementation, *args, **kwargs)
+
+        return dataclasses.replace(
+            tool, implementation=_tool_wrapper(implementation, speculated)
+        )
+
+
+class _mixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.Options = build_openrouter_options(self.Options)
+
+    def get_key(self, explicit_key=None):
+        if explicit_key is None and self.key is None:
+            pool = get_key_pool()
+            if pool is not None:
+                return pool.select()
+        return super().get_key(explicit_key)
+
+    def get_client(self, key, *, async_=False):
+        client = super().get_client(key, async_=async_)
+        if self.api_base and self.api_base.rstrip("/") == get_api_base():
+            serve_api_base = get_serve_api_base()
+            if serve_api_base:
+                client = client.with_options(base_url=serve_api_base)
+        if _http_observers():
+            client = client.with_options(http_client=_observed_http_client(async_))
+        return client
+
+    def _trace_request(self, prompt, stream, response):
+        """Trace a request in an ``openrouter.request`` span.
+
+        Yields a ``_RequestTrace``, or None when tracing is off.
+        """
+        tracer = get_tracer()
+        if tracer is None:
+            return nullcontext()
+        return self._request_trace(tracer, prompt, stream, response)
+
+    def _requested_provider(self, prompt):
+        provider = prompt.options.provider or {}
+        return ",".join(provider.get("order") or []) or None
+
+    @contextmanager
+    def _request_trace(self, tracer, prompt, stream, response):
+        span = tracer.start_span(
+            "openrouter.request",
+            {
+                "llm.model_id": self.model_id,
+                "openrouter.model": self.model_name,
+                "openrouter.stream": bool(stream),
+                # Replaced by the provider that answered, if OpenRouter says
+                "openrouter.provider": self._requested_provider(prompt),
+            },
+            _current_span.get(),
+        )
+        request_trace = _RequestTrace(tracer, span)
+        span_token = _current_span.set(span)
+        trace_token = _current_request_trace.set(request_trace)
+        error = None
+        try:
+            yield request_trace
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            _reset_context_var(_current_request_trace, trace_token)
+            _reset_context_var(_current_span, span_token)
+            request_trace.finish(response, error)
+
+    def _measure_request(self, prompt, response):
+        """Record a request in ``metrics``.
+
+        Yields a ``_RequestMetrics``, or None when metrics are off.
+        """
+        active = _active_metrics()
+        if active is None:
+            return nullcontext()
+        return self._request_metrics(active, prompt, response)
+
+    @contextmanager
+    def _request_metrics(self, active, prompt, response):
+        request_metrics = _RequestMetrics(
+            active, self.model_id, self._requested_provider(prompt)
+        )
+        token = _current_request_metrics.set(request_metrics)
+        error = None
+        try:
+            yield request_metrics
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            _reset_context_var(_current_request_metrics, token)
+            request_metrics.finish(response, error)
+
+    def _track_key(self, key):
+        pool = get_key_pool()
+        if pool is not None and key in pool:
+            return pool.track(key)
+        return nullcontext()
+
+    def _release_key(self, key):
+        "Give back a pool key selected for a request that will not be made"
+        pool = get_key_pool()
+        if pool is not None and key in pool:
+            pool.release(key)
+
+    @contextmanager
+    def _request_guard(self, key):
+        "Wait for host-wide limits, then track the request against its key"
+        limiter = get_host_limiter()
+        with limiter.acquire(key or "") if limiter else nullcontext():
+            with self._track_key(key):
+                yield
+
+    @asynccontextmanager
+    async def _async_request_guard(self, key):
+        limiter = get_host_limiter()
+        async with limiter.acquire_async(key or "") if limiter else nullcontext():
+            with self._track_key(key):
+                yield
+
+    def _check_circuit(self, response, key, providers=True):
+        """Fail fast if this model's circuit breaker is open.
+
+        Returns a ``_CircuitRequest`` to record the outcome with, or None
+        when circuit breakers are off. ``providers`` is false for requests
+        whose successful responses do not say which provider served them,
+        so their failures are not held against a provider either. If the
+        circuit is open the pool key selected for the request is released.
+        """
+        breaker = get_circuit_breaker()
+        if breaker is None:
+            return None
+        try:
+            probe, ignored = breaker.check(self.model_name)
+        except CircuitOpenError:
+            self._release_key(key)
+            raise
+        return _CircuitRequest(
+            breaker, self.model_name, probe, response, ignored, providers
+        )
+
+    async def _acheck_circuit(self, response, key, providers=True):
+        "Async version of ``_check_circuit`` that never blocks the event loop"
+        breaker = get_circuit_breaker()
+        if breaker is None:
+            return None
+        try:
+            probe, ignored = await asyncio.to_thread(breaker.check, self.model_name)
+        except CircuitOpenError:
+            self._release_key(key)
+            raise
+        return _CircuitRequest(
+            breaker, self.model_name, probe, response, ignored, providers
+        )
+
+    def _fallback_models(self, prompt):
+        """Validate fallback_models against the cached catalog.
+
+        Returns the value for OpenRouter's ``models`` parameter - this model
+        followed by its fallbacks - or None if no fallbacks were requested.
+        """
+        fallback_models = getattr(prompt.options, "fallback_models", None)
+        if not fallback_models:
+            return None
+        catalog = {model["id"]: model for model in get_openrouter_models()}
+        for model_id in fallback_models:
+            model_definition = catalog.get(model_id)
+            if model_definition is None:
+                raise ValueError(f"Unknown fallback model: {model_id}")
+            missing = get_missing_capabilities(model_definition, prompt)
+            if missing:
+                raise ValueError(
+                    "Fallback model {} does not support: {}".format(
+                        model_id, ", ".join(missing)
+                    )
+                )
+        return [self.model_name, *fallback_models]
+
+    def _record_resolved_model(self, prompt, response):
+        # With fallbacks OpenRouter reports whichever model actually answered
+        fallback_models = getattr(prompt.options, "fallback_models", None)
+        if not fallback_models:
+            return
+        resolved = (response.response_json or {}).get("model")
+        if not resolved:
+            return
+        model_names = (self.model_name, *fallback_models)
+        # It can name a dated version of the model, such as model-2024-08-06
+        if resolved not in model_names and _without_version(resolved) in model_names:
+            resolved = _without_version(resolved)
+        if resolved != self.model_name:
+            response.set_resolved_model("openrouter/{}".format(resolved))
+
+    def _checks_schema(self, prompt):
+        return bool(
+            prompt.schema
+            and (
+                getattr(prompt.options, "schema_abort", None)
+                or getattr(prompt.options, "schema_retries", None)
+            )
+        )
+
+    def _schema_checked(self, prompt, response, execute):
+        """Run ``execute()``, stopping as soon as its JSON breaks the schema.
+
+        With ``schema_retries`` the events of each attempt are held back
+        until its JSON is complete, so a broken attempt can be thrown away.
+        The usage of thrown away attempts is added to the response's.
+        """
+        if not self._checks_schema(prompt):
+            return execute()
+        return self._schema_checked_events(prompt, response, execute)
+
+    def _schema_checked_events(self, prompt, response, execute):
+        retries = prompt.options.schema_retries or 0
+        usage = _AbandonedUsage(response)
+        for attempt in range(retries + 1):
+            parser = JSONStreamParser(prompt.schema)
+            events = execute()
+            held = []
+            try:
+                for event in events:
+                    if event.type == "text":
+                        parser.feed(event.chunk)
+                    if retries:
+                        held.append(event)
+                    else:
+                        yield event
+                parser.close()
+            except SchemaViolation:
+                # Closing the stream drops the connection to OpenRouter
+                events.close()
+                if attempt == retries:
+                    usage.apply()
+                    raise
+                usage.abandon()
+                continue
+            usage.apply()
+            yield from held
+            return
+
+    def _aschema_checked(self, prompt, response, execute):
+        if not self._checks_schema(prompt):
+            return execute()
+        return self._aschema_checked_events(prompt, response, execute)
+
+    async def _aschema_checked_events(self, prompt, response, execute):
+        retries = prompt.options.schema_retries or 0
+        usage = _AbandonedUsage(response)
+        for attempt in range(retries + 1):
+            parser = JSONStreamParser(prompt.schema)
+            events = execute()
+            held = []
+            try:
+                async for event in events:
+                    if event.type == "text":
+                        parser.feed(event.chunk)
+                    if retries:
+                        held.append(event)
+                    else:
+                        yield event
+                parser.close()
+            except SchemaViolation:
+                await events.aclose()
+                if attempt == retries:
+                    usage.apply()
+                    raise
+                usage.abandon()
+                continue
+            usage.apply()
+            for event in held:
+                yield event
+            return
+
+    def _collect_generation_stats(self, response, key):
+        collector = get_generation_stats_collector()
+        if collector is None:
+            return
+        generation_id = (response.response_json or {}).get("id")
+        if generation_id:
+            collector.submit(generation_id, key)
+
+    def _prepare_tools(self, response):
+        """Set up the local tools of an async response before it streams.
+
+        Chains pass each prompt's tools on to the next, so tools wrapped for
+        an earlier response are unwrapped first. ``tool_concurrency`` and
+        ``tool_timeout`` are then applied with ``_bounded_tool``, sharing
+        one semaphore across the turn's calls. Returns a
+        ``_SpeculativeTools`` if ``speculative_tools`` is set and any tool
+        is idempotent.
+        """
+        options = response.prompt.options
+        concurrency = getattr(options, "tool_concurrency", None)
+        timeout = getattr(options, "tool_timeout", None)
+        limit = asyncio.Semaphore(concurrency) if concurrency else nullcontext()
+        tools = []
+        for tool in response.prompt.tools:
+            if isinstance(tool, llm.Tool) and tool.implementation:
+                implementation = getattr(
+                    tool.implementation, "_original", tool.implementation
+                )
+                if concurrency or timeout:
+                    implementation = _bounded_tool(
+                        implementation, tool.name, limit, timeout
+                    )
+                if implementation is not tool.implementation:
+                    tool = dataclasses.replace(tool, implementation=implementation)
+            tools.append(tool)
+        response.prompt.tools = tools
+        if getattr(options, "speculative_tools", None):
+            speculation = _SpeculativeTools(tools)
+            if speculation.tools:
+                return speculation
+        return None
+
+    def _checkout_shell_containers(self, prompt, key):
+        """Point ``Shell(reuse_container=True)`` tools at warm containers.
+
+        Returns the prompt to execute and the containers taken from the pool,
+        as a list of ``(pool_key, container_id, expires_at)`` tuples.
+        """
+        if not _reuses_containers(prompt):
+            return prompt, []
+        tools = list(prompt.tools or [])
+        pool = get_shell_container_pool()
+        checked_out = []
+        for index, tool in enumerate(tools):
+            if not getattr(tool, "reuse_container", False):
+                continue
+            pool_key = tool.pool_key(key)
+            container_id, expires_at = pool.checkout(pool_key) or (None, None)
+            checked_out.append((pool_key, container_id, expires_at))
+            if container_id is not None:
+                tools[index] = tool.with_container(container_id)
+        return _PromptToolsProxy(prompt, tools), checked_out
+
+    def _checkin_shell_containers(self, response, checked_out):
+        "Return containers to the pool, including new ones the response used"
+        if not checked_out:
+            return
+        pool = get_shell_container_pool()
+        used = []
+        for item in (response.response_json or {}).get("output") or []:
+            if item.get("type") in (
+                "shell_call",
+                "shell_call_output",
+                "openrouter:shell",
+            ):
+                container_id = _shell_container_id(item)
+                if container_id and container_id not in used:
+                    used.append(container_id)
+        # Containers started by this response, one for each tool that was
+        # not given a warm container, in order
+        reserved = {entry[1] for entry in checked_out}
+        started = [
+            container_id for container_id in used if container_id not in reserved
+        ]
+        for pool_key, container_id, expires_at in checked_out:
+            if container_id is None:
+                if not started:
+                    continue
+                container_id = started.pop(0)
+            elif container_id not in used:
+                # Not used by this response, so its idle timer was not reset
+                pool.checkin(pool_key, container_id, expires_at)
+                continue
+            ttl = json.loads(pool_key)[2]
+            if ttl is None:
+                ttl = SHELL_CONTAINER_TTL
+            pool.checkin(pool_key, container_id, time.time() + ttl)
+
+    @_traced("openrouter.build_kwargs")
+    def build_kwargs(self, prompt, stream):
+        kwargs = super().build_kwargs(prompt, stream)
+        kwargs.pop("provider", None)
+        kwargs.pop("reasoning_effort", None)
+        kwargs.pop("reasoning_max_tokens", None)
+        kwargs.pop("reasoning_enabled", None)
+        kwargs.pop("fallback_models", None)
+        kwargs.pop("coalesce", None)
+        kwargs.pop("image_max_edge", None)
+        kwargs.pop("schema_abort", None)
+        kwargs.pop("schema_retries", None)
+        kwargs.pop("tool_concurrency", None)
+        kwargs.pop("tool_timeout", None)
+        kwargs.pop("speculative_tools", None)
+        if not prompt.tools:
+            kwargs.pop("parallel_tool_calls", None)
+        extra_body = {}
+        if prompt.options.provider:
+            extra_body["provider"] = prompt.options.provider
+        models = self._fallback_models(prompt)
+        if models:
+            extra_body["models"] = models
+        reasoning = {}
+        if prompt.options.reasoning_effort:
+            reasoning["effort"] = prompt.options.reasoning_effort
+        if prompt.options.reasoning_max_tokens:
+            reasoning["max_tokens"] = prompt.options.reasoning_max_tokens
+        if prompt.options.reasoning_enabled is not None:
+            reasoning["enabled"] = prompt.options.reasoning_enabled
+        if reasoning:
+            extra_body["reasoning"] = reasoning
+        if extra_body:
+            kwargs["extra_body"] = extra_body
+        return kwargs
+
+    @_traced("openrouter.build_kwargs")
+    def _build_responses_kwargs(self, prompt, stream):
+        reasoning_effort = prompt.options.reasoning_effort
+        reasoning_summary = getattr(prompt.options, "reasoning_summary", None)
+        reasoning_max_tokens = prompt.options.reasoning_max_tokens
+        reasoning_enabled = prompt.options.reasoning_enabled
+        provider = prompt.options.provider
+
+        kwargs = super()._build_responses_kwargs(prompt, stream)
+        for key in (
+            "provider",
+            "reasoning_summary",
+            "reasoning_max_tokens",
+            "reasoning_enabled",
+            "fallback_models",
+            "coalesce",
+            "image_max_edge",
+            "schema_abort",
+            "schema_retries",
+            "tool_concurrency",
+            "tool_timeout",
+            "speculative_tools",
+        ):
+            kwargs.pop(key, None)
+        if not prompt.tools:
+            kwargs.pop("parallel_tool_calls", None)
+
+        unsupported = [
+            key
+            for key in ("stop", "logit_bias", "seed")
+            if kwargs.pop(key, None) is not None
+        ]
+        if unsupported:
+            raise ValueError(
+                "The OpenRouter Responses API does not support these options: {}".format(
+                    ", ".join(unsupported)
+                )
+            )
+
+        reasoning = dict(kwargs.get("reasoning") or {})
+        if reasoning_summary is None or getattr(prompt, "hide_reasoning", False):
+            reasoning.pop("summary", None)
+        else:
+            reasoning["summary"] = reasoning_summary
+        if reasoning_effort:
+            reasoning["effort"] = reasoning_effort
+        if reasoning_max_tokens is not None:
+            reasoning["max_tokens"] = reasoning_max_tokens
+        if reasoning_enabled is not None:
+            reasoning["enabled"] = reasoning_enabled
+        if reasoning:
+            kwargs["reasoning"] = reasoning
+        else:
+            kwargs.pop("reasoning", None)
+
+        extra_body = dict(kwargs.pop("extra_body", {}) or {})
+        for key in ("frequency_penalty", "presence_penalty"):
+            value = kwargs.pop(key, None)
+            if value is not None:
+                extra_body[key] = value
+        if provider:
+            extra_body["provider"] = provider
+        models = self._fallback_models(prompt)
+        if models:
+            extra_body["models"] = models
+        if extra_body:
+            kwargs["extra_body"] = extra_body
+        return kwargs
+
+    def _with_cached_attachments(self, prompt):
+        "Swap each attachment in the prompt for one using attachment_cache"
+        from llm.parts import AttachmentPart, Message
+
+        messages = prompt.messages
+        if not any(
+            isinstance(part, AttachmentPart) and part.attachment
+            for message in messages
+            for part in message.parts
+        ):
+            return prompt
+        image_max_edge = getattr(prompt.options, "image_max_edge", None)
+        return _PromptMessagesProxy(
+            prompt,
+            [
+                Message(
+                    role=message.role,
+                    parts=[
+                        (
+                            AttachmentPart(
+                                attachment=_cached_attachment(
+                                    part.attachment, image_max_edge
+                                ),
+                                provider_metadata=part.provider_metadata,
+                            )
+                            if isinstance(part, AttachmentPart) and part.attachment
+                            else part
+                        )
+                        for part in message.parts
+                    ],
+                    provider_metadata=message.provider_metadata,
+                )
+                for message in messages
+            ],
+        )
+
+    @_traced("openrouter.build_input")
+    def build_messages(self, prompt, conversation, image_detail=None):
+        return super().build_messages(
+            self._with_cached_attachments(prompt),
+            conversation,
+            image_detail=image_detail,
+        )
+
+    @_traced("openrouter.build_input")
+    def _build_responses_input(self, prompt, image_detail=None):
+        """Replay raw OpenRouter server-tool items in conversation history."""
+        from llm.parts import Message
+
+        prompt = self._with_cached_attachments(prompt)
+        base_builder = super()._build_responses_input
+        messages = prompt.messages
+        if not any(
+            _openrouter_response_item(part) is not None
+            for message in messages
+            for part in message.parts
+        ):
+            return base_builder(prompt, image_detail=image_detail)
+
+        items = []
+        instructions = None
+        response_item_indexes = {}
+
+        def append_ordinary_parts(message, parts):
+            # Delegate ordinary text, attachments and local tools back to LLM
+            # in segments so raw server-tool items retain their exact position.
+            nonlocal instructions
+            if not parts:
+                return
+            segment = Message(
+                role=message.role,
+                parts=parts,
+                provider_metadata=message.provider_metadata,
+            )
+            segment_items, segment_instructions = base_builder(
+                _PromptMessagesProxy(prompt, [segment]),
+                image_detail=image_detail,
+            )
+            items.extend(segment_items)
+            if segment_instructions is not None:
+                instructions = segment_instructions
+
+        for message in messages:
+            ordinary_parts = []
+            for part in message.parts:
+                response_item = _openrouter_response_item(part)
+                if response_item is None:
+                    ordinary_parts.append(part)
+                    continue
+                response_item = deepcopy(_response_item_dict(response_item))
+                response_item_key = _response_item_key(response_item)
+
+                if (
+                    response_item_key is not None
+                    and response_item_key in response_item_indexes
+                ):
+                    items[response_item_indexes[response_item_key]] = response_item
+                    continue
+
+                if ordinary_parts:
+                    append_ordinary_parts(message, ordinary_parts)
+                    ordinary_parts = []
+
+                if response_item_key is not None:
+                    response_item_indexes[response_item_key] = len(items)
+                items.append(response_item)
+
+            append_ordinary_parts(message, ordinary_parts)
+
+        return items, instructions
+
+    def _server_tool_events(self, item, message_index):
+        events = super()._server_tool_events(item, message_index)
+        if events:
+            response_item = _response_item_dict(item)
+            events[0].provider_metadata = {
+                **(events[0].provider_metadata or {}),
+                "openrouter": {"response_item": response_item},
+            }
+            return events
+
+        item_type = getattr(item, "type", None)
+        if item_type not in (
+            "openrouter:web_search",
+            "openrouter:web_fetch",
+            "openrouter:shell",
+            "shell_call",
+            "shell_call_output",
+        ):
+            return []
+        response_item = _response_item_dict(item)
+        if item_type == "shell_call":
+            call_id = response_item.get("call_id") or response_item.get("id")
+            return [
+                StreamEvent(
+                    type="tool_call_name",
+                    chunk="shell",
+                    tool_call_id=call_id,
                     server_executed=True,
                     provider_metadata={
                         "openrouter": {"response_item": response_item}
@@ -532,207 +3897,1951 @@ class _mixin:
                     },
                     message_index=message_index,
                 )
-            ]
-        if item_type == "openrouter:shell":
-            call_id = response_item.get("call_id") or response_item.get("id")
-            action = response_item.get("action") or {}
-            output = response_item.get("output")
-            result = (
-                json.dumps(output)
-                if output is not None
-                else (response_item.get("status") or "completed")
+            ]
+        if item_type == "openrouter:shell":
+            call_id = response_item.get("call_id") or response_item.get("id")
+            action = response_item.get("action") or {}
+            output = response_item.get("output")
+            result = (
+                json.dumps(output)
+                if output is not None
+                else (response_item.get("status") or "completed")
+            )
+            return [
+                StreamEvent(
+                    type="tool_call_name",
+                    chunk="shell",
+                    tool_call_id=call_id,
+                    server_executed=True,
+                    provider_metadata={
+                        "openrouter": {"response_item": response_item}
+                    },
+                    message_index=message_index,
+                ),
+                StreamEvent(
+                    type="tool_call_args",
+                    chunk=json.dumps(action),
+                    tool_call_id=call_id,
+                    server_executed=True,
+                    message_index=message_index,
+                ),
+                StreamEvent(
+                    type="tool_result",
+                    chunk=result,
+                    tool_call_id=call_id,
+                    server_executed=True,
+                    tool_name="shell",
+                    message_index=message_index,
+                ),
+            ]
+        if item_type == "openrouter:web_fetch":
+            item_id = response_item.get("id")
+            result = {
+                key: value
+                for key, value in response_item.items()
+                if key not in ("type", "id")
+            }
+            return [
+                StreamEvent(
+                    type="tool_call_name",
+                    chunk="web_fetch",
+                    tool_call_id=item_id,
+                    server_executed=True,
+                    provider_metadata={
+                        "openrouter": {"response_item": response_item}
+                    },
+                    message_index=message_index,
+                ),
+                StreamEvent(
+                    type="tool_call_args",
+                    chunk=json.dumps({"url": response_item.get("url")}),
+                    tool_call_id=item_id,
+                    server_executed=True,
+                    message_index=message_index,
+                ),
+                StreamEvent(
+                    type="tool_result",
+                    chunk=json.dumps(result),
+                    tool_call_id=item_id,
+                    server_executed=True,
+                    tool_name="web_fetch",
+                    message_index=message_index,
+                ),
+            ]
+        item_id = response_item.get("id")
+        action = response_item.get("action") or {}
+        return [
+            StreamEvent(
+                type="tool_call_name",
+                chunk="web_search",
+                tool_call_id=item_id,
+                server_executed=True,
+                provider_metadata={
+                    "openrouter": {"response_item": response_item}
+                },
+                message_index=message_index,
+            ),
+            StreamEvent(
+                type="tool_call_args",
+                chunk=json.dumps(action),
+                tool_call_id=item_id,
+                server_executed=True,
+                message_index=message_index,
+            ),
+            StreamEvent(
+                type="tool_result",
+                chunk=response_item.get("status") or "completed",
+                tool_call_id=item_id,
+                server_executed=True,
+                tool_name="web_search",
+                message_index=message_index,
+            ),
+        ]
+
+    def _refresh_server_tool_events(self, output, done_events):
+        super()._refresh_server_tool_events(output, done_events)
+        for item in output or []:
+            item_id = getattr(item, "id", None)
+            prior_events = done_events.get(item_id)
+            if not prior_events:
+                continue
+            response_item = _response_item_dict(item)
+            for event in prior_events:
+                provider_metadata = event.provider_metadata or {}
+                openrouter_metadata = provider_metadata.get("openrouter") or {}
+                if "response_item" in openrouter_metadata:
+                    openrouter_metadata["response_item"] = deepcopy(response_item)
+
+
+class OpenRouterChat(_mixin, Chat):
+    needs_key = "openrouter"
+    key_env_var = "OPENROUTER_KEY"
+
+    def execute(self, prompt, stream, response, conversation=None, key=None):
+        # Streamed chunks do not reach the response, so neither does the
+        # provider that served them
+        circuit = self._check_circuit(response, key, providers=not stream)
+        if circuit:
+            prompt = circuit.routed_prompt(prompt)
+        with (
+            self._trace_request(prompt, stream, response) as request_trace,
+            self._measure_request(prompt, response) as request_metrics,
+            self._request_guard(key),
+        ):
+            events = self._schema_checked(
+                prompt,
+                response,
+                partial(super().execute, prompt, stream, response, conversation, key),
+            )
+            if circuit:
+                events = circuit.observe(events)
+            if request_metrics:
+                events = request_metrics.observe(events)
+            yield from request_trace.observe(events) if request_trace else events
+        self._record_resolved_model(prompt, response)
+        self._collect_generation_stats(response, key)
+
+    def __str__(self):
+        return "OpenRouter: {}".format(self.model_id)
+
+
+class OpenRouterAsyncChat(_mixin, AsyncChat):
+    needs_key = "openrouter"
+    key_env_var = "OPENROUTER_KEY"
+
+    async def execute(self, prompt, stream, response, conversation=None, key=None):
+        speculation = self._prepare_tools(response)
+        circuit = await self._acheck_circuit(response, key, providers=not stream)
+        if circuit:
+            prompt = circuit.routed_prompt(prompt)
+        with (
+            self._trace_request(prompt, stream, response) as request_trace,
+            self._measure_request(prompt, response) as request_metrics,
+        ):
+            async with self._async_request_guard(key):
+                events = self._aschema_checked(
+                    prompt,
+                    response,
+                    partial(
+                        super().execute, prompt, stream, response, conversation, key
+                    ),
+                )
+                if circuit:
+                    events = circuit.aobserve(events)
+                if speculation:
+                    events = speculation.observe(events)
+                if request_metrics:
+                    events = request_metrics.aobserve(events)
+                if request_trace:
+                    events = request_trace.aobserve(events)
+                async for event in events:
+                    yield event
+        self._record_resolved_model(prompt, response)
+        self._collect_generation_stats(response, key)
+        if speculation:
+            speculation.install(response)
+
+    def __str__(self):
+        return "OpenRouter: {}".format(self.model_id)
+
+
+class OpenRouterResponses(_mixin, Responses):
+    needs_key = "openrouter"
+    key_env_var = "OPENROUTER_KEY"
+
+    @property
+    def supported_server_side_tools(self):
+        return (WebSearch, WebFetch, Shell, llm.ServerSideTool)
+
+    def execute(self, prompt, stream, response, conversation=None, key=None):
+        if getattr(prompt.options, "chat_completions", None):
+            if any(isinstance(tool, llm.ServerSideTool) for tool in prompt.tools):
+                raise ValueError(
+                    "Server-side tools cannot be used with chat_completions"
+                )
+            chat = OpenRouterChat(**self._delegate_chat_kwargs())
+            yield from chat.execute(prompt, stream, response, conversation, key)
+            return
+        circuit = self._check_circuit(response, key)
+        if circuit:
+            prompt = circuit.routed_prompt(prompt)
+        prompt, shell_containers = self._checkout_shell_containers(prompt, key)
+        try:
+            with (
+                self._trace_request(prompt, stream, response) as request_trace,
+                self._measure_request(prompt, response) as request_metrics,
+                self._request_guard(key),
+            ):
+                events = self._schema_checked(
+                    prompt,
+                    response,
+                    partial(
+                        super().execute, prompt, stream, response, conversation, key
+                    ),
+                )
+                if circuit:
+                    events = circuit.observe(events)
+                if request_metrics:
+                    events = request_metrics.observe(events)
+                yield from request_trace.observe(events) if request_trace else events
+        finally:
+            self._checkin_shell_containers(response, shell_containers)
+        self._record_resolved_model(prompt, response)
+        self._collect_generation_stats(response, key)
+
+    def __str__(self):
+        return "OpenRouter: {}".format(self.model_id)
+
+
+class OpenRouterAsyncResponses(_mixin, AsyncResponses):
+    needs_key = "openrouter"
+    key_env_var = "OPENROUTER_KEY"
+
+    @property
+    def supported_server_side_tools(self):
+        return (WebSearch, WebFetch, Shell, llm.ServerSideTool)
+
+    def get_client(self, key, *, async_=False):
+        client = super().get_client(key, async_=async_)
+        if async_:
+            # Requests given different keys from the same pool can still
+            # share a call, made with the key of the first of them
+            pool = get_key_pool()
+            source = pool if pool is not None and key in pool else key
+            # Coalesced requests are guarded here, once for each request made
+            client = _CoalescingClient(
+                client,
+                (source, str(client.base_url)),
+                partial(self._async_request_guard, key),
+                partial(self._release_key, key),
+            )
+        return client
+
+    def _finalize_responses_kwargs(self, prompt, stream, instructions=None):
+        kwargs = super()._finalize_responses_kwargs(prompt, stream, instructions)
+        if getattr(prompt.options, "coalesce", None):
+            # Consumed by _CoalescingResponses, never sent to OpenRouter
+            kwargs["_coalesce"] = True
+        return kwargs
+
+    async def execute(self, prompt, stream, response, conversation=None, key=None):
+        if getattr(prompt.options, "chat_completions", None):
+            if any(isinstance(tool, llm.ServerSideTool) for tool in prompt.tools):
+                raise ValueError(
+                    "Server-side tools cannot be used with chat_completions"
+                )
+            chat = OpenRouterAsyncChat(**self._delegate_chat_kwargs())
+            async for event in chat.execute(
+                prompt, stream, response, conversation, key
+            ):
+                yield event
+            return
+        speculation = self._prepare_tools(response)
+        circuit = await self._acheck_circuit(response, key)
+        if circuit:
+            prompt = circuit.routed_prompt(prompt)
+        shell_containers = []
+        if _reuses_containers(prompt):
+            # The pool's file lock is taken in a worker thread, off the event loop
+            prompt, shell_containers = await asyncio.to_thread(
+                self._checkout_shell_containers, prompt, key
+            )
+        try:
+            with (
+                self._trace_request(prompt, stream, response) as request_trace,
+                self._measure_request(prompt, response) as request_metrics,
+            ):
+                if getattr(prompt.options, "coalesce", None):
+                    # Guarded by _CoalescingResponses, for the shared request
+                    guard = nullcontext()
+                else:
+                    guard = self._async_request_guard(key)
+                async with guard:
+                    events = self._aschema_checked(
+                        prompt,
+                        response,
+                        partial(
+                            super().execute,
+                            prompt,
+                            stream,
+                            response,
+                            conversation,
+                            key,
+                        ),
+                    )
+                    if circuit:
+                        events = circuit.aobserve(events)
+                    if speculation:
+                        events = speculation.observe(events)
+                    if request_metrics:
+                        events = request_metrics.aobserve(events)
+                    if request_trace:
+                        events = request_trace.aobserve(events)
+                    async for event in events:
+                        yield event
+        finally:
+            if shell_containers:
+                await asyncio.to_thread(
+                    self._checkin_shell_containers, response, shell_containers
+                )
+        self._record_resolved_model(prompt, response)
+        self._collect_generation_stats(response, key)
+        if speculation:
+            speculation.install(response)
+
+    def __str__(self):
+        return "OpenRouter: {}".format(self.model_id)
+
+
+ROUTE_STRATEGIES = ("cheapest", "fastest")
+
+
+@cache
+def _router_options(base_options):
+    class Options(base_options):
+        route: Optional[Literal["cheapest", "fastest"]] = Field(
+            description=(
+                'How the local router picks a model: "cheapest" (the default) '
+                'or "fastest"'
+            ),
+            default=None,
+        )
+        route_models: Optional[Union[list, str]] = Field(
+            description=(
+                "Only route to these models - a JSON list or comma-separated "
+                "IDs, which can use * wildcards"
+            ),
+            default=None,
+        )
+        route_free: Optional[bool] = Field(
+            description="Allow routing to free models, which are rate limited",
+            default=None,
+        )
+
+        @field_validator("route_models")
+        def validate_route_models(cls, route_models):
+            return _model_id_list("route_models", route_models)
+
+    return Options
+
+
+@dataclasses.dataclass(frozen=True)
+class _RouterModel:
+    id: str
+    features: frozenset
+    context_length: int
+    # Per token, weighting input three to one against output
+    price: float
+    # Median seconds to the first token in logged generation stats
+    latency: Optional[float]
+
+
+def _router_model(model_definition, latencies):
+    "A catalog entry as a ``_RouterModel``, or None if it cannot be routed to"
+    if is_embedding_model(model_definition):
+        return None
+    pricing = model_definition.get("pricing") or {}
+    try:
+        prompt_price = float(pricing["prompt"])
+        completion_price = float(pricing["completion"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if prompt_price < 0 or completion_price < 0:
+        # Routers such as openrouter/auto have no price of their own
+        return None
+    architecture = model_definition.get("architecture") or {}
+    features = set(architecture.get("input_modalities") or ["text"])
+    features.update(
+        parameter
+        for parameter in ("tools", "structured_outputs")
+        if has_parameter(model_definition, parameter)
+    )
+    context_length = (model_definition.get("top_provider") or {}).get(
+        "context_length"
+    ) or model_definition.get("context_length")
+    return _RouterModel(
+        id=model_definition["id"],
+        features=frozenset(features),
+        context_length=context_length or 0,
+        price=(3 * prompt_price + completion_price) / 4,
+        latency=latencies.get(model_definition["id"]),
+    )
+
+
+def _logged_latencies():
+    "Median latency in seconds of each model, from ``openrouter_generations``"
+    from llm.cli import logs_db_path
+
+    path = logs_db_path()
+    if not path.exists():
+        return {}
+    import sqlite_utils
+
+    db = sqlite_utils.Database(path)
+    if not db["openrouter_generations"].exists():
+        return {}
+    latencies = {}
+    for row in db.query(
+        "select model, latency from openrouter_generations "
+        "where status = 'done' and latency is not null"
+    ):
+        latencies.setdefault(row["model"], []).append(row["latency"] / 1000)
+    return {model: _percentile(values, 50) for model, values in latencies.items()}
+
+
+class RouterIndex:
+    """Catalog models the local router can choose from.
+
+    Models able to handle each combination of needed features are sorted
+    by strategy the first time that combination is seen, so routing a
+    prompt is a dictionary lookup and a short scan for a large enough
+    context window.
+    """
+
+    def __init__(self, catalog, latencies=None):
+        latencies = latencies or {}
+        self.models = [
+            model
+            for model in (
+                _router_model(model_definition, latencies)
+                for model_definition in catalog
+            )
+            if model is not None
+        ]
+        self._groups = {}
+
+    def candidates(self, needs, strategy="cheapest", models=None, free=False):
+        "Models with every feature in ``needs``, best first"
+        group_key = (needs, strategy, models, free)
+        group = self._groups.get(group_key)
+        if group is None:
+            if strategy not in ROUTE_STRATEGIES:
+                raise ValueError("strategy must be cheapest or fastest")
+            group = [
+                model
+                for model in self.models
+                if needs <= model.features
+                and (free or model.price > 0)
+                and (
+                    models is None
+                    or any(fnmatch.fnmatchcase(model.id, pattern) for pattern in models)
+                )
+            ]
+            if strategy == "fastest":
+                # Models without latency stats go last, cheapest first
+                group.sort(
+                    key=lambda model: (
+                        model.latency is None,
+                        model.latency or 0,
+                        model.price,
+                    )
+                )
+            else:
+                group.sort(key=lambda model: model.price)
+            self._groups[group_key] = group
+        return group
+
+    def select(self, needs, tokens, strategy="cheapest", models=None, free=False):
+        """The best model for a prompt with these needs and estimated tokens.
+
+        Returns a ``(model, candidates)`` tuple, with ``model`` None if no
+        model qualifies.
+        """
+        candidates = self.candidates(needs, strategy, models, free)
+        for model in candidates:
+            if model.context_length >= tokens:
+                return model, len(candidates)
+        return None, len(candidates)
+
+
+# The index for each API base, with the version of the catalog cache file
+# it was built from - each caller gets its own copy of the catalog itself
+_router_indexes = {}
+
+
+def _catalog_version(api_base):
+    "The path, modification time and size of the cached catalog, or None"
+    _, path = _catalog_location(api_base)
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return (str(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _cached_router_index(api_base):
+    cached = _router_indexes.get(api_base)
+    if cached is not None and cached[0] is not None:
+        if cached[0] == _catalog_version(api_base):
+            return cached[1]
+    return None
+
+
+def get_router_index(catalog, api_base=None):
+    """The ``RouterIndex`` for the cached catalog of ``api_base``.
+
+    It is built once per catalog download, from ``catalog``.
+    """
+    api_base = api_base or get_api_base()
+    index = _cached_router_index(api_base)
+    if index is None:
+        index = RouterIndex(catalog, _logged_latencies())
+        _router_indexes[api_base] = (_catalog_version(api_base), index)
+    return index
+
+
+def _attachment_feature(attachment):
+    content_type = attachment.resolve_type() or ""
+    for feature in ("image", "audio", "video"):
+        if content_type.startswith(feature + "/"):
+            return feature
+    return "file"
+
+
+def prompt_needs(prompt):
+    """The features a prompt needs and its estimated size in tokens.
+
+    Features use the catalog's names: ``tools``, ``structured_outputs`` and
+    input modalities such as ``image``. Tokens are estimated at four
+    characters each, plus any ``max_tokens`` reserved for the output.
+    """
+    from llm.parts import AttachmentPart, ToolCallPart
+
+    needs = {"text"}
+    characters = 0
+    tools = [tool for tool in prompt.tools if isinstance(tool, llm.Tool)]
+    if tools:
+        needs.add("tools")
+        characters += sum(
+            len(json.dumps([tool.name, tool.description, tool.input_schema]))
+            for tool in tools
+        )
+    if prompt.schema:
+        needs.add("structured_outputs")
+        characters += len(json.dumps(prompt.schema))
+    for message in prompt.messages:
+        for part in message.parts:
+            if isinstance(part, AttachmentPart):
+                if part.attachment is not None:
+                    needs.add(_attachment_feature(part.attachment))
+            elif isinstance(part, ToolCallPart):
+                characters += len(json.dumps(part.arguments))
+            elif isinstance(part, ToolResultPart):
+                characters += len(str(part.output))
+            else:
+                characters += len(getattr(part, "text", None) or "")
+    tokens = characters // 4 + (getattr(prompt.options, "max_tokens", None) or 0)
+    return frozenset(needs), tokens
+
+
+class _PromptOptionsProxy:
+    def __init__(self, prompt, options):
+        self._prompt = prompt
+        self.options = options
+
+    def __getattr__(self, name):
+        return getattr(self._prompt, name)
+
+
+class _delegating_mixin:
+    "A model that runs each prompt with one or more catalog models"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._routed_models = {}
+
+    def _routed(self, model_name, prompt):
+        "The model to run a routed prompt with, and the prompt with its options"
+        routed = self._routed_models.get(model_name)
+        if routed is None:
+            routed = self.routed_class(
+                model_id="openrouter/{}".format(model_name),
+                model_name=model_name,
+                api_base=self.api_base,
+                headers=self.headers,
+                vision=True,
+                reasoning=True,
+                supports_schema=True,
+                supports_tools=True,
+            )
+            self._routed_models[model_name] = routed
+        options = routed.Options(
+            **{
+                name: value
+                for name, value in prompt.options
+                if name in routed.Options.model_fields
+            }
+        )
+        return routed, _PromptOptionsProxy(prompt, options)
+
+    def __str__(self):
+        return "OpenRouter: {}".format(self.model_id)
+
+
+class _router_mixin(_delegating_mixin):
+    """Pick a catalog model for each prompt, then run it with that model.
+
+    The choice is recorded as the response's resolved model and, with the
+    reasons for it, under ``local_router`` in its ``response_json``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.Options = _router_options(self.Options)
+
+    def _route(self, prompt, index):
+        options = prompt.options
+        strategy = options.route or "cheapest"
+        models = tuple(options.route_models) if options.route_models else None
+        needs, tokens = prompt_needs(prompt)
+        model, candidates = index.select(
+            needs, tokens, strategy, models, bool(options.route_free)
+        )
+        if model is None:
+            raise llm.ModelError(
+                "No model can handle this prompt: it needs {} and about {} "
+                "tokens of context".format(", ".join(sorted(needs)), tokens)
+            )
+        route = {
+            "model": model.id,
+            "strategy": strategy,
+            "needs": sorted(needs),
+            "estimated_tokens": tokens,
+            "candidates": candidates,
+            "context_length": model.context_length,
+            "price": model.price,
+            "latency": model.latency,
+        }
+        return model.id, route
+
+    def _record_route(self, response, route):
+        if response.resolved_model is None:
+            response.set_resolved_model("openrouter/{}".format(route["model"]))
+        response.response_json = dict(response.response_json or {})
+        response.response_json["local_router"] = route
+
+
+class OpenRouterLocalRouter(_router_mixin, OpenRouterResponses):
+    routed_class = OpenRouterResponses
+
+    def execute(self, prompt, stream, response, conversation=None, key=None):
+        api_base = self.api_base.rstrip("/")
+        index = get_router_index(get_openrouter_models(api_base=api_base), api_base)
+        model_name, route = self._route(prompt, index)
+        routed, prompt = self._routed(model_name, prompt)
+        yield from routed.execute(prompt, stream, response, conversation, key)
+        self._record_route(response, route)
+
+
+class OpenRouterAsyncLocalRouter(_router_mixin, OpenRouterAsyncResponses):
+    routed_class = OpenRouterAsyncResponses
+
+    async def execute(self, prompt, stream, response, conversation=None, key=None):
+        api_base = self.api_base.rstrip("/")
+        catalog = await aget_openrouter_models(api_base=api_base)
+        index = _cached_router_index(api_base)
+        if index is None:
+            # Reads latency stats from the logs database
+            index = await asyncio.to_thread(get_router_index, catalog, api_base)
+        model_name, route = self._route(prompt, index)
+        routed, prompt = self._routed(model_name, prompt)
+        async for event in routed.execute(prompt, stream, response, conversation, key):
+            yield event
+        self._record_route(response, route)
+
+
+# Replies that open like this are escalated by the cascade model as refusals
+REFUSAL_PATTERN = (
+    r"^\W*(?:I['’]m sorry|I am sorry|I apologi[sz]e|Sorry, (?:but )?I can"
+    r"|I can(?:no|['’])t (?:help|assist|comply|provide|do that)"
+    r"|I(?:['’]m| am) (?:not able|unable) to|As an AI)"
+)
+
+
+@cache
+def _cascade_options(base_options):
+    class Options(base_options):
+        cascade_models: Optional[Union[list, str]] = Field(
+            description=(
+                "Models to try in turn, cheapest first - a JSON list or "
+                "comma-separated IDs"
+            ),
+            default=None,
+        )
+        cascade_refusal: Optional[str] = Field(
+            description=(
+                "Regular expression matching refusals to escalate, or an "
+                "empty string to accept them"
+            ),
+            default=None,
+        )
+        cascade_validator: Optional[str] = Field(
+            description=(
+                "module:function called with the reply text and prompt - a "
+                "false result or ValueError escalates to the next model"
+            ),
+            default=None,
+        )
+
+        @field_validator("cascade_models")
+        def validate_cascade_models(cls, cascade_models):
+            return _model_id_list("cascade_models", cascade_models)
+
+        @field_validator("cascade_refusal")
+        def validate_cascade_refusal(cls, cascade_refusal):
+            if cascade_refusal:
+                try:
+                    re.compile(cascade_refusal)
+                except re.error as ex:
+                    raise ValueError("Invalid cascade_refusal pattern: {}".format(ex))
+            return cascade_refusal
+
+        @field_validator("cascade_validator")
+        def validate_cascade_validator(cls, cascade_validator):
+            if cascade_validator is not None and ":" not in cascade_validator:
+                raise ValueError("cascade_validator must look like module:function")
+            return cascade_validator
+
+    return Options
+
+
+@cache
+def _import_validator(path):
+    import importlib
+
+    module, _, name = path.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def _truncated(response_json):
+    "Whether a response stopped because it reached its output token limit"
+    details = response_json.get("incomplete_details") or {}
+    finish_reasons = [response_json.get("finish_reason")] + [
+        choice.get("finish_reason") for choice in response_json.get("choices") or []
+    ]
+    return details.get("reason") == "max_output_tokens" or "length" in finish_reasons
+
+
+def _validator_failure(result):
+    return None if result else "validator"
+
+
+class _cascade_mixin(_delegating_mixin):
+    """Send each prompt to the ``cascade_models`` in turn until one passes.
+
+    A reply fails if it was cut short by its token limit, breaks the
+    prompt's schema, matches the refusal pattern or is rejected by
+    ``cascade_validator``. A model that errors fails too. Replies are held
+    back until they pass, except from the last model, whose reply streams
+    straight through. Every attempt is recorded under ``cascade`` in the
+    response's ``response_json``, and the response's usage and cost add up
+    all of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.Options = _cascade_options(self.Options)
+
+    def _cascade_models(self, prompt):
+        models = prompt.options.cascade_models
+        if not models:
+            raise ValueError(
+                "openrouter/cascade needs the models to try, for example "
+                "-o cascade_models 'openai/gpt-5-nano,openai/gpt-5'"
+            )
+        return models
+
+    def _failed_check(self, prompt, events, response):
+        "Why a reply should be escalated, or None if it passes the built-in checks"
+        if _truncated(response.response_json or {}):
+            return "truncated"
+        if any(event.type.startswith("tool_call") for event in events):
+            # Tool calls are checked by running them
+            return None
+        text = "".join(event.chunk for event in events if event.type == "text")
+        if prompt.schema:
+            parser = JSONStreamParser(prompt.schema)
+            try:
+                parser.feed(text)
+                parser.close()
+            except SchemaViolation as ex:
+                return "schema: {}".format(ex)
+        pattern = prompt.options.cascade_refusal
+        if pattern is None:
+            pattern = REFUSAL_PATTERN
+        if pattern and re.search(pattern, text, re.IGNORECASE):
+            return "refusal"
+        return None
+
+    def _validator(self, prompt, events):
+        "The validator to call for this reply, with its arguments"
+        path = prompt.options.cascade_validator
+        if not path or any(event.type.startswith("tool_call") for event in events):
+            return None
+        text = "".join(event.chunk for event in events if event.type == "text")
+        return partial(_import_validator(path), text, prompt)
+
+    def _check(self, prompt, events, response):
+        "Why a reply should be escalated, or None if it passes"
+        reason = self._failed_check(prompt, events, response)
+        validator = self._validator(prompt, events)
+        if reason is not None or validator is None:
+            return reason
+        try:
+            return _validator_failure(validator())
+        except ValueError as ex:
+            return "validator: {}".format(ex)
+
+    async def _acheck(self, prompt, events, response):
+        reason = self._failed_check(prompt, events, response)
+        validator = self._validator(prompt, events)
+        if reason is not None or validator is None:
+            return reason
+        try:
+            result = validator()
+            if inspect.isawaitable(result):
+                result = await result
+            return _validator_failure(result)
+        except ValueError as ex:
+            return "validator: {}".format(ex)
+
+    def _attempt(self, model_name, start, response, reason):
+        usage = (response.response_json or {}).get("usage") or {}
+        return {
+            "model": model_name,
+            "passed": reason is None,
+            "reason": reason,
+            "latency": round(time.monotonic() - start, 3),
+            "input_tokens": response.input_tokens,
+            "output_tokens": response.output_tokens,
+            "cost": usage.get("cost"),
+        }
+
+    def _reset(self, response, usage):
+        "Set a failed attempt aside, keeping its usage, before the next model runs"
+        usage.abandon()
+        response.resolved_model = None
+
+    def _record_cascade(self, response, model_name, attempts):
+        if response.resolved_model is None:
+            response.set_resolved_model("openrouter/{}".format(model_name))
+        response.response_json = dict(response.response_json or {})
+        response.response_json["cascade"] = attempts
+
+
+class OpenRouterCascade(_cascade_mixin, OpenRouterResponses):
+    routed_class = OpenRouterResponses
+
+    def execute(self, prompt, stream, response, conversation=None, key=None):
+        models = self._cascade_models(prompt)
+        attempts = []
+        usage = _AbandonedUsage(response)
+        for level, model_name in enumerate(models):
+            last = level == len(models) - 1
+            routed, routed_prompt = self._routed(model_name, prompt)
+            start = time.monotonic()
+            events = []
+            try:
+                for event in routed.execute(
+                    routed_prompt, stream, response, conversation, key
+                ):
+                    events.append(event)
+                    if last:
+                        yield event
+            except Exception as ex:
+                if last:
+                    usage.apply()
+                    raise
+                reason = "error: {}".format(ex)
+            else:
+                reason = self._check(prompt, events, response)
+            attempts.append(self._attempt(model_name, start, response, reason))
+            if reason is None or last:
+                break
+            self._reset(response, usage)
+        if not last:
+            yield from events
+        usage.apply()
+        self._record_cascade(response, model_name, attempts)
+
+
+class OpenRouterAsyncCascade(_cascade_mixin, OpenRouterAsyncResponses):
+    routed_class = OpenRouterAsyncResponses
+
+    async def execute(self, prompt, stream, response, conversation=None, key=None):
+        models = self._cascade_models(prompt)
+        attempts = []
+        usage = _AbandonedUsage(response)
+        for level, model_name in enumerate(models):
+            last = level == len(models) - 1
+            routed, routed_prompt = self._routed(model_name, prompt)
+            start = time.monotonic()
+            events = []
+            try:
+                async for event in routed.execute(
+                    routed_prompt, stream, response, conversation, key
+                ):
+                    events.append(event)
+                    if last:
+                        yield event
+            except Exception as ex:
+                if last:
+                    usage.apply()
+                    raise
+                reason = "error: {}".format(ex)
+            else:
+                reason = await self._acheck(prompt, events, response)
+            attempts.append(self._attempt(model_name, start, response, reason))
+            if reason is None or last:
+                break
+            self._reset(response, usage)
+        if not last:
+            for event in events:
+                yield event
+        usage.apply()
+        self._record_cascade(response, model_name, attempts)
+
+
+def _embedding_batches(items, max_items, max_tokens):
+    """Pack items into consecutive request batches.
+
+    Each batch is as large as it can be while holding at most ``max_items``
+    items and roughly ``max_tokens`` tokens, estimated at four characters
+    per token. An item over the token budget gets a batch of its own.
+    """
+    batch, tokens = [], 0
+    for item in items:
+        estimate = len(item) // 4 + 1
+        if batch and (len(batch) >= max_items or tokens + estimate > max_tokens):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(item)
+        tokens += estimate
+    if batch:
+        yield batch
+
+
+class OpenRouterEmbedding(llm.EmbeddingModel):
+    """An OpenRouter embedding model.
+
+    ``embed_batch`` packs items into request batches of up to
+    ``request_items`` items and ``request_tokens`` estimated tokens, and
+    keeps up to ``concurrency`` of those requests in flight at once.
+    Embeddings are returned in the same order as the items.
+    """
+
+    needs_key = "openrouter"
+    key_env_var = "OPENROUTER_KEY"
+    # llm hands embed_batch() every item, so requests can be packed and
+    # pipelined across the whole input
+    batch_size = None
+
+    def __init__(
+        self,
+        model_id,
+        model_name,
+        *,
+        api_base=None,
+        headers=None,
+        request_items=256,
+        request_tokens=100_000,
+        concurrency=None,
+    ):
+        self.model_id = model_id
+        self.model_name = model_name
+        self.api_base = api_base or get_api_base()
+        self.headers = headers
+        self.request_items = request_items
+        self.request_tokens = request_tokens
+        if concurrency is None:
+            concurrency = int(os.environ.get("OPENROUTER_EMBED_CONCURRENCY") or 4)
+        self.concurrency = concurrency
+
+    def get_key(self, explicit_key=None):
+        if explicit_key is None and self.key is None:
+            pool = get_key_pool()
+            if pool is not None:
+                # Only decides whether to pool, as each request selects again
+                return pool.select(reserve=False)
+        return super().get_key(explicit_key)
+
+    # Requests are rate limited and tracked against their key like prompts
+    _track_key = _mixin._track_key
+    _request_guard = _mixin._request_guard
+
+    def get_client(self, key):
+        import openai
+
+        api_base = self.api_base
+        if api_base.rstrip("/") == get_api_base():
+            api_base = get_serve_api_base() or api_base
+        return openai.OpenAI(
+            api_key=key, base_url=api_base, default_headers=self.headers
+        )
+
+    def embed_batch(self, items, *, key=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        client = self.get_client(key)
+        pool = get_key_pool()
+        # Keys from the pool are chosen again for each request
+        pooled = pool is not None and self.key is None and key in pool
+        batches = _embedding_batches(items, self.request_items, self.request_tokens)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            pending = deque()
+            try:
+                for batch in batches:
+                    if len(pending) >= self.concurrency:
+                        yield from pending.popleft().result()
+                    request_key = pool.select() if pooled else key
+                    pending.append(
+                        executor.submit(self._embed, client, batch, request_key)
+                    )
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _embed(self, client, batch, key):
+        if key != client.api_key:
+            client = client.with_options(api_key=key)
+        with self._request_guard(key):
+            response = client.embeddings.create(
+                model=self.model_name, input=batch, encoding_format="float"
+            )
+        data = sorted(response.data, key=lambda item: item.index)
+        if len(data) != len(batch):
+            raise llm.ModelError(
+                "Expected {} embeddings, got {}".format(len(batch), len(data))
+            )
+        return [item.embedding for item in data]
+
+    def __str__(self):
+        return "OpenRouter: {}".format(self.model_id)
+
+
+def _get_async_model(model):
+    if not isinstance(model, str):
+        return model
+    try:
+        return llm.get_async_model(model)
+    except llm.UnknownModelError:
+        if model.startswith("openrouter/"):
+            raise
+        return llm.get_async_model("openrouter/" + model)
+
+
+class FanoutError(llm.ModelError):
+    "Every model of a ``fanout(first=True)`` failed"
+
+    def __init__(self, errors):
+        super().__init__(
+            "Every model failed: {}".format(
+                "; ".join(
+                    "{}: {}".format(model.model_id, error) for model, error in errors
+                )
             )
-            return [
-                StreamEvent(
-                    type="tool_call_name",
-                    chunk="shell",
-                    tool_call_id=call_id,
-                    server_executed=True,
-                    provider_metadata={
-                        "openrouter": {"response_item": response_item}
-                    },
-                    message_index=message_index,
-                ),
-                StreamEvent(
-                    type="tool_call_args",
-                    chunk=json.dumps(action),
-                    tool_call_id=call_id,
-                    server_executed=True,
-                    message_index=message_index,
+        )
+        # (model, exception) pairs, in the order the models were given
+        self.errors = errors
+
+
+async def fanout(prompt, models, *, first=False, on_chunk=None, **kwargs):
+    """Run one prompt concurrently against several OpenRouter models.
+
+    ``models`` can be model IDs or async model instances. Extra keyword
+    arguments are passed to each ``model.prompt()`` call and ``on_chunk`` is
+    called with ``(model, chunk)`` as text arrives from any model.
+
+    Returns a list with one completed AsyncResponse per model, in the order
+    the models were given - a model that failed has its exception in place
+    of a response. With ``first=True`` the list holds just the first
+    response to finish successfully and the others are cancelled. If every
+    model fails it raises ``FanoutError``.
+    """
+    models = [_get_async_model(model) for model in models]
+
+    async def run(model):
+        response = model.prompt(prompt, **kwargs)
+        async for chunk in response:
+            if on_chunk is not None:
+                on_chunk(model, chunk)
+        return response
+
+    tasks = [asyncio.create_task(run(model)) for model in models]
+    if not first:
+        return list(await asyncio.gather(*tasks, return_exceptions=True))
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                return [await next_done]
+            except Exception:
+                pass
+        raise FanoutError(
+            [(model, task.exception()) for model, task in zip(models, tasks)]
+        )
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+BENCH_PROMPTS = (
+    "Write a haiku about a pelican.",
+    "Explain what a hash table is in two sentences.",
+    "List five unusual uses for a paperclip.",
+)
+
+
+def _percentile(values, percent):
+    "Linearly interpolated percentile of some numbers, or None if there are none"
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _pinned_provider(routing, provider):
+    """Provider routing that sends requests to ``provider`` alone.
+
+    Other preferences from the ``provider`` option in ``routing`` are kept,
+    but ones choosing providers of their own are rejected.
+    """
+    if isinstance(routing, str):
+        try:
+            routing = json.loads(routing)
+        except json.JSONDecodeError:
+            raise ValueError("Invalid JSON in provider string")
+    routing = dict(routing or {})
+    conflicting = [name for name in ("order", "only") if name in routing]
+    if conflicting:
+        raise ValueError(
+            "The provider option cannot set {} when benchmarking "
+            "providers".format(" or ".join(conflicting))
+        )
+    routing.update(order=[provider], allow_fallbacks=False)
+    return routing
+
+
+async def bench(
+    models,
+    prompts=BENCH_PROMPTS,
+    *,
+    iterations=1,
+    concurrency=4,
+    providers=(None,),
+    options=None,
+    **kwargs,
+):
+    """Time prompts against models, optionally pinned to specific providers.
+
+    Every prompt runs ``iterations`` times for each model and provider, with
+    at most ``concurrency`` requests at once. Returns a dictionary for each
+    run with its ``model`` and ``provider``, ``ttft`` and ``latency`` in
+    seconds, token counts and the ``cost`` OpenRouter reported - or the
+    ``error`` that it failed with.
+
+    A ``provider`` in ``options`` is combined with each pinned provider. It
+    raises ``ValueError`` if it sets an ``order`` or ``only`` of its own.
+    """
+    models = [_get_async_model(model) for model in models]
+    semaphore = asyncio.Semaphore(concurrency)
+    options = dict(options or {})
+    routing = {
+        provider: _pinned_provider(options.get("provider"), provider)
+        for provider in providers
+        if provider
+    }
+
+    async def run(model, provider, prompt):
+        record = {"model": model.model_id, "provider": provider, "error": None}
+        run_options = dict(options)
+        if provider:
+            run_options["provider"] = routing[provider]
+        async with semaphore:
+            first_token = None
+            start = time.perf_counter()
+            try:
+                response = model.prompt(prompt, options=run_options, **kwargs)
+                async for chunk in response:
+                    if first_token is None and chunk:
+                        first_token = time.perf_counter()
+                end = time.perf_counter()
+                usage = await response.usage()
+            except Exception as ex:
+                record["error"] = str(ex) or type(ex).__name__
+                return record
+        first_token = first_token or end
+        output_tokens = usage.output or 0
+        record.update(
+            ttft=first_token - start,
+            latency=end - start,
+            input_tokens=usage.input or 0,
+            output_tokens=output_tokens,
+            # The first token arrived at first_token, so it is not counted
+            tokens_per_second=(
+                (output_tokens - 1) / (end - first_token)
+                if end > first_token and output_tokens > 1
+                else None
+            ),
+            cost=((response.response_json or {}).get("usage") or {}).get("cost"),
+        )
+        return record
+
+    return await asyncio.gather(
+        *(
+            run(model, provider, prompt)
+            for model in models
+            for provider in providers
+            for prompt in prompts
+            for _ in range(iterations)
+        )
+    )
+
+
+def summarize_bench(records, pricing=None):
+    """Summarize bench() results for each model and provider.
+
+    ``pricing`` maps model IDs to OpenRouter catalog pricing, used to
+    estimate the cost of runs that did not report one.
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault((record["model"], record["provider"]), []).append(record)
+    summaries = []
+    for (model_id, provider), runs in groups.items():
+        succeeded = [run for run in runs if run["error"] is None]
+        ttfts = [run["ttft"] for run in succeeded]
+        latencies = [run["latency"] for run in succeeded]
+        speeds = [
+            run["tokens_per_second"]
+            for run in succeeded
+            if run["tokens_per_second"] is not None
+        ]
+        model_pricing = (pricing or {}).get(model_id.removeprefix("openrouter/"))
+        cost = 0.0
+        for run in succeeded:
+            if run["cost"] is not None:
+                cost += run["cost"]
+            elif model_pricing:
+                cost += run["input_tokens"] * float(
+                    model_pricing.get("prompt") or 0
+                ) + run["output_tokens"] * float(model_pricing.get("completion") or 0)
+        output_tokens = sum(run["output_tokens"] for run in succeeded)
+        summaries.append(
+            {
+                "model": model_id,
+                "provider": provider,
+                "runs": len(runs),
+                "errors": len(runs) - len(succeeded),
+                "error_rate": (len(runs) - len(succeeded)) / len(runs),
+                "ttft_p50": _percentile(ttfts, 50),
+                "ttft_p95": _percentile(ttfts, 95),
+                "tokens_per_second": _percentile(speeds, 50),
+                "latency_p50": _percentile(latencies, 50),
+                "latency_p90": _percentile(latencies, 90),
+                "latency_p99": _percentile(latencies, 99),
+                "cost_per_1k_output_tokens": (
+                    cost / output_tokens * 1000 if output_tokens else None
                 ),
-                StreamEvent(
-                    type="tool_result",
-                    chunk=result,
-                    tool_call_id=call_id,
-                    server_executed=True,
-                    tool_name="shell",
-                    message_index=message_index,
+                "error_messages": sorted(
+                    {run["error"] for run in runs if run["error"] is not None}
                 ),
-            ]
-        if item_type == "openrouter:web_fetch":
-            item_id = response_item.get("id")
-            result = {
-                key: value
-                for key, value in response_item.items()
-                if key not in ("type", "id")
             }
-            return [
-                StreamEvent(
-                    type="tool_call_name",
-                    chunk="web_fetch",
-                    tool_call_id=item_id,
-                    server_executed=True,
-                    provider_metadata={
-                        "openrouter": {"response_item": response_item}
-                    },
-                    message_index=message_index,
+        )
+    return summaries
+
+
+def logged_prompts(
+    db, *, models=(), since=None, before=None, conversations=(), limit=None
+):
+    """Yield prompts from an llm logs database, oldest first.
+
+    Rows are read from SQLite one at a time, optionally filtered by the
+    ``models`` they were logged for, by ``conversations`` and by
+    ``since``/``before`` UTC timestamps. Each prompt is a dictionary with the
+    ``response_id``, ``model`` and ``conversation_id`` it was logged with,
+    the ``text`` of its final user message, ``prompt`` keyword arguments
+    that rebuild it - earlier turns of its conversation included - and its
+    logged ``options``. The logged ``response`` text, ``latency``, token
+    counts and ``cost`` are included for comparison.
+
+    Prompts logged by versions of llm before 0.32, which only exist in the
+    ``responses`` table, come first.
+    """
+    where, params = [], []
+    if models:
+        marks = ", ".join("?" for _ in models)
+        where.append("(model in ({0}) or resolved_model in ({0}))".format(marks))
+        params.extend([*models, *models])
+    if conversations:
+        where.append(
+            "{{conversation}} in ({})".format(", ".join("?" for _ in conversations))
+        )
+        params.extend(conversations)
+    if since:
+        where.append("datetime_utc >= ?")
+        params.append(since.replace(" ", "T"))
+    if before:
+        where.append("datetime_utc < ?")
+        params.append(before.replace(" ", "T"))
+    prompts = itertools.chain(
+        _legacy_logged_prompts(db, where, params),
+        _turn_logged_prompts(db, where, params),
+    )
+    return itertools.islice(prompts, limit)
+
+
+def _logged_prompt(row, conversation_id, text, prompt, response, response_json):
+    return {
+        "response_id": row["id"],
+        "model": row["model"],
+        "conversation_id": conversation_id,
+        "text": text,
+        "prompt": prompt,
+        "options": json.loads(row["options_json"] or "{}"),
+        "response": response,
+        "latency": (
+            row["duration_ms"] / 1000 if row["duration_ms"] is not None else None
+        ),
+        "input_tokens": row["input_tokens"],
+        "output_tokens": row["output_tokens"],
+        "cost": ((response_json or {}).get("usage") or {}).get("cost"),
+    }
+
+
+def _logged_schema(db, schema_id):
+    if schema_id:
+        return json.loads(db["schemas"].get(schema_id)["content"])
+    return None
+
+
+def _message_text(message):
+    return "".join(part.text for part in message.parts if isinstance(part, TextPart))
+
+
+def _turn_logged_prompts(db, where, params):
+    from llm.logs import LogStore
+
+    if not db["turns"].exists():
+        return
+    store = LogStore(db)
+    sql = _logged_sql("turns", where).format(conversation="thread_id")
+    for row in db.query(sql, params):
+        messages = store.load_chain(row["parent_message_hash"])
+        if (
+            not messages
+            or messages[-1].role != "user"
+            or any(isinstance(part, ToolResultPart) for part in messages[-1].parts)
+        ):
+            # Turns that sent tool results cannot be replayed without the tools
+            continue
+        output = store.load_chain(row["tip_message_hash"])[len(messages) :]
+        yield _logged_prompt(
+            row,
+            conversation_id=row["thread_id"],
+            text=_message_text(messages[-1]),
+            prompt={
+                "messages": messages,
+                "schema": _logged_schema(db, row["schema_id"]),
+            },
+            response="".join(
+                _message_text(message)
+                for message in output
+                if message.role == "assistant"
+            ),
+            response_json=store.turn_response_json(row["id"]),
+        )
+
+
+def _logged_sql(table, where):
+    return "select * from {}{} order by datetime_utc, id".format(
+        table, " where " + " and ".join(where) if where else ""
+    )
+
+
+def _legacy_logged_prompts(db, where, params):
+    from llm.models import FRAGMENT_SQL
+
+    if not db["responses"].exists():
+        return
+    if db["turns"].exists():
+        # Everything logged since llm 0.32 is a turn
+        where = ["id not in (select id from turns)", *where]
+    sql = _logged_sql("responses", where).format(conversation="conversation_id")
+    for row in db.query(sql, params):
+        fragments = list(db.query(FRAGMENT_SQL, {"response_id": row["id"]}))
+        prompt_fragments = [
+            fragment["content"]
+            for fragment in fragments
+            if fragment["fragment_type"] == "prompt"
+        ]
+        attachments = [
+            llm.Attachment.from_row(attachment)
+            for attachment in db.query(
+                """
+                select attachments.* from attachments
+                join prompt_attachments
+                on attachments.id = prompt_attachments.attachment_id
+                where prompt_attachments.response_id = ?
+                order by prompt_attachments."order"
+                """,
+                [row["id"]],
+            )
+        ]
+        if not (row["prompt"] or prompt_fragments or attachments):
+            # Responses that sent tool results cannot be replayed without the tools
+            continue
+        messages = []
+        if row["conversation_id"]:
+            for turn in db.query(
+                """
+                select prompt, response from responses
+                where conversation_id = ? and datetime_utc < ?
+                order by datetime_utc, id
+                """,
+                [row["conversation_id"], row["datetime_utc"]],
+            ):
+                if turn["prompt"]:
+                    messages.append(
+                        Message(role="user", parts=[TextPart(turn["prompt"])])
+                    )
+                if turn["response"]:
+                    messages.append(
+                        Message(role="assistant", parts=[TextPart(turn["response"])])
+                    )
+        prompt = {
+            "prompt": row["prompt"],
+            "system": row["system"],
+            "fragments": prompt_fragments,
+            "system_fragments": [
+                fragment["content"]
+                for fragment in fragments
+                if fragment["fragment_type"] == "system"
+            ],
+            "attachments": attachments,
+            "schema": _logged_schema(db, row["schema_id"]),
+        }
+        if messages:
+            # Alongside messages llm ignores the system prompt, so it leads them
+            system = "\n".join(
+                [*prompt.pop("system_fragments"), prompt.pop("system") or ""]
+            ).strip()
+            if system:
+                messages.insert(0, Message(role="system", parts=[TextPart(system)]))
+            prompt["messages"] = messages
+        yield _logged_prompt(
+            row,
+            conversation_id=row["conversation_id"],
+            text=row["prompt"] or "",
+            prompt=prompt,
+            response=row["response"],
+            response_json=json.loads(row["response_json"] or "null"),
+        )
+
+
+async def replay(prompts, models, *, concurrency=4, options=None, key=None):
+    """Re-run logged prompts against models, yielding a record for each run.
+
+    ``prompts`` is an iterable such as ``logged_prompts()``. It is consumed
+    lazily, so only the prompts in flight are held in memory, with at most
+    ``concurrency`` requests at once. Each prompt keeps the logged options
+    its target model supports, with ``options`` applied on top.
+
+    Records are yielded as runs finish. Each pairs the logged response -
+    the ``original_`` keys - with the replayed ``response``, ``ttft``,
+    ``latency``, token counts and ``cost``, or the ``error`` it failed with.
+    """
+    models = [_get_async_model(model) for model in models]
+
+    async def run(logged, model):
+        record = {
+            "response_id": logged["response_id"],
+            "conversation_id": logged["conversation_id"],
+            "prompt": logged["text"],
+            "original_model": logged["model"],
+            "model": model.model_id,
+            "original_response": logged["response"],
+            "response": None,
+            "error": None,
+            "original_latency": logged["latency"],
+            "ttft": None,
+            "latency": None,
+            "original_input_tokens": logged["input_tokens"],
+            "original_output_tokens": logged["output_tokens"],
+            "input_tokens": None,
+            "output_tokens": None,
+            "original_cost": logged["cost"],
+            "cost": None,
+        }
+        run_options = {
+            name: value
+            for name, value in logged["options"].items()
+            if name in model.Options.model_fields
+        }
+        run_options.update(options or {})
+        first_token = None
+        start = time.perf_counter()
+        try:
+            response = model.prompt(**logged["prompt"], options=run_options, key=key)
+            async for chunk in response:
+                if first_token is None and chunk:
+                    first_token = time.perf_counter()
+            end = time.perf_counter()
+            usage = await response.usage()
+            record["response"] = await response.text()
+        except Exception as ex:
+            record["error"] = str(ex) or type(ex).__name__
+            return record
+        record.update(
+            ttft=(first_token or end) - start,
+            latency=end - start,
+            input_tokens=usage.input or 0,
+            output_tokens=usage.output or 0,
+            cost=_response_cost(response),
+        )
+        return record
+
+    pending = set()
+    try:
+        for logged in prompts:
+            for model in models:
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        yield task.result()
+                pending.add(asyncio.create_task(run(logged, model)))
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def summarize_replay(records):
+    """Compare replayed runs with their logged responses for each model.
+
+    Latency and cost are compared over the runs that succeeded, with costs
+    only summed for runs where both the logged and replayed cost are known.
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(record["model"], []).append(record)
+    summaries = []
+    for model_id, runs in groups.items():
+        succeeded = [run for run in runs if run["error"] is None]
+        costed = [
+            run
+            for run in succeeded
+            if run["cost"] is not None and run["original_cost"] is not None
+        ]
+        summaries.append(
+            {
+                "model": model_id,
+                "runs": len(runs),
+                "errors": len(runs) - len(succeeded),
+                "error_rate": (len(runs) - len(succeeded)) / len(runs),
+                "ttft_p50": _percentile([run["ttft"] for run in succeeded], 50),
+                "latency_p50": _percentile([run["latency"] for run in succeeded], 50),
+                "original_latency_p50": _percentile(
+                    [
+                        run["original_latency"]
+                        for run in succeeded
+                        if run["original_latency"] is not None
+                    ],
+                    50,
                 ),
-                StreamEvent(
-                    type="tool_call_args",
-                    chunk=json.dumps({"url": response_item.get("url")}),
-                    tool_call_id=item_id,
-                    server_executed=True,
-                    message_index=message_index,
+                "output_tokens": sum(run["output_tokens"] for run in succeeded),
+                "original_output_tokens": sum(
+                    run["original_output_tokens"] or 0 for run in succeeded
                 ),
-                StreamEvent(
-                    type="tool_result",
-                    chunk=json.dumps(result),
-                    tool_call_id=item_id,
-                    server_executed=True,
-                    tool_name="web_fetch",
-                    message_index=message_index,
+                "cost": sum(run["cost"] for run in costed) if costed else None,
+                "original_cost": (
+                    sum(run["original_cost"] for run in costed) if costed else None
                 ),
-            ]
-        item_id = response_item.get("id")
-        action = response_item.get("action") or {}
-        return [
-            StreamEvent(
-                type="tool_call_name",
-                chunk="web_search",
-                tool_call_id=item_id,
-                server_executed=True,
-                provider_metadata={
-                    "openrouter": {"response_item": response_item}
-                },
-                message_index=message_index,
-            ),
-            StreamEvent(
-                type="tool_call_args",
-                chunk=json.dumps(action),
-                tool_call_id=item_id,
-                server_executed=True,
-                message_index=message_index,
-            ),
-            StreamEvent(
-                type="tool_result",
-                chunk=response_item.get("status") or "completed",
-                tool_call_id=item_id,
-                server_executed=True,
-                tool_name="web_search",
-                message_index=message_index,
-            ),
-        ]
+                "error_messages": sorted(
+                    {run["error"] for run in runs if run["error"] is not None}
+                ),
+            }
+        )
+    return summaries
+
+
+def logged_cascades(db, *, since=None, before=None):
+    """Yield the attempts made for each ``openrouter/cascade`` prompt.
+
+    Prompts are read from the ``turns`` of an llm logs database, oldest
+    first, optionally limited to ``since``/``before`` UTC timestamps. Each
+    is the list of attempt dictionaries recorded under ``cascade`` in its
+    response JSON.
+    """
+    from llm.logs import LogStore
+
+    if not db["turns"].exists():
+        return
+    where, params = ["model = ?"], ["openrouter/cascade"]
+    if since:
+        where.append("datetime_utc >= ?")
+        params.append(since.replace(" ", "T"))
+    if before:
+        where.append("datetime_utc < ?")
+        params.append(before.replace(" ", "T"))
+    store = LogStore(db)
+    for row in db.query(_logged_sql("turns", where), params):
+        cascade = (store.turn_response_json(row["id"]) or {}).get("cascade")
+        if cascade:
+            yield cascade
+
 
-    def _refresh_server_tool_events(self, output, done_events):
-        super()._refresh_server_tool_events(output, done_events)
-        for item in output or []:
-            item_id = getattr(item, "id", None)
-            prior_events = done_events.get(item_id)
-            if not prior_events:
-                continue
-            response_item = _response_item_dict(item)
-            for event in prior_events:
-                provider_metadata = event.provider_metadata or {}
-                openrouter_metadata = provider_metadata.get("openrouter") or {}
-                if "response_item" in openrouter_metadata:
-                    openrouter_metadata["response_item"] = deepcopy(response_item)
+def summarize_cascade(cascades):
+    """Summarize cascade attempts overall and for each model.
 
+    ``answered`` counts the prompts whose reply came from a model, and
+    ``failures`` counts why its replies were escalated - ``truncated``,
+    ``schema``, ``refusal``, ``validator`` or ``error``. Costs are summed
+    over the attempts where OpenRouter reported one.
+    """
+    cascades = list(cascades)
+    models = {}
+    for attempts in cascades:
+        for position, attempt in enumerate(attempts):
+            summary = models.setdefault(
+                attempt["model"],
+                {
+                    "model": attempt["model"],
+                    "attempts": 0,
+                    "passed": 0,
+                    "answered": 0,
+                    "failures": {},
+                    "latencies": [],
+                    "cost": None,
+                },
+            )
+            summary["attempts"] += 1
+            summary["passed"] += attempt["passed"]
+            summary["answered"] += position == len(attempts) - 1
+            if attempt["reason"]:
+                kind = attempt["reason"].split(":")[0]
+                summary["failures"][kind] = summary["failures"].get(kind, 0) + 1
+            summary["latencies"].append(attempt["latency"])
+            if attempt["cost"] is not None:
+                summary["cost"] = (summary["cost"] or 0) + attempt["cost"]
+    for summary in models.values():
+        summary["latency_p50"] = _percentile(summary.pop("latencies"), 50)
+    costs = [
+        attempt["cost"]
+        for attempts in cascades
+        for attempt in attempts
+        if attempt["cost"] is not None
+    ]
+    return {
+        "prompts": len(cascades),
+        "attempts": sum(len(attempts) for attempts in cascades),
+        "escalated": sum(len(attempts) > 1 for attempts in cascades),
+        "unresolved": sum(not attempts[-1]["passed"] for attempts in cascades),
+        "latency_p50": _percentile(
+            [sum(attempt["latency"] for attempt in attempts) for attempts in cascades],
+            50,
+        ),
+        "cost": sum(costs) if costs else None,
+        "models": list(models.values()),
+    }
 
-class OpenRouterChat(_mixin, Chat):
-    needs_key = "openrouter"
-    key_env_var = "OPENROUTER_KEY"
 
-    def __str__(self):
-        return "OpenRouter: {}".format(self.model_id)
+# Headers that apply to a single connection and are not forwarded
+_HOP_BY_HOP_HEADERS = frozenset(
+    {
+        "connection",
+        "content-length",
+        "host",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    }
+)
 
 
-class OpenRouterAsyncChat(_mixin, AsyncChat):
-    needs_key = "openrouter"
-    key_env_var = "OPENROUTER_KEY"
+class ServeProxy:
+    """Local OpenAI-compatible proxy used by ``llm openrouter serve``.
 
-    def __str__(self):
-        return "OpenRouter: {}".format(self.model_id)
+    Requests are forwarded to ``upstream`` over a pool of kept-alive
+    connections, using HTTP/2 if the ``h2`` package is installed. The model
+    catalog is held in memory and refreshed every ``refresh_interval``
+    seconds, which also keeps the plugin's catalog cache file up to date.
+    """
 
+    def __init__(
+        self, upstream=None, host="127.0.0.1", port=0, *, refresh_interval=1800
+    ):
+        from http.server import ThreadingHTTPServer
+        from importlib.util import find_spec
 
-class OpenRouterResponses(_mixin, Responses):
-    needs_key = "openrouter"
-    key_env_var = "OPENROUTER_KEY"
+        import httpx
+
+        self.upstream = (upstream or get_api_base()).rstrip("/")
+        self.refresh_interval = refresh_interval
+        self.client = httpx.Client(
+            http2=find_spec("h2") is not None,
+            timeout=httpx.Timeout(600, connect=10),
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300),
+        )
+        self.catalog = None
+        self._stopped = threading.Event()
+        self.server = ThreadingHTTPServer((host, port), _serve_handler_class())
+        self.server.daemon_threads = True
+        self.server.proxy = self
 
     @property
-    def supported_server_side_tools(self):
-        return (WebSearch, WebFetch, Shell, llm.ServerSideTool)
+    def api_base(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/api/v1".format(host, port)
 
-    def execute(self, prompt, stream, response, conversation=None, key=None):
-        if getattr(prompt.options, "chat_completions", None):
-            if any(isinstance(tool, llm.ServerSideTool) for tool in prompt.tools):
-                raise ValueError(
-                    "Server-side tools cannot be used with chat_completions"
-                )
-            chat = OpenRouterChat(**self._delegate_chat_kwargs())
-            yield from chat.execute(prompt, stream, response, conversation, key)
-            return
-        yield from super().execute(prompt, stream, response, conversation, key)
+    def refresh_catalog(self, skip_cache=False):
+        models = get_openrouter_models(skip_cache=skip_cache, api_base=self.upstream)
+        self.catalog = json.dumps({"data": models}).encode("utf-8")
 
-    def __str__(self):
-        return "OpenRouter: {}".format(self.model_id)
+    def _refresh_loop(self):
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.refresh_catalog(skip_cache=True)
+            except Exception:
+                # Keep serving the catalog we already have
+                pass
 
+    def serve_forever(self, poll_interval=0.5):
+        if self.catalog is None:
+            self.refresh_catalog()
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+        self.server.serve_forever(poll_interval)
 
-class OpenRouterAsyncResponses(_mixin, AsyncResponses):
-    needs_key = "openrouter"
-    key_env_var = "OPENROUTER_KEY"
+    def shutdown(self):
+        self._stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.client.close()
 
-    @property
-    def supported_server_side_tools(self):
-        return (WebSearch, WebFetch, Shell, llm.ServerSideTool)
 
-    async def execute(self, prompt, stream, response, conversation=None, key=None):
-        if getattr(prompt.options, "chat_completions", None):
-            if any(isinstance(tool, llm.ServerSideTool) for tool in prompt.tools):
-                raise ValueError(
-                    "Server-side tools cannot be used with chat_completions"
+def _serve_handler_class():
+    from http.server import BaseHTTPRequestHandler
+
+    import httpx
+
+    class _ServeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            proxy = self.server.proxy
+            if self.path.split("?")[0] == "/api/v1/models" and proxy.catalog:
+                self._send(200, {"Content-Type": "application/json"}, proxy.catalog)
+            else:
+                self._forward(None)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                try:
+                    data = json.loads(body)
+                except ValueError:
+                    data = None
+                # Accept the model IDs used with llm -m from other clients
+                if isinstance(data, dict) and str(data.get("model", "")).startswith(
+                    "openrouter/"
+                ):
+                    data["model"] = data["model"].removeprefix("openrouter/")
+                    body = json.dumps(data).encode("utf-8")
+            self._forward(body)
+
+        def _forward(self, body):
+            proxy = self.server.proxy
+            path = self.path.removeprefix("/api/v1")
+            headers = {
+                name: value
+                for name, value in self.headers.items()
+                if name.lower() not in _HOP_BY_HOP_HEADERS
+            }
+            try:
+                request = proxy.client.build_request(
+                    self.command, proxy.upstream + path, headers=headers, content=body
                 )
-            chat = OpenRouterAsyncChat(**self._delegate_chat_kwargs())
-            async for event in chat.execute(
-                prompt, stream, response, conversation, key
-            ):
-                yield event
-            return
-        async for event in super().execute(
-            prompt, stream, response, conversation, key
-        ):
-            yield event
+                upstream = proxy.client.send(request, stream=True)
+            except httpx.HTTPError as ex:
+                self._send(
+                    502,
+                    {"Content-Type": "application/json"},
+                    json.dumps({"error": {"message": str(ex), "code": 502}}).encode(),
+                )
+                return
+            try:
+                response_headers = {
+                    name: value
+                    for name, value in upstream.headers.items()
+                    if name.lower() not in _HOP_BY_HOP_HEADERS
+                }
+                if upstream.headers.get("content-type", "").startswith(
+                    "text/event-stream"
+                ):
+                    self._stream(upstream.status_code, response_headers, upstream)
+                else:
+                    # Still encoded as upstream sent it, matching its headers
+                    self._send(
+                        upstream.status_code,
+                        response_headers,
+                        b"".join(upstream.iter_raw()),
+                    )
+            finally:
+                upstream.close()
 
-    def __str__(self):
-        return "OpenRouter: {}".format(self.model_id)
+        def _send(self, status, headers, content):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def _stream(self, status, headers, upstream):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in upstream.iter_raw():
+                if chunk:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return _ServeHandler
+
+
+def _serve_state_path():
+    return llm.user_dir() / "openrouter-serve.json"
+
+
+# Seconds before checking again that a running proxy's process is alive
+SERVE_CHECK_INTERVAL = 5.0
+
+_serve_api_bases = {}
+
+
+def get_serve_api_base():
+    """The URL of a running ``llm openrouter serve`` proxy, if there is one
+    forwarding requests to the current API base.
+
+    Set ``OPENROUTER_SERVE=0`` to stop models from using a running proxy.
+    The answer is cached until the proxy's state file changes, for at most
+    ``SERVE_CHECK_INTERVAL`` seconds.
+    """
+    if os.environ.get("OPENROUTER_SERVE") == "0":
+        return None
+    path = _serve_state_path()
+    try:
+        modified = path.stat().st_mtime_ns
+    except OSError:
+        return None
+    cache_key = (str(path), modified, get_api_base())
+    cached = _serve_api_bases.get(cache_key)
+    if cached and time.monotonic() - cached[0] < SERVE_CHECK_INTERVAL:
+        return cached[1]
+    api_base = _read_serve_api_base(path, cache_key[2])
+    _serve_api_bases.clear()
+    _serve_api_bases[cache_key] = (time.monotonic(), api_base)
+    return api_base
+
+
+def _read_serve_api_base(path, upstream):
+    try:
+        state = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    if state.get("upstream") != upstream:
+        return None
+    if sys.platform != "win32":
+        try:
+            os.kill(state["pid"], 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+    return state["api_base"]
 
 
 @llm.hookimpl
 def register_models(register):
     # Only do this if the openrouter key is set
     key = llm.get_key("", "openrouter", "OPENROUTER_KEY")
-    if not key:
+    if not key and get_key_pool() is None:
         return
-    for model_definition in get_openrouter_models():
-        supports_images = get_supports_images(model_definition)
+    for model in _model_summaries():
+        if model["embedding"]:
+            continue
         kwargs = dict(
-            model_id="openrouter/{}".format(model_definition["id"]),
-            model_name=model_definition["id"],
-            vision=supports_images,
-            reasoning=has_parameter(model_definition, "reasoning"),
-            verbosity=has_parameter(model_definition, "verbosity"),
-            supports_schema=has_parameter(model_definition, "structured_outputs"),
-            supports_tools=has_parameter(model_definition, "tools"),
-            api_base="https://openrouter.ai/api/v1",
+            model_id="openrouter/{}".format(model["id"]),
+            model_name=model["id"],
+            vision=model["vision"],
+            reasoning=model["reasoning"],
+            verbosity=model["verbosity"],
+            supports_schema=model["supports_schema"],
+            supports_tools=model["supports_tools"],
+            api_base=get_api_base(),
             headers={
                 "HTTP-Referer": "https://llm.datasette.io/",
                 "X-OpenRouter-Title": "LLM",
@@ -742,12 +5851,95 @@ def register_models(register):
             OpenRouterResponses(**kwargs),
             OpenRouterAsyncResponses(**kwargs),
         )
+    router_kwargs = dict(
+        model_id="openrouter/local-router",
+        model_name="local-router",
+        vision=True,
+        reasoning=True,
+        supports_schema=True,
+        supports_tools=True,
+        api_base=get_api_base(),
+        headers={
+            "HTTP-Referer": "https://llm.datasette.io/",
+            "X-OpenRouter-Title": "LLM",
+        },
+    )
+    register(
+        OpenRouterLocalRouter(**router_kwargs),
+        OpenRouterAsyncLocalRouter(**router_kwargs),
+    )
+    cascade_kwargs = dict(router_kwargs, model_id="openrouter/cascade")
+    cascade_kwargs["model_name"] = "cascade"
+    register(
+        OpenRouterCascade(**cascade_kwargs),
+        OpenRouterAsyncCascade(**cascade_kwargs),
+    )
+
+
+@llm.hookimpl
+def register_embedding_models(register):
+    key = llm.get_key("", "openrouter", "OPENROUTER_KEY")
+    if not key and get_key_pool() is None:
+        return
+    for model in _model_summaries():
+        if model["embedding"]:
+            register(
+                OpenRouterEmbedding(
+                    model_id="openrouter/{}".format(model["id"]),
+                    model_name=model["id"],
+                    api_base=get_api_base(),
+                    headers={
+                        "HTTP-Referer": "https://llm.datasette.io/",
+                        "X-OpenRouter-Title": "LLM",
+                    },
+                )
+            )
 
 
 class DownloadError(Exception):
     pass
 
 
+# Parsed JSON from cache files, by path, with their modification time and
+# size. It is kept pickled so that every caller gets a copy of its own to
+# change - unpickling is quicker than parsing the JSON again or deepcopy()
+_cached_json = {}
+
+
+def _loaded_cached_json(path, stat):
+    "JSON this process already parsed from path, if the file is unchanged"
+    import pickle
+
+    cached = _cached_json.get(str(path))
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return pickle.loads(cached[1])
+    return None
+
+
+def _load_cached_json(path, stat):
+    import pickle
+
+    data = _loaded_cached_json(path, stat)
+    if data is None:
+        with open(path, "r") as file:
+            data = json.load(file)
+        _cached_json[str(path)] = (
+            (stat.st_mtime_ns, stat.st_size),
+            pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+        )
+    return data
+
+
+def _read_json(path):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def _write_json(path, data):
+    with open(path, "w") as file:
+        json.dump(data, file)
+
+
 def fetch_cached_json(url, path, cache_timeout):
     path = Path(path)
 
@@ -756,12 +5948,14 @@ def fetch_cached_json(url, path, cache_timeout):
 
     if path.is_file():
         # Get the file's modification time
-        mod_time = path.stat().st_mtime
+        stat = path.stat()
+        mod_time = stat.st_mtime
         # Check if it's more than the cache_timeout old
         if time.time() - mod_time < cache_timeout:
-            # If not, load the file
-            with open(path, "r") as file:
-                return json.load(file)
+            # If not, load the file - unless this process already has
+            return _load_cached_json(path, stat)
+
+    import httpx
 
     # Try to download the data
     try:
@@ -769,15 +5963,13 @@ def fetch_cached_json(url, path, cache_timeout):
         response.raise_for_status()  # This will raise an HTTPError if the request fails
 
         # If successful, write to the file
-        with open(path, "w") as file:
-            json.dump(response.json(), file)
+        _write_json(path, response.json())
 
         return response.json()
     except httpx.HTTPError:
         # If there's an existing file, load it
         if path.is_file():
-            with open(path, "r") as file:
-                return json.load(file)
+            return _read_json(path)
         else:
             # If not, raise an error
             raise DownloadError(
@@ -785,6 +5977,70 @@ def fetch_cached_json(url, path, cache_timeout):
             )
 
 
+# In-progress afetch_cached_json calls, so concurrent callers share them
+_json_fetches = {}
+
+
+async def afetch_cached_json(url, path, cache_timeout):
+    """Async version of ``fetch_cached_json``.
+
+    Files are read and written in a worker thread and downloads use
+    ``httpx.AsyncClient``. Concurrent calls for the same file on one event
+    loop share a single read or download.
+    """
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except OSError:
+        stat = None
+    if stat is not None and time.time() - stat.st_mtime < cache_timeout:
+        data = _loaded_cached_json(path, stat)
+        if data is not None:
+            return data
+    key = (str(path), url, cache_timeout, asyncio.get_running_loop())
+    task = _json_fetches.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_afetch_pickled_json(url, path, cache_timeout))
+        _json_fetches[key] = task
+        task.add_done_callback(lambda _: _json_fetches.pop(key, None))
+    import pickle
+
+    # A cancelled caller must not cancel the fetch the others are waiting on
+    return pickle.loads(await asyncio.shield(task))
+
+
+async def _afetch_pickled_json(url, path, cache_timeout):
+    "Pickled, so that callers sharing the fetch each get their own copy"
+    import pickle
+
+    data = await _afetch_cached_json(url, path, cache_timeout)
+    return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+
+async def _afetch_cached_json(url, path, cache_timeout):
+    await asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+    if path.is_file():
+        stat = path.stat()
+        if time.time() - stat.st_mtime < cache_timeout:
+            return await asyncio.to_thread(_load_cached_json, path, stat)
+
+    import httpx
+
+    try:
+        async with httpx.AsyncClient(follow_redirects=True) as client:
+            response = await client.get(url)
+        response.raise_for_status()
+        data = response.json()
+        await asyncio.to_thread(_write_json, path, data)
+        return data
+    except httpx.HTTPError:
+        if path.is_file():
+            return await asyncio.to_thread(_read_json, path)
+        raise DownloadError(
+            f"Failed to download data and no cache is available at {path}"
+        )
+
+
 @llm.hookimpl
 def register_commands(cli):
     @cli.group()
@@ -854,16 +6110,630 @@ def register_commands(cli):
 
     @openrouter.command()
     @click.option("--key", help="Key to inspect")
-    def key(key):
+    @click.option(
+        "all_", "--all", is_flag=True, help="Inspect every key in the key pool"
+    )
+    def key(key, all_):
         "View information and rate limits for the current key"
+        if all_:
+            pool = get_key_pool()
+            if pool is None:
+                raise click.ClickException(
+                    "No key pool configured - set OPENROUTER_KEYS or "
+                    "'llm keys set openrouter_keys'"
+                )
+            click.echo(json.dumps(asyncio.run(_inspect_keys(pool.keys)), indent=2))
+            return
+        import httpx
+
         key = llm.get_key(key, "openrouter", "OPENROUTER_KEY")
         response = httpx.get(
-            "https://openrouter.ai/api/v1/auth/key",
+            get_api_base() + "/auth/key",
             headers={"Authorization": f"Bearer {key}"},
         )
         response.raise_for_status()
         click.echo(json.dumps(response.json()["data"], indent=2))
 
+    @openrouter.command(name="bench")
+    @click.option(
+        "model_ids",
+        "-m",
+        "--model",
+        multiple=True,
+        required=True,
+        help="Model to benchmark, can be used multiple times",
+    )
+    @click.option(
+        "prompts",
+        "-p",
+        "--prompt",
+        multiple=True,
+        help="Prompt to run, can be used multiple times - defaults to a built-in set",
+    )
+    @click.option(
+        "-n",
+        "--iterations",
+        type=click.IntRange(min=1),
+        default=3,
+        show_default=True,
+        help="Number of times to run each prompt",
+    )
+    @click.option(
+        "-c",
+        "--concurrency",
+        type=click.IntRange(min=1),
+        default=4,
+        show_default=True,
+        help="Maximum number of requests to run at once",
+    )
+    @click.option(
+        "providers",
+        "--provider",
+        multiple=True,
+        help="Pin requests to this provider, can be used multiple times",
+    )
+    @click.option("-s", "--system", help="System prompt to use")
+    @click.option(
+        "options",
+        "-o",
+        "--option",
+        type=(str, str),
+        multiple=True,
+        help="key/value options for every model",
+    )
+    @click.option("json_", "--json", is_flag=True, help="Output as JSON")
+    @click.option("--key", help="API key to use")
+    def bench_(
+        model_ids,
+        prompts,
+        iterations,
+        concurrency,
+        providers,
+        system,
+        options,
+        json_,
+        key,
+    ):
+        """
+        Compare latency, throughput and cost across models and providers
+
+        Runs each prompt several times against every model and reports time to
+        first token, output tokens per second, latency percentiles, error rates
+        and cost per thousand output tokens. Responses are not logged.
+
+        Example:
+
+        \b
+            llm openrouter bench -m openai/gpt-4o-mini \\
+              -m meta-llama/llama-3.3-70b-instruct \\
+              --provider groq --provider together
+        """
+        try:
+            models = [_get_async_model(model_id) for model_id in model_ids]
+        except llm.UnknownModelError as ex:
+            raise click.ClickException(str(ex))
+        try:
+            records = asyncio.run(
+                bench(
+                    models,
+                    prompts or BENCH_PROMPTS,
+                    iterations=iterations,
+                    concurrency=concurrency,
+                    providers=providers or (None,),
+                    options=dict(options),
+                    system=system,
+                    key=key,
+                )
+            )
+        except ValueError as ex:
+            raise click.ClickException(str(ex))
+        pricing = {model["id"]: model["pricing"] for model in get_openrouter_models()}
+        summaries = summarize_bench(records, pricing)
+        if json_:
+            click.echo(json.dumps(summaries, indent=2))
+        else:
+            click.echo(_format_bench_table(summaries))
+
+    @openrouter.command(name="replay")
+    @click.argument("output", type=click.File("w"))
+    @click.option(
+        "model_ids",
+        "-m",
+        "--model",
+        multiple=True,
+        required=True,
+        help="Model to replay prompts against, can be used multiple times",
+    )
+    @click.option(
+        "source_models",
+        "--source",
+        multiple=True,
+        help="Only replay prompts logged for this model, can be used multiple times",
+    )
+    @click.option(
+        "conversations",
+        "--cid",
+        "--conversation",
+        multiple=True,
+        help="Only replay prompts from this conversation, can be used multiple times",
+    )
+    @click.option(
+        "--since", help="Only replay prompts logged at or after this UTC time"
+    )
+    @click.option("--before", help="Only replay prompts logged before this UTC time")
+    @click.option(
+        "-n",
+        "--limit",
+        type=click.IntRange(min=1),
+        help="Replay at most this many logged prompts",
+    )
+    @click.option(
+        "-c",
+        "--concurrency",
+        type=click.IntRange(min=1),
+        default=4,
+        show_default=True,
+        help="Maximum number of requests to run at once",
+    )
+    @click.option(
+        "options",
+        "-o",
+        "--option",
+        type=(str, str),
+        multiple=True,
+        help="key/value options for every model, replacing logged options",
+    )
+    @click.option(
+        "-d",
+        "--database",
+        type=click.Path(readable=True, exists=True, dir_okay=False),
+        help="Path to log database",
+    )
+    @click.option("json_", "--json", is_flag=True, help="Output the summary as JSON")
+    @click.option("--key", help="API key to use")
+    def replay_(
+        output,
+        model_ids,
+        source_models,
+        conversations,
+        since,
+        before,
+        limit,
+        concurrency,
+        options,
+        database,
+        json_,
+        key,
+    ):
+        """
+        Re-run logged prompts against other models and compare the results
+
+        Selected prompts are rebuilt from the logs database - with their
+        attachments, options and earlier conversation turns - and run
+        against every model. Each pair of logged and replayed responses is
+        written to OUTPUT as a line of JSON, then a comparison of latency
+        and cost is shown for each model. Replayed responses are not logged.
+
+        Example:
+
+        \b
+            llm openrouter replay pairs.jsonl \\
+              --source openrouter/openai/gpt-4o --since 2025-06-01 \\
+              -m anthropic/claude-sonnet-4 -m google/gemini-2.5-flash
+        """
+        import sqlite_utils
+        from llm.cli import logs_db_path
+
+        try:
+            models = [_get_async_model(model_id) for model_id in model_ids]
+        except llm.UnknownModelError as ex:
+            raise click.ClickException(str(ex))
+        db = sqlite_utils.Database(database or logs_db_path())
+        if not db["responses"].exists():
+            raise click.ClickException("No logged responses found")
+        prompts = logged_prompts(
+            db,
+            models=source_models,
+            since=since,
+            before=before,
+            conversations=conversations,
+            limit=limit,
+        )
+        records = []
+
+        async def run():
+            async for record in replay(
+                prompts,
+                models,
+                concurrency=concurrency,
+                options=dict(options),
+                key=key,
+            ):
+                output.write(json.dumps(record) + "\n")
+                # Keep only what the summary needs, not the text of every run
+                records.append(
+                    {
+                        name: value
+                        for name, value in record.items()
+                        if name not in ("prompt", "response", "original_response")
+                    }
+                )
+
+        asyncio.run(run())
+        if not records:
+            raise click.ClickException("No logged prompts matched")
+        summaries = summarize_replay(records)
+        if json_:
+            click.echo(json.dumps(summaries, indent=2))
+        else:
+            click.echo(_format_replay_table(summaries))
+
+    @openrouter.command(name="cascade-stats")
+    @click.option(
+        "--since", help="Only include prompts logged at or after this UTC time"
+    )
+    @click.option("--before", help="Only include prompts logged before this UTC time")
+    @click.option(
+        "-d",
+        "--database",
+        type=click.Path(readable=True, exists=True, dir_okay=False),
+        help="Path to log database",
+    )
+    @click.option("json_", "--json", is_flag=True, help="Output as JSON")
+    def cascade_stats(since, before, database, json_):
+        """
+        Show how logged openrouter/cascade prompts were answered
+
+        For each model in the cascade: how many prompts it was tried for,
+        how many of its replies passed, how many prompts it answered, why
+        its replies were escalated, its median latency and total cost.
+        """
+        import sqlite_utils
+        from llm.cli import logs_db_path
+
+        db = sqlite_utils.Database(database or logs_db_path())
+        summary = summarize_cascade(logged_cascades(db, since=since, before=before))
+        if not summary["prompts"]:
+            raise click.ClickException("No logged cascade prompts found")
+        if json_:
+            click.echo(json.dumps(summary, indent=2))
+        else:
+            click.echo(_format_cascade_table(summary))
+
+    @openrouter.command()
+    @click.option("--reset", is_flag=True, help="Close every circuit")
+    def breakers(reset):
+        """
+        Show the state of each model's and provider's circuit breaker
+
+        Circuit breakers are enabled by setting OPENROUTER_CIRCUIT_BREAKER.
+        """
+        breaker = get_circuit_breaker() or CircuitBreaker(
+            llm.user_dir() / "openrouter-breakers"
+        )
+        if reset:
+            breaker.reset()
+            click.echo("Closed every circuit", err=True)
+            return
+        click.echo(json.dumps(breaker.status(), indent=2))
+
+    @openrouter.command()
+    @click.option("--host", default="127.0.0.1", show_default=True)
+    @click.option("-p", "--port", type=int, default=8765, show_default=True)
+    @click.option(
+        "--upstream",
+        help="API to forward requests to, defaults to OpenRouter",
+    )
+    def serve(host, port, upstream):
+        """
+        Run a local proxy that OpenRouter models use while it is running
+
+        The proxy keeps connections to OpenRouter open between prompts and
+        holds the model catalog in memory, refreshing it in the background.
+        Any OpenAI-compatible client can use it too, at the URL it outputs.
+        """
+        existing = get_serve_api_base()
+        if existing:
+            raise click.ClickException(
+                "llm openrouter serve is already running at {}".format(existing)
+            )
+        proxy = ServeProxy(upstream, host, port)
+        proxy.refresh_catalog()
+        state_path = _serve_state_path()
+        state_path.parent.mkdir(parents=True, exist_ok=True)
+        state_path.write_text(
+            json.dumps(
+                {
+                    "pid": os.getpid(),
+                    "api_base": proxy.api_base,
+                    "upstream": proxy.upstream,
+                }
+            )
+        )
+        click.echo("Serving OpenRouter proxy at {}".format(proxy.api_base), err=True)
+        # Clean up the state file when stopped with kill as well as Ctrl+C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            proxy.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            proxy.shutdown()
+            state_path.unlink(missing_ok=True)
+
+    @openrouter.command(name="fanout")
+    @click.argument("prompt", required=False)
+    @click.option(
+        "model_ids",
+        "-m",
+        "--model",
+        multiple=True,
+        required=True,
+        help="Model to run the prompt against, can be used multiple times",
+    )
+    @click.option("-s", "--system", help="System prompt to use")
+    @click.option(
+        "options",
+        "-o",
+        "--option",
+        type=(str, str),
+        multiple=True,
+        help="key/value options for every model",
+    )
+    @click.option(
+        "--first", is_flag=True, help="Output only the first response to finish"
+    )
+    @click.option(
+        "--grouped",
+        is_flag=True,
+        help="Output each response in full once it completes",
+    )
+    @click.option("-n", "--no-log", is_flag=True, help="Don't log to database")
+    @click.option("--key", help="API key to use")
+    def fanout_(prompt, model_ids, system, options, first, grouped, no_log, key):
+        """
+        Run the same prompt against several models at once
+
+        Example:
+
+        \b
+            llm openrouter fanout 'Five names for a pet pelican' \\
+              -m openai/gpt-4o -m anthropic/claude-sonnet-4
+        """
+        import sqlite_utils
+        from llm.cli import logs_db_path, logs_on
+        from llm.migrations import migrate
+
+        if prompt is None:
+            if sys.stdin.isatty():
+                raise click.ClickException("No prompt provided")
+            prompt = sys.stdin.read()
+        try:
+            models = [_get_async_model(model_id) for model_id in model_ids]
+        except llm.UnknownModelError as ex:
+            raise click.ClickException(str(ex))
+        width = max(len(model.model_id) for model in models)
+        buffers = {}
+
+        def echo_line(model, line):
+            click.echo("{}  {}".format(model.model_id.ljust(width), line))
+
+        def on_chunk(model, chunk):
+            # Interleave output from all models one complete line at a time
+            buffer = buffers.get(model.model_id, "") + chunk
+            *lines, buffers[model.model_id] = buffer.split("\n")
+            for line in lines:
+                echo_line(model, line)
+
+        try:
+            results = asyncio.run(
+                fanout(
+                    prompt,
+                    models,
+                    first=first,
+                    on_chunk=None if (grouped or first) else on_chunk,
+                    system=system,
+                    options=dict(options),
+                    key=key,
+                )
+            )
+        except FanoutError as ex:
+            raise click.ClickException(
+                "Every model failed:\n"
+                + "\n".join(
+                    "{}  Error: {}".format(model.model_id.ljust(width), error)
+                    for model, error in ex.errors
+                )
+            )
+        if first:
+            models = [results[0].model]
+        for model, result in zip(models, results):
+            if isinstance(result, Exception):
+                click.echo(
+                    "{}  Error: {}".format(model.model_id.ljust(width), result),
+                    err=True,
+                )
+            elif grouped or first:
+                click.echo(
+                    "## {}\n\n{}\n".format(
+                        result.model.model_id, result.text_or_raise()
+                    )
+                )
+            elif buffers.get(model.model_id):
+                echo_line(model, buffers[model.model_id])
+        if logs_on() and not no_log:
+            db = sqlite_utils.Database(logs_db_path())
+            migrate(db)
+            for result in results:
+                if not isinstance(result, Exception):
+                    result.log_to_db(db)
+
+
+def _format_bench_table(summaries):
+    def seconds(value):
+        return "-" if value is None else "{:.2f}s".format(value)
+
+    headers = (
+        "model",
+        "provider",
+        "runs",
+        "errors",
+        "ttft p50",
+        "ttft p95",
+        "tok/s",
+        "latency p50",
+        "p90",
+        "p99",
+        "$/1K out",
+    )
+    rows = [
+        (
+            summary["model"],
+            summary["provider"] or "-",
+            str(summary["runs"]),
+            "{} ({:.0%})".format(summary["errors"], summary["error_rate"]),
+            seconds(summary["ttft_p50"]),
+            seconds(summary["ttft_p95"]),
+            (
+                "-"
+                if summary["tokens_per_second"] is None
+                else "{:.1f}".format(summary["tokens_per_second"])
+            ),
+            seconds(summary["latency_p50"]),
+            seconds(summary["latency_p90"]),
+            seconds(summary["latency_p99"]),
+            (
+                "-"
+                if summary["cost_per_1k_output_tokens"] is None
+                else "${:.4f}".format(summary["cost_per_1k_output_tokens"])
+            ),
+        )
+        for summary in summaries
+    ]
+    widths = [max(len(row[i]) for row in (headers, *rows)) for i in range(len(headers))]
+    return "\n".join(
+        "  ".join(
+            value.ljust(width) if i < 2 else value.rjust(width)
+            for i, (value, width) in enumerate(zip(row, widths))
+        ).rstrip()
+        for row in (headers, *rows)
+    )
+
+
+def _format_replay_table(summaries):
+    def seconds(value):
+        return "-" if value is None else "{:.2f}s".format(value)
+
+    def dollars(value):
+        return "-" if value is None else "${:.4f}".format(value)
+
+    headers = (
+        "model",
+        "runs",
+        "errors",
+        "ttft p50",
+        "latency p50",
+        "logged",
+        "tokens out",
+        "logged",
+        "cost",
+        "logged",
+    )
+    rows = [
+        (
+            summary["model"],
+            str(summary["runs"]),
+            "{} ({:.0%})".format(summary["errors"], summary["error_rate"]),
+            seconds(summary["ttft_p50"]),
+            seconds(summary["latency_p50"]),
+            seconds(summary["original_latency_p50"]),
+            str(summary["output_tokens"]),
+            str(summary["original_output_tokens"]),
+            dollars(summary["cost"]),
+            dollars(summary["original_cost"]),
+        )
+        for summary in summaries
+    ]
+    widths = [max(len(row[i]) for row in (headers, *rows)) for i in range(len(headers))]
+    return "\n".join(
+        "  ".join(
+            value.ljust(width) if i < 1 else value.rjust(width)
+            for i, (value, width) in enumerate(zip(row, widths))
+        ).rstrip()
+        for row in (headers, *rows)
+    )
+
+
+def _format_cascade_table(summary):
+    def seconds(value):
+        return "-" if value is None else "{:.2f}s".format(value)
+
+    def dollars(value):
+        return "-" if value is None else "${:.4f}".format(value)
+
+    headers = (
+        "model",
+        "attempts",
+        "passed",
+        "answered",
+        "latency p50",
+        "cost",
+        "escalated because",
+    )
+    rows = [
+        (
+            model["model"],
+            str(model["attempts"]),
+            str(model["passed"]),
+            str(model["answered"]),
+            seconds(model["latency_p50"]),
+            dollars(model["cost"]),
+            ", ".join(
+                "{} {}".format(kind, count)
+                for kind, count in sorted(model["failures"].items())
+            ),
+        )
+        for model in summary["models"]
+    ]
+    widths = [max(len(row[i]) for row in (headers, *rows)) for i in range(len(headers))]
+    table = "\n".join(
+        "  ".join(
+            value.ljust(width) if i in (0, 6) else value.rjust(width)
+            for i, (value, width) in enumerate(zip(row, widths))
+        ).rstrip()
+        for row in (headers, *rows)
+    )
+    return (
+        "{} prompts, {} attempts, {} escalated, {} unresolved - "
+        "latency p50 {}, cost {}\n\n{}"
+    ).format(
+        summary["prompts"],
+        summary["attempts"],
+        summary["escalated"],
+        summary["unresolved"],
+        seconds(summary["latency_p50"]),
+        dollars(summary["cost"]),
+        table,
+    )
+
+
+async def _inspect_keys(keys):
+    import httpx
+
+    async def inspect(client, key):
+        try:
+            response = await client.get(
+                get_api_base() + "/auth/key",
+                headers={"Authorization": f"Bearer {key}"},
+            )
+            response.raise_for_status()
+            return {"key": redact_key(key), **response.json()["data"]}
+        except httpx.HTTPError as ex:
+            return {"key": redact_key(key), "error": str(ex)}
+
+    async with httpx.AsyncClient() as client:
+        return await asyncio.gather(*(inspect(client, key) for key in keys))
+
 
 def format_price(key, price_str):
     """Format a price value with appropriate scaling and no trailing zeros."""
@@ -0,0 +1,413 @@
+"""Benchmarks for the plugin's hot paths, with results written as JSON.
+
+Run them with::
+
+    python tests/benchmarks.py -o results.json
+
+Then compare a later run against those results, exiting with an error if
+any benchmark got more than 25% slower::
+
+    python tests/benchmarks.py --compare results.json --threshold 1.25
+
+Everything runs locally: catalogs are synthetic and streaming benchmarks
+use the stand-in server in ``fake_openrouter.py``.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from importlib.metadata import version
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import llm  # noqa: E402
+from llm.parts import Message, TextPart, ToolCallPart, ToolResultPart  # noqa: E402
+
+import llm_openrouter  # noqa: E402
+from fake_openrouter import FakeOpenRouter, synthetic_catalog  # noqa: E402
+
+
+@contextmanager
+def environment(**values):
+    "Set environment variables, restoring their previous values afterwards"
+    previous = {name: os.environ.get(name) for name in values}
+    os.environ.update({k: v for k, v in values.items() if v is not None})
+    for name in (k for k, v in values.items() if v is None):
+        os.environ.pop(name, None)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def measure(name, func, *, repeat=5, number=1, units=1, unit="calls"):
+    """Time ``func``, returning a result dictionary.
+
+    ``func`` runs once to warm up, then ``repeat`` rounds of ``number``
+    calls. ``units`` is the amount of work done by each call, used for the
+    ``per_second`` rate.
+    """
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    median = statistics.median(timings)
+    return {
+        "name": name,
+        "unit": unit,
+        "repeat": repeat,
+        "number": number,
+        "min": min(timings),
+        "median": median,
+        "mean": statistics.fmean(timings),
+        "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        "per_second": units / median if median else None,
+    }
+
+
+def model(model_class=llm_openrouter.OpenRouterResponses):
+    return model_class(
+        model_id="openrouter/bench/model",
+        model_name="bench/model",
+        api_base="https://openrouter.ai/api/v1",
+        vision=True,
+        supports_tools=True,
+    )
+
+
+def server_tool_history(turns):
+    "A conversation with a web search and a shell call in every turn"
+    messages = []
+    for turn in range(turns):
+        search = {
+            "id": "ws_{}".format(turn),
+            "type": "openrouter:web_search",
+            "status": "completed",
+            "action": {"type": "search", "query": "pelicans {}".format(turn)},
+        }
+        shell_call = {
+            "id": "sh_{}".format(turn),
+            "type": "shell_call",
+            "call_id": "shell_call_{}".format(turn),
+            "action": {"commands": ["ls /tmp/{}".format(turn)]},
+        }
+        shell_output = {
+            "id": "sho_{}".format(turn),
+            "type": "shell_call_output",
+            "call_id": "shell_call_{}".format(turn),
+            "output": [{"stdout": "file.txt\n" * 20, "stderr": "", "exit_code": 0}],
+        }
+        messages.append(
+            Message(role="user", parts=[TextPart("Question {}".format(turn))])
+        )
+        messages.append(
+            Message(
+                role="assistant",
+                parts=[
+                    TextPart("Searching. "),
+                    ToolCallPart(
+                        name="web_search",
+                        arguments=search["action"],
+                        tool_call_id=search["id"],
+                        server_executed=True,
+                        provider_metadata={"openrouter": {"response_item": search}},
+                    ),
+                    ToolCallPart(
+                        name="shell",
+                        arguments=shell_call["action"],
+                        tool_call_id=shell_call["call_id"],
+                        server_executed=True,
+                        provider_metadata={"openrouter": {"response_item": shell_call}},
+                    ),
+                    ToolResultPart(
+                        name="shell",
+                        output="file.txt",
+                        tool_call_id=shell_call["call_id"],
+                        server_executed=True,
+                        provider_metadata={
+                            "openrouter": {"response_item": shell_output}
+                        },
+                    ),
+                    TextPart("Answer {}".format(turn)),
+                ],
+            )
+        )
+    messages.append(Message(role="user", parts=[TextPart("Summarize")]))
+    return messages
+
+
+def server_tool_items(count):
+    items = []
+    for i in range(count):
+        items.append(
+            SimpleNamespace(
+                id="ws_{}".format(i),
+                type="openrouter:web_search",
+                status="completed",
+                action={"type": "search", "query": "pelicans"},
+            )
+        )
+        items.append(
+            SimpleNamespace(
+                id="sh_{}".format(i),
+                type="shell_call",
+                call_id="shell_call_{}".format(i),
+                action={"commands": ["ls"]},
+            )
+        )
+        items.append(
+            SimpleNamespace(
+                id="sho_{}".format(i),
+                type="shell_call_output",
+                call_id="shell_call_{}".format(i),
+                output=[{"stdout": "file.txt\n", "stderr": "", "exit_code": 0}],
+            )
+        )
+    return items
+
+
+def write_catalog(user_dir, size):
+    path = Path(user_dir) / "openrouter_models.json"
+    path.write_text(json.dumps({"data": synthetic_catalog(size)}))
+    return path
+
+
+def register_models_benchmarks(user_dir, sizes, repeat):
+    results = []
+    for size in sizes:
+        write_catalog(user_dir, size)
+        registered = []
+
+        def register_models():
+            registered.clear()
+            llm_openrouter.register_models(
+                lambda *models, **kwargs: registered.append(models)
+            )
+
+        results.append(
+            measure(
+                "register_models[{}]".format(size),
+                register_models,
+                repeat=repeat,
+                units=size,
+                unit="models",
+            )
+        )
+        # Every catalog model, plus the local router and cascade models
+        assert len(registered) == size + 2
+    return results
+
+
+def fetch_cached_json_benchmarks(user_dir, sizes, repeat):
+    results = []
+    for size in sizes:
+        path = write_catalog(user_dir, size)
+        results.append(
+            measure(
+                "fetch_cached_json_hit[{}]".format(size),
+                lambda: llm_openrouter.fetch_cached_json(
+                    "https://openrouter.ai/api/v1/models", path, 3600
+                ),
+                repeat=repeat,
+                number=10,
+            )
+        )
+    return results
+
+
+def request_building_benchmarks(turns, items, repeat):
+    results = []
+    responses_model = model()
+    prompt = responses_model.prompt(messages=server_tool_history(turns)).prompt
+    results.append(
+        measure(
+            "build_responses_input[{} turns]".format(turns),
+            lambda: responses_model._build_responses_input(prompt),
+            repeat=repeat,
+            units=turns,
+            unit="turns",
+        )
+    )
+    output = server_tool_items(items)
+
+    def server_tool_events():
+        done_events = {}
+        for item in output:
+            events = responses_model._server_tool_events(item, 0)
+            if events:
+                done_events[item.id] = events
+        return done_events
+
+    results.append(
+        measure(
+            "server_tool_events[{} items]".format(len(output)),
+            server_tool_events,
+            repeat=repeat,
+            units=len(output),
+            unit="items",
+        )
+    )
+    done_events = server_tool_events()
+    results.append(
+        measure(
+            "refresh_server_tool_events[{} items]".format(len(output)),
+            lambda: responses_model._refresh_server_tool_events(output, done_events),
+            repeat=repeat,
+            units=len(output),
+            unit="items",
+        )
+    )
+    return results
+
+
+def streaming_benchmarks(tokens, repeat):
+    results = []
+    with FakeOpenRouter(catalog_size=1, output_tokens=tokens) as server:
+        with environment(OPENROUTER_API_BASE=server.api_base):
+            streaming_model = llm.get_model("openrouter/stand-in/model-0")
+            for name, options in (
+                ("responses", {}),
+                ("chat_completions", {"chat_completions": True}),
+            ):
+
+                def stream():
+                    for _ in streaming_model.prompt("Go", **options):
+                        pass
+
+                results.append(
+                    measure(
+                        "stream_{}[{} tokens]".format(name, tokens),
+                        stream,
+                        repeat=repeat,
+                        units=tokens,
+                        unit="events",
+                    )
+                )
+    return results
+
+
+def run_benchmarks(quick=False, only=None):
+    """Run every benchmark, or those with ``only`` in their name.
+
+    ``quick`` uses small inputs and few repeats, for checking that the
+    benchmarks still work rather than for measurements.
+    """
+    repeat = 2 if quick else 5
+    with (
+        tempfile.TemporaryDirectory() as user_dir,
+        environment(
+            LLM_USER_PATH=user_dir,
+            OPENROUTER_KEY="sk-or-benchmark",
+            OPENROUTER_API_BASE=None,
+            OPENROUTER_KEYS=None,
+            OPENROUTER_RATE_LIMIT=None,
+            OPENROUTER_MAX_IN_FLIGHT=None,
+            OPENROUTER_CIRCUIT_BREAKER=None,
+        ),
+    ):
+        if quick:
+            catalog_sizes, turns, items, tokens = (20,), 5, 10, 50
+        else:
+            catalog_sizes, turns, items, tokens = (100, 1000), 200, 1000, 5000
+        groups = (
+            (
+                "register_models",
+                register_models_benchmarks,
+                (user_dir, catalog_sizes, repeat),
+            ),
+            (
+                "fetch_cached_json",
+                fetch_cached_json_benchmarks,
+                (user_dir, catalog_sizes, repeat),
+            ),
+            (
+                "build_responses_input server_tool_events refresh_server_tool_events",
+                request_building_benchmarks,
+                (turns, items, repeat),
+            ),
+            ("stream_", streaming_benchmarks, (tokens, repeat)),
+        )
+        results = []
+        for names, func, args in groups:
+            if only and not any(only in name for name in names.split()):
+                continue
+            results.extend(
+                result for result in func(*args) if not only or only in result["name"]
+            )
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "llm": version("llm"),
+        "llm-openrouter": version("llm-openrouter"),
+        "quick": quick,
+        "benchmarks": results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Print how each benchmark changed, returning the names of regressions.
+
+    A benchmark regressed if its median time grew by more than ``threshold``
+    times its baseline median.
+    """
+    before = {result["name"]: result for result in baseline["benchmarks"]}
+    regressions = []
+    for result in current["benchmarks"]:
+        previous = before.get(result["name"])
+        if previous is None:
+            print("{:<48} new".format(result["name"]))
+            continue
+        ratio = result["median"] / previous["median"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(result["name"])
+            flag = "  REGRESSION"
+        print("{:<48} {:>7.2f}x{}".format(result["name"], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-o", "--output", help="Write JSON results to this file")
+    parser.add_argument("--quick", action="store_true", help="Small, fast run")
+    parser.add_argument("--only", help="Only run benchmarks with this in the name")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Slowdown ratio that counts as a regression",
+    )
+    args = parser.parse_args(argv)
+    results = run_benchmarks(quick=args.quick, only=args.only)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    elif not args.compare:
+        print(output)
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if compare(baseline, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
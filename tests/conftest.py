@@ -1,6 +1,7 @@
 import pytest
 import os
 import vcr
+from fake_openrouter import FakeOpenRouter
 from models_persister import TruncatedModelsFilesystemPersister
 
 OPENROUTER_KEY = os.getenv("PYTEST_OPENROUTER_KEY", "sk-...")
@@ -30,3 +31,10 @@ def user_path(tmpdir):
 def env_setup(monkeypatch, user_path):
     monkeypatch.setenv("LLM_USER_PATH", str(user_path))
     monkeypatch.setenv("OPENROUTER_KEY", OPENROUTER_KEY)
+
+
+@pytest.fixture
+def fake_openrouter(monkeypatch):
+    with FakeOpenRouter() as server:
+        monkeypatch.setenv("OPENROUTER_API_BASE", server.api_base)
+        yield server
@@ -0,0 +1,790 @@
+"""A local stand-in for the OpenRouter API, for offline load and latency testing.
+
+It serves the models catalog, ``/auth/key``, ``/generation`` stats,
+``/embeddings`` and streaming or non-streaming Responses and Chat
+Completions requests, with configurable timing, catalog size and error
+injection. Run it from the command line::
+
+    python tests/fake_openrouter.py --port 8080 --ttft 0.3 --tokens-per-second 80
+    OPENROUTER_API_BASE=http://127.0.0.1:8080/api/v1 \\
+      llm -m openrouter/stand-in/model-0 'Say hello'
+
+Or start it from Python::
+
+    with FakeOpenRouter(ttft=0.1, error_rate=0.05) as server:
+        os.environ["OPENROUTER_API_BASE"] = server.api_base
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+WORDS = (
+    "the quick brown pelican glides over calm water while a curious heron "
+    "watches from the reeds and the evening light fades"
+).split()
+
+
+def synthetic_catalog(size):
+    "A list of model definitions shaped like OpenRouter's /models response"
+    return [
+        {
+            "id": "stand-in/model-{}".format(i),
+            "canonical_slug": "stand-in/model-{}".format(i),
+            "name": "Stand-in: Model {}".format(i),
+            "created": 1750000000 + i,
+            "description": "Synthetic model served by the local stand-in",
+            "context_length": 128000,
+            "architecture": {
+                "modality": "text+image->text",
+                "input_modalities": ["text", "image"],
+                "output_modalities": ["text"],
+                "tokenizer": "Other",
+            },
+            "pricing": {
+                "prompt": "0.000001",
+                "completion": "0.000002",
+                "request": "0",
+                "image": "0",
+                "web_search": "0",
+                "internal_reasoning": "0",
+            },
+            "top_provider": {
+                "context_length": 128000,
+                "max_completion_tokens": 16384,
+                "is_moderated": False,
+            },
+            "supported_parameters": [
+                "max_tokens",
+                "temperature",
+                "top_p",
+                "tools",
+                "tool_choice",
+                "structured_outputs",
+                "response_format",
+                "reasoning",
+            ],
+        }
+        for i in range(size)
+    ]
+
+
+def synthetic_embedding_catalog(size):
+    "Model definitions for embedding models, shaped like OpenRouter's"
+    return [
+        {
+            "id": "stand-in/embed-{}".format(i),
+            "canonical_slug": "stand-in/embed-{}".format(i),
+            "name": "Stand-in: Embed {}".format(i),
+            "created": 1750000000 + i,
+            "description": "Synthetic embedding model served by the local stand-in",
+            "context_length": 8192,
+            "architecture": {
+                "modality": "text->embeddings",
+                "input_modalities": ["text"],
+                "output_modalities": ["embeddings"],
+                "tokenizer": "Other",
+            },
+            "pricing": {"prompt": "0.00000002", "completion": "0"},
+            "top_provider": {"context_length": 8192, "is_moderated": False},
+            "supported_parameters": [],
+        }
+        for i in range(size)
+    ]
+
+
+def embedding(text):
+    "The deterministic vector the stand-in returns for text"
+    return [float(len(text)), float(sum(map(ord, text)) % 997)]
+
+
+class FakeOpenRouter:
+    """Stand-in OpenRouter server running on a background thread.
+
+    ``ttft`` is the delay in seconds before the first token of a response,
+    ``tokens_per_second`` paces the tokens after that and ``error_rate`` is
+    the fraction of requests that fail with ``error_status``. When
+    ``tool_calls`` is set, prompts offering function tools get a call to
+    each of them - or just the first, if ``parallel_tool_calls`` is false -
+    until a tool result is sent back. Streamed calls are paced like tokens,
+    with their arguments sent a character at a time. Strings added to
+    ``outputs`` are sent, four characters at a time, as the text of the next
+    responses instead of the usual sentence. Stats for each
+    generation are available from ``/generation`` after
+    ``generation_delay`` seconds. ``embedding_models`` adds that many
+    embedding models to the catalog, whose ``/embeddings`` requests wait
+    ``ttft`` seconds; ``peak_embedding_requests`` is the most that were
+    ever in flight at once. Responses and errors name ``provider`` as the
+    upstream provider, if it is set. With ``gzip`` set, JSON responses are
+    compressed for clients that accept it.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        *,
+        catalog_size=20,
+        output_tokens=20,
+        ttft=0.0,
+        tokens_per_second=None,
+        error_rate=0.0,
+        error_status=429,
+        retry_after=1.0,
+        tool_calls=False,
+        generation_delay=0.0,
+        seed=None,
+        embedding_models=0,
+        provider=None,
+        gzip=False,
+    ):
+        self.catalog_size = catalog_size
+        self.embedding_models = embedding_models
+        self.output_tokens = output_tokens
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.tool_calls = tool_calls
+        self.generation_delay = generation_delay
+        self.provider = provider
+        self.gzip = gzip
+        self.requests = []
+        self.outputs = []
+        self.generations = {}
+        self.embedding_requests = 0
+        self.peak_embedding_requests = 0
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def api_base(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/api/v1".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record(self, method, path, body):
+        with self._lock:
+            self.requests.append((method, path, body))
+
+    def next_id(self, prefix):
+        with self._lock:
+            return "{}_{}".format(prefix, next(self._ids))
+
+    def add_generation(self, generation_id, body, usage, streamed):
+        tokens_prompt = usage.get("input_tokens", usage.get("prompt_tokens"))
+        tokens_completion = usage.get("output_tokens", usage.get("completion_tokens"))
+        stats = {
+            "id": generation_id,
+            "model": body.get("model"),
+            "provider_name": "Stand-in",
+            "streamed": streamed,
+            "finish_reason": "stop",
+            "latency": int(self.ttft * 1000),
+            "generation_time": int(
+                self.output_tokens / (self.tokens_per_second or 1000) * 1000
+            ),
+            "moderation_latency": None,
+            "tokens_prompt": tokens_prompt,
+            "tokens_completion": tokens_completion,
+            "native_tokens_prompt": tokens_prompt,
+            "native_tokens_completion": tokens_completion,
+            "native_tokens_reasoning": 0,
+            "total_cost": usage.get("cost"),
+        }
+        with self._lock:
+            self.generations[generation_id] = (time.monotonic(), stats)
+
+    def generation(self, generation_id):
+        "Stats for a generation, or None if it is unknown or not ready yet"
+        with self._lock:
+            created, stats = self.generations.get(generation_id, (None, None))
+        if created is None or time.monotonic() - created < self.generation_delay:
+            return None
+        return stats
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def tokens(self, body=None):
+        "Tokens of the next output, cut short at the request's token limit"
+        with self._lock:
+            text = self.outputs.pop(0) if self.outputs else None
+        if text is not None:
+            tokens = [text[i : i + 4] for i in range(0, len(text), 4)]
+        else:
+            tokens = [
+                ("" if i == 0 else " ") + WORDS[i % len(WORDS)]
+                for i in range(self.output_tokens)
+            ]
+        limit = (body or {}).get("max_output_tokens") or (body or {}).get("max_tokens")
+        return tokens[:limit] if limit else tokens
+
+    def catalog(self):
+        return synthetic_catalog(self.catalog_size) + synthetic_embedding_catalog(
+            self.embedding_models
+        )
+
+    def embeddings(self, body):
+        with self._lock:
+            self.embedding_requests += 1
+            self.peak_embedding_requests = max(
+                self.peak_embedding_requests, self.embedding_requests
+            )
+        try:
+            time.sleep(self.ttft)
+        finally:
+            with self._lock:
+                self.embedding_requests -= 1
+        texts = body["input"]
+        texts = [texts] if isinstance(texts, str) else texts
+        # Out of order, as clients must go by each item's index
+        data = [
+            {"object": "embedding", "index": index, "embedding": embedding(text)}
+            for index, text in reversed(list(enumerate(texts)))
+        ]
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        return {
+            "object": "list",
+            "model": body.get("model"),
+            "data": data,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def key_info(self):
+        return {
+            "data": {
+                "label": "sk-or-v1-sta...",
+                "limit": None,
+                "usage": 0,
+                "is_free_tier": False,
+                "rate_limit": {"requests": -1, "interval": "10s"},
+            }
+        }
+
+    def pause(self, first):
+        if first:
+            time.sleep(self.ttft)
+        elif self.tokens_per_second:
+            time.sleep(1 / self.tokens_per_second)
+
+
+def _function_tools(body, chat):
+    "The function tools to call, none if a tool result was already sent"
+    if chat:
+        if any(message.get("role") == "tool" for message in body.get("messages", [])):
+            return []
+        names = [
+            tool["function"]["name"]
+            for tool in body.get("tools") or []
+            if tool.get("type") == "function"
+        ]
+    else:
+        if any(
+            isinstance(item, dict) and item.get("type") == "function_call_output"
+            for item in body.get("input") or []
+        ):
+            return []
+        names = [
+            tool["name"]
+            for tool in body.get("tools") or []
+            if tool.get("type") == "function"
+        ]
+    if body.get("parallel_tool_calls") is False:
+        return names[:1]
+    return names
+
+
+def _server_tool_items(fake, body):
+    items = []
+    for tool in body.get("tools") or []:
+        tool_type = tool.get("type")
+        if tool_type == "openrouter:web_search":
+            items.append(
+                {
+                    "id": fake.next_id("ws"),
+                    "type": "openrouter:web_search",
+                    "status": "completed",
+                    "action": {"type": "search", "query": "stand-in search"},
+                }
+            )
+        elif tool_type == "openrouter:shell":
+            environment = (tool.get("parameters") or {}).get("environment") or {}
+            container_id = environment.get("container_id") or fake.next_id("cntr")
+            call_id = fake.next_id("call")
+            items.append(
+                {
+                    "id": fake.next_id("sh"),
+                    "type": "shell_call",
+                    "call_id": call_id,
+                    "status": "completed",
+                    "action": {"commands": ["echo stand-in"]},
+                    "environment": {
+                        "type": "container_reference",
+                        "container_id": container_id,
+                    },
+                }
+            )
+            items.append(
+                {
+                    "id": fake.next_id("sho"),
+                    "type": "shell_call_output",
+                    "call_id": call_id,
+                    "output": [
+                        {
+                            "stdout": "stand-in\n",
+                            "stderr": "",
+                            "outcome": {"type": "exit", "exit_code": 0},
+                        }
+                    ],
+                }
+            )
+    return items
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-stream when they abort a response
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def do_GET(self):
+        self.fake.record("GET", self.path, None)
+        if self.path.split("?")[0] == "/api/v1/models":
+            self._send_json(200, {"data": self.fake.catalog()})
+        elif self.path == "/api/v1/auth/key":
+            self._send_json(200, self.fake.key_info())
+        elif self.path.startswith("/api/v1/generation?"):
+            query = parse_qs(urlsplit(self.path).query)
+            stats = self.fake.generation((query.get("id") or [""])[0])
+            if stats is None:
+                self._send_json(
+                    404, {"error": {"message": "Generation not found", "code": 404}}
+                )
+            else:
+                self._send_json(200, {"data": stats})
+        else:
+            self._send_json(404, {"error": {"message": "Not found", "code": 404}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        self.fake.record("POST", self.path, body)
+        if self.path not in (
+            "/api/v1/responses",
+            "/api/v1/chat/completions",
+            "/api/v1/embeddings",
+        ):
+            self._send_json(404, {"error": {"message": "Not found", "code": 404}})
+            return
+        if self.fake.should_fail():
+            status = self.fake.error_status
+            self._send_json(
+                status,
+                {
+                    "error": {
+                        "message": "Injected error",
+                        "code": status,
+                        **(
+                            {"metadata": {"provider_name": self.fake.provider}}
+                            if self.fake.provider
+                            else {}
+                        ),
+                    }
+                },
+                headers={
+                    "Retry-After": str(int(self.fake.retry_after)),
+                    "Retry-After-Ms": str(int(self.fake.retry_after * 1000)),
+                },
+            )
+            return
+        if self.path.endswith("/embeddings"):
+            self._send_json(200, self.fake.embeddings(body))
+            return
+        chat = self.path.endswith("/chat/completions")
+        if body.get("stream"):
+            self._start_stream()
+            if chat:
+                self._stream_chat(body)
+            else:
+                self._stream_responses(body)
+            self._write_chunk(b"")
+        elif chat:
+            self._send_json(200, self._chat_completion(body))
+        else:
+            self._send_json(200, self._response(body))
+
+    def _send_json(self, status, data, headers=None):
+        encoded = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if self.fake.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            encoded = gzip.compress(encoded)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(encoded)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_event(self, data, event=None):
+        lines = "event: {}\n".format(event) if event else ""
+        lines += "data: {}\n\n".format(
+            data if isinstance(data, str) else json.dumps(data)
+        )
+        self._write_chunk(lines.encode("utf-8"))
+
+    def _usage(self, body, output_tokens, chat):
+        input_tokens = max(1, len(json.dumps(body.get("input") or body)) // 4)
+        cost = round(input_tokens * 1e-6 + output_tokens * 2e-6, 9)
+        if chat:
+            return {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "cost": cost,
+            }
+        return {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+            "cost": cost,
+        }
+
+    def _response_items(self, body):
+        items = _server_tool_items(self.fake, body)
+        if self.fake.tool_calls:
+            for tool_name in _function_tools(body, chat=False):
+                items.append(
+                    {
+                        "id": self.fake.next_id("fc"),
+                        "type": "function_call",
+                        "call_id": self.fake.next_id("call"),
+                        "name": tool_name,
+                        "arguments": "{}",
+                        "status": "completed",
+                    }
+                )
+        return items
+
+    def _response_object(self, body, output, output_tokens, status="completed"):
+        generation_id = self.fake.next_id("resp")
+        usage = None
+        incomplete_details = None
+        if status == "completed" and output_tokens == body.get("max_output_tokens"):
+            status = "incomplete"
+            incomplete_details = {"reason": "max_output_tokens"}
+        if status != "in_progress":
+            usage = self._usage(body, output_tokens, chat=False)
+            self.fake.add_generation(
+                generation_id, body, usage, streamed=bool(body.get("stream"))
+            )
+        return {
+            "id": generation_id,
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model"),
+            **self._provider(),
+            "status": status,
+            "incomplete_details": incomplete_details,
+            "output": output,
+            "parallel_tool_calls": body.get("parallel_tool_calls", True),
+            "tool_choice": "auto",
+            "tools": body.get("tools") or [],
+            "usage": usage,
+        }
+
+    def _message_item(self, text):
+        return {
+            "id": self.fake.next_id("msg"),
+            "type": "message",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }
+
+    def _response(self, body):
+        self.fake.pause(first=True)
+        items = self._response_items(body)
+        tokens = []
+        if not (items and items[-1]["type"] == "function_call"):
+            tokens = self.fake.tokens(body)
+            items.append(self._message_item("".join(tokens)))
+        return self._response_object(body, items, len(tokens) or 1)
+
+    def _stream_responses(self, body):
+        sequence = itertools.count()
+
+        def send(event_type, **data):
+            self._send_event(
+                {"type": event_type, "sequence_number": next(sequence), **data},
+                event=event_type,
+            )
+
+        send(
+            "response.created",
+            response=self._response_object(body, [], 0, status="in_progress"),
+        )
+        self.fake.pause(first=True)
+        output = self._response_items(body)
+        for index, item in enumerate(output):
+            if item["type"] != "function_call":
+                send("response.output_item.added", output_index=index, item=item)
+                send("response.output_item.done", output_index=index, item=item)
+                continue
+            if index:
+                self.fake.pause(first=False)
+            send(
+                "response.output_item.added",
+                output_index=index,
+                item={**item, "arguments": "", "status": "in_progress"},
+            )
+            for delta in item["arguments"]:
+                send(
+                    "response.function_call_arguments.delta",
+                    item_id=item["id"],
+                    output_index=index,
+                    delta=delta,
+                )
+            send(
+                "response.function_call_arguments.done",
+                item_id=item["id"],
+                output_index=index,
+                arguments=item["arguments"],
+            )
+            send("response.output_item.done", output_index=index, item=item)
+        tokens = []
+        if not (output and output[-1]["type"] == "function_call"):
+            tokens = self.fake.tokens(body)
+            message = self._message_item("")
+            index = len(output)
+            send(
+                "response.output_item.added",
+                output_index=index,
+                item={**message, "status": "in_progress", "content": []},
+            )
+            for position, token in enumerate(tokens):
+                if position:
+                    self.fake.pause(first=False)
+                send(
+                    "response.output_text.delta",
+                    item_id=message["id"],
+                    output_index=index,
+                    content_index=0,
+                    delta=token,
+                    logprobs=[],
+                )
+            text = "".join(tokens)
+            send(
+                "response.output_text.done",
+                item_id=message["id"],
+                output_index=index,
+                content_index=0,
+                text=text,
+                logprobs=[],
+            )
+            message["content"][0]["text"] = text
+            send("response.output_item.done", output_index=index, item=message)
+            output.append(message)
+        send(
+            "response.completed",
+            response=self._response_object(body, output, len(tokens) or 1),
+        )
+
+    def _chat_completion(self, body):
+        self.fake.pause(first=True)
+        tool_names = self.fake.tool_calls and _function_tools(body, chat=True)
+        if tool_names:
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [self._chat_tool_call(name) for name in tool_names],
+            }
+            output_tokens, finish_reason = 1, "tool_calls"
+        else:
+            tokens = self.fake.tokens(body)
+            message = {"role": "assistant", "content": "".join(tokens)}
+            output_tokens, finish_reason = len(tokens), "stop"
+            if output_tokens == body.get("max_tokens"):
+                finish_reason = "length"
+        generation_id = self.fake.next_id("gen")
+        usage = self._usage(body, output_tokens, chat=True)
+        self.fake.add_generation(generation_id, body, usage, streamed=False)
+        return {
+            "id": generation_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            **self._provider(),
+            "choices": [
+                {"index": 0, "message": message, "finish_reason": finish_reason}
+            ],
+            "usage": usage,
+        }
+
+    def _provider(self):
+        return {"provider": self.fake.provider} if self.fake.provider else {}
+
+    def _chat_tool_call(self, name):
+        return {
+            "id": self.fake.next_id("call"),
+            "type": "function",
+            "function": {"name": name, "arguments": "{}"},
+        }
+
+    def _stream_chat(self, body):
+        generation_id = self.fake.next_id("gen")
+        created = int(time.time())
+
+        def send(delta, finish_reason=None, usage=None):
+            chunk = {
+                "id": generation_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+            if usage:
+                chunk["usage"] = usage
+            self._send_event(chunk)
+
+        self.fake.pause(first=True)
+        tool_names = self.fake.tool_calls and _function_tools(body, chat=True)
+        if tool_names:
+            for index, name in enumerate(tool_names):
+                if index:
+                    self.fake.pause(first=False)
+                tool_call = self._chat_tool_call(name)
+                arguments = tool_call["function"]["arguments"]
+                tool_call["function"]["arguments"] = ""
+                send(
+                    {"role": "assistant", "tool_calls": [{"index": index, **tool_call}]}
+                )
+                for delta in arguments:
+                    send(
+                        {
+                            "tool_calls": [
+                                {"index": index, "function": {"arguments": delta}}
+                            ]
+                        }
+                    )
+            usage = self._usage(body, 1, chat=True)
+            send({}, "tool_calls", usage)
+        else:
+            tokens = self.fake.tokens(body)
+            for position, token in enumerate(tokens):
+                if position:
+                    self.fake.pause(first=False)
+                send({"role": "assistant", "content": token})
+            usage = self._usage(body, len(tokens), chat=True)
+            send(
+                {}, "length" if len(tokens) == body.get("max_tokens") else "stop", usage
+            )
+        self.fake.add_generation(generation_id, body, usage, streamed=True)
+        self._send_event("[DONE]")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--catalog-size", type=int, default=20)
+    parser.add_argument("--output-tokens", type=int, default=20)
+    parser.add_argument("--ttft", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=float)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--tool-calls", action="store_true")
+    parser.add_argument("--generation-delay", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--embedding-models", type=int, default=0)
+    parser.add_argument("--provider")
+    parser.add_argument("--gzip", action="store_true")
+    args = parser.parse_args(argv)
+    server = FakeOpenRouter(
+        args.host,
+        args.port,
+        catalog_size=args.catalog_size,
+        output_tokens=args.output_tokens,
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        tool_calls=args.tool_calls,
+        generation_delay=args.generation_delay,
+        seed=args.seed,
+        embedding_models=args.embedding_models,
+        provider=args.provider,
+        gzip=args.gzip,
+    )
+    print("Serving stand-in OpenRouter API at {}".format(server.api_base))
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,8 @@
+import asyncio
+import base64
+import hashlib
+import json
+import time
 from copy import deepcopy
 from types import SimpleNamespace
 
@@ -6,13 +11,25 @@ import pytest
 from click.testing import CliRunner
 from inline_snapshot import snapshot
 from llm.cli import cli
-from llm.parts import Message, TextPart, ToolCallPart, ToolResultPart
+from llm.default_plugins import openai_models
+from llm.parts import Message, StreamEvent, TextPart, ToolCallPart, ToolResultPart
+import llm_openrouter
 from llm_openrouter import (
+    CircuitBreaker,
+    CircuitOpenError,
+    HostLimiter,
+    KeyPool,
     OpenRouterAsyncResponses,
+    OpenRouterChat,
+    OpenRouterEmbedding,
     OpenRouterResponses,
+    RouterIndex,
     Shell,
     WebFetch,
     WebSearch,
+    fanout,
+    parse_circuit_breaker,
+    parse_rate_limit,
 )
 
 TINY_PNG = (
@@ -633,3 +650,2368 @@ def test_unsupported_responses_options(option, value):
     response = model.prompt("hello", options={option: value})
     with pytest.raises(ValueError, match=option):
         model._build_responses_kwargs(response.prompt, stream=True)
+
+
+def fake_async_model(model_name, chunks, delay=0.0):
+    model = OpenRouterAsyncResponses(
+        model_id="openrouter/{}".format(model_name),
+        model_name=model_name,
+        api_base="https://openrouter.ai/api/v1",
+    )
+
+    async def execute(prompt, stream, response, conversation=None, key=None):
+        for chunk in chunks:
+            await asyncio.sleep(delay)
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    model.execute = execute
+    return model
+
+
+def test_fanout_collects_every_response_in_order():
+    slow = fake_async_model("test/slow", ["slow ", "answer"], delay=0.02)
+    fast = fake_async_model("test/fast", ["fast ", "answer"])
+    seen = []
+
+    responses = asyncio.run(
+        fanout(
+            "hello",
+            [slow, fast],
+            on_chunk=lambda model, chunk: seen.append((model.model_id, chunk)),
+        )
+    )
+
+    assert [response.text_or_raise() for response in responses] == [
+        "slow answer",
+        "fast answer",
+    ]
+    # Chunks from the fast model arrive before the slow model has finished
+    assert seen[:2] == [
+        ("openrouter/test/fast", "fast "),
+        ("openrouter/test/fast", "answer"),
+    ]
+
+
+def test_fanout_first_cancels_slower_models():
+    slow = fake_async_model("test/slow", ["slow"], delay=5)
+    fast = fake_async_model("test/fast", ["fast"])
+
+    responses = asyncio.run(fanout("hello", [slow, fast], first=True))
+
+    assert len(responses) == 1
+    assert responses[0].model is fast
+    assert responses[0].text_or_raise() == "fast"
+
+
+def test_fanout_first_reports_every_error(monkeypatch):
+    models = {
+        "a/model": fake_async_model("a/model", [ValueError("Bad request")]),
+        "b/model": fake_async_model("b/model", ["partial", RuntimeError("Dropped")]),
+    }
+    monkeypatch.setattr(
+        llm_openrouter, "_get_async_model", lambda model: models.get(model, model)
+    )
+    with pytest.raises(llm_openrouter.FanoutError) as ex:
+        asyncio.run(fanout("hello", list(models), first=True))
+    assert [(model.model_id, str(error)) for model, error in ex.value.errors] == [
+        ("openrouter/a/model", "Bad request"),
+        ("openrouter/b/model", "Dropped"),
+    ]
+
+    result = CliRunner().invoke(
+        cli,
+        ["openrouter", "fanout", "hello", "-m", "a/model", "-m", "b/model", "--first"],
+    )
+    assert result.exit_code == 1
+    assert result.stderr == (
+        "Error: Every model failed:\n"
+        "openrouter/a/model  Error: Bad request\n"
+        "openrouter/b/model  Error: Dropped\n"
+    )
+
+
+@pytest.fixture
+def cached_catalog(user_path):
+    catalog = {
+        "data": [
+            {
+                "id": "test/text-only",
+                "architecture": {"input_modalities": ["text"]},
+                "supported_parameters": ["tools"],
+            },
+            {
+                "id": "test/vision",
+                "architecture": {"input_modalities": ["text", "image"]},
+                "supported_parameters": ["tools", "structured_outputs"],
+            },
+        ]
+    }
+    (user_path / "openrouter_models.json").write_text(
+        json.dumps(catalog), encoding="utf-8"
+    )
+    return catalog
+
+
+@pytest.mark.parametrize(
+    "model_class", (OpenRouterResponses, OpenRouterAsyncResponses)
+)
+def test_fallback_models(model_class, cached_catalog):
+    model = model_class(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+    response = model.prompt(
+        "hello",
+        options={"fallback_models": "openrouter/test/vision, test/text-only"},
+    )
+
+    kwargs = model._build_responses_kwargs(response.prompt, stream=True)
+
+    assert kwargs["extra_body"] == {
+        "models": ["test/model", "test/vision", "test/text-only"]
+    }
+
+
+def test_fallback_models_chat_completions(cached_catalog):
+    model = OpenRouterChat(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+    response = model.prompt("hello", options={"fallback_models": '["test/vision"]'})
+
+    kwargs = model.build_kwargs(response.prompt, stream=True)
+
+    assert "fallback_models" not in kwargs
+    assert kwargs["extra_body"] == {"models": ["test/model", "test/vision"]}
+
+
+@pytest.mark.parametrize(
+    ("fallback", "prompt_kwargs", "error"),
+    (
+        ("test/missing", {}, "Unknown fallback model: test/missing"),
+        (
+            "test/text-only",
+            {"schema": {"type": "object"}},
+            "test/text-only does not support: schema",
+        ),
+        (
+            "test/text-only",
+            {"attachments": [llm.Attachment(content=TINY_PNG)]},
+            "test/text-only does not support: image attachments",
+        ),
+        (
+            "test/vision",
+            {"attachments": [llm.Attachment(content=b"%PDF-1.4 pretend pdf")]},
+            "test/vision does not support: file attachments",
+        ),
+    ),
+)
+def test_fallback_models_must_match_capabilities(
+    cached_catalog, fallback, prompt_kwargs, error
+):
+    model = OpenRouterResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+        vision=True,
+        supports_schema=True,
+    )
+    response = model.prompt(
+        "hello", options={"fallback_models": fallback}, **prompt_kwargs
+    )
+    with pytest.raises(ValueError, match=error):
+        model._build_responses_kwargs(response.prompt, stream=True)
+
+
+def test_fallback_model_used_is_recorded(cached_catalog):
+    model = OpenRouterResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+    response = model.prompt("hello", options={"fallback_models": "test/vision"})
+    response.response_json = {"model": "test/vision"}
+
+    model._record_resolved_model(response.prompt, response)
+
+    assert response.resolved_model == "openrouter/test/vision"
+
+
+@pytest.mark.parametrize(
+    ("answered_by", "resolved_model"),
+    (
+        ("test/model-2024-08-06", None),
+        ("test/model-20240806", None),
+        ("test/vision-2024-08-06", "openrouter/test/vision"),
+        ("test/other", "openrouter/test/other"),
+        # Not dated versions of the requested models
+        ("test/vision-0613", "openrouter/test/vision-0613"),
+        ("test/model-1106", "openrouter/test/model-1106"),
+        ("test/model-2024", "openrouter/test/model-2024"),
+        ("test/model-2024-0806", "openrouter/test/model-2024-0806"),
+        ("test/model-20241306", "openrouter/test/model-20241306"),
+    ),
+)
+def test_fallback_model_version_suffix(cached_catalog, answered_by, resolved_model):
+    model = OpenRouterResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+    response = model.prompt("hello", options={"fallback_models": "test/vision"})
+    response.response_json = {"model": answered_by}
+
+    model._record_resolved_model(response.prompt, response)
+
+    assert response.resolved_model == resolved_model
+
+
+KEY_A = "sk-or-v1-aaaaaaaaaaaaaaaaaaaaaaa"
+KEY_B = "sk-or-v1-bbbbbbbbbbbbbbbbbbbbbbb"
+
+
+def test_key_pool_least_loaded():
+    pool = KeyPool([KEY_A, KEY_B])
+    with pool.track(KEY_A):
+        # While one key has a request in flight the other is chosen
+        assert {pool.select(reserve=False) for _ in range(4)} == {KEY_B}
+    assert {pool.select(reserve=False) for _ in range(4)} == {KEY_A, KEY_B}
+
+
+def test_key_pool_reserves_selected_keys():
+    pool = KeyPool([KEY_A, KEY_B])
+    # Prompts that select keys before any request starts are spread out
+    first, second = pool.select(), pool.select()
+    assert {first, second} == {KEY_A, KEY_B}
+    with pool.track(first):
+        # Starting the request uses up the reservation
+        assert pool.stats()[llm_openrouter.redact_key(first)]["in_flight"] == 1
+    # The other reservation lapses if its request never starts
+    pool.reservation_timeout = 0
+    assert {pool.select() for _ in range(4)} == {KEY_A, KEY_B}
+
+
+def test_key_pool_is_cached(monkeypatch, user_path):
+    monkeypatch.delenv("OPENROUTER_KEYS", raising=False)
+    assert llm_openrouter.get_key_pool() is None
+    loads = []
+    real_get_key = llm.get_key
+    monkeypatch.setattr(
+        llm, "get_key", lambda *a, **kw: loads.append(kw) or real_get_key(*a, **kw)
+    )
+    assert llm_openrouter.get_key_pool() is None
+    assert loads == []
+    (user_path / "keys.json").write_text(
+        json.dumps({"openrouter_keys": "key-a,key-b"}), encoding="utf-8"
+    )
+    pool = llm_openrouter.get_key_pool()
+    assert pool.keys == ["key-a", "key-b"]
+    assert llm_openrouter.get_key_pool() is pool
+    monkeypatch.setenv("OPENROUTER_KEYS", "key-c")
+    assert llm_openrouter.get_key_pool().keys == ["key-c"]
+
+
+def test_key_pool_round_robin():
+    pool = KeyPool(["key-a", "key-b", "key-c"], strategy="round-robin")
+    assert [pool.select() for _ in range(4)] == ["key-a", "key-b", "key-c", "key-a"]
+
+
+def test_key_pool_rests_rate_limited_keys():
+    class RateLimited(Exception):
+        status_code = 429
+        response = SimpleNamespace(headers={"retry-after": "60"})
+
+    pool = KeyPool([KEY_A, KEY_B])
+    with pytest.raises(RateLimited):
+        with pool.track(KEY_A):
+            raise RateLimited()
+
+    assert {pool.select() for _ in range(4)} == {KEY_B}
+    assert pool.stats() == {
+        "sk-or-v1-aa...aaa": {
+            "in_flight": 0,
+            "requests": 1,
+            "errors": 1,
+            "rate_limited": 1,
+            "healthy": False,
+        },
+        "sk-or-v1-bb...bbb": {
+            "in_flight": 0,
+            "requests": 0,
+            "errors": 0,
+            "rate_limited": 0,
+            "healthy": True,
+        },
+    }
+
+
+def test_models_use_key_pool(monkeypatch):
+    monkeypatch.setenv("OPENROUTER_KEYS", "key-a,key-b")
+    monkeypatch.setenv("OPENROUTER_KEYS_STRATEGY", "round-robin")
+    model = OpenRouterResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+    assert {model.get_key() for _ in range(4)} == {"key-a", "key-b"}
+    # An explicit key still takes precedence over the pool
+    assert model.get_key("key-c") == "key-c"
+
+
+def test_host_limiter_in_flight_slots_are_shared(tmpdir):
+    # Two limiters on the same directory behave like two separate processes
+    first = HostLimiter(tmpdir, max_in_flight=1)
+    second = HostLimiter(tmpdir, max_in_flight=1)
+
+    slot = first._take_slot()
+    assert slot == 0
+    assert second._take_slot() is None
+    first._release_slot(slot)
+    assert second._take_slot() == 0
+
+
+def test_host_limiter_rate_is_shared_per_key(tmpdir):
+    first = HostLimiter(tmpdir, requests=2, interval=60)
+    second = HostLimiter(tmpdir, requests=2, interval=60)
+
+    assert first._take_token("key-a") == 0
+    assert second._take_token("key-a") == 0
+    assert first._take_token("key-a") == pytest.approx(30, abs=1)
+    # Waiting requests reserve their tokens, so each waits its turn
+    assert second._take_token("key-a") == pytest.approx(60, abs=1)
+    # Other keys have their own bucket
+    assert second._take_token("key-b") == 0
+
+
+def test_host_limiter_acquire_async_waits_in_turn(tmpdir):
+    limiter = HostLimiter(tmpdir, requests=1, interval=0.1, max_in_flight=2)
+    started = []
+
+    async def request():
+        async with limiter.acquire_async("key-a"):
+            started.append(time.monotonic())
+
+    async def run():
+        await asyncio.gather(*(request() for _ in range(4)))
+
+    asyncio.run(run())
+    gaps = [later - earlier for earlier, later in zip(started, started[1:])]
+    assert all(gap == pytest.approx(0.1, abs=0.05) for gap in gaps)
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    (("40/10s", (40, 10.0)), ("100/m", (100, 60.0)), ("5/s", (5, 1.0))),
+)
+def test_parse_rate_limit(value, expected):
+    assert parse_rate_limit(value) == expected
+
+
+def test_parse_rate_limit_invalid():
+    with pytest.raises(ValueError, match="Invalid rate limit"):
+        parse_rate_limit("40 per second")
+
+
+def test_circuit_breaker_is_shared(tmpdir):
+    # Two breakers on the same directory behave like two separate processes
+    first = CircuitBreaker(tmpdir, min_requests=3, cooldown=0.2)
+    second = CircuitBreaker(tmpdir, min_requests=3, cooldown=0.2)
+
+    first.record("a/model", "Groq", failed=False)
+    second.record("a/model", "Groq", failed=True)
+    assert first.check("a/model") == (False, [])
+    first.record("a/model", "Groq", failed=True)
+    with pytest.raises(CircuitOpenError) as ex:
+        second.check("a/model")
+    assert ex.value.model == "a/model"
+    # Other models have their own circuit
+    assert second.check("b/model") == (False, [])
+
+    time.sleep(0.25)
+    # Once the cooldown is over a single request probes the model
+    assert first.check("a/model") == (True, [])
+    with pytest.raises(CircuitOpenError):
+        second.check("a/model")
+    first.record("a/model", "Groq", failed=False, probe=True)
+    assert second.check("a/model") == (False, [])
+    assert second.status()["a/model"]["circuit"]["state"] == "closed"
+    assert second.status()["a/model"]["providers"]["Groq"]["state"] == "closed"
+
+
+def test_circuit_breaker_provider_circuits(tmpdir):
+    breaker = CircuitBreaker(tmpdir, min_requests=2, cooldown=0.1)
+    for _ in range(10):
+        breaker.record("a/model", "Groq", failed=False)
+    for _ in range(2):
+        breaker.record("a/model", "Cerebras", failed=True)
+    assert breaker.check("a/model") == (False, ["Cerebras"])
+    time.sleep(0.15)
+    assert breaker.check("a/model") == (False, [])
+
+
+def test_circuit_breaker_reset_is_shared(tmpdir):
+    first = CircuitBreaker(tmpdir, min_requests=1)
+    second = CircuitBreaker(tmpdir, min_requests=1)
+    second.record("a/model", failed=True)
+    with pytest.raises(CircuitOpenError):
+        second.check("a/model")
+    first.reset()
+    assert second.check("a/model") == (False, [])
+    second.record("a/model", failed=True)
+    with pytest.raises(CircuitOpenError):
+        first.check("a/model")
+
+
+@pytest.mark.parametrize("async_", (False, True))
+@pytest.mark.parametrize("options", ({}, {"chat_completions": True}))
+def test_circuit_breaker_releases_pool_key(
+    fake_openrouter, monkeypatch, async_, options
+):
+    class OpenBreaker:
+        def check(self, model):
+            raise CircuitOpenError(model, 60)
+
+    monkeypatch.setattr(llm_openrouter, "get_circuit_breaker", OpenBreaker)
+    monkeypatch.setenv("OPENROUTER_KEYS", KEY_A)
+    model_id = "openrouter/stand-in/model-0"
+    with pytest.raises(CircuitOpenError):
+        if async_:
+            asyncio.run(llm.get_async_model(model_id).prompt("hi", **options).text())
+        else:
+            llm.get_model(model_id).prompt("hi", **options).text()
+    # The key selected for the request is not held until its reservation expires
+    assert not llm_openrouter.get_key_pool()._reservations[KEY_A]
+
+
+def test_circuit_breaker_failed_probe_reopens(tmpdir):
+    breaker = CircuitBreaker(tmpdir, min_requests=1, cooldown=0.1)
+    breaker.record("a/model", failed=True)
+    time.sleep(0.15)
+    assert breaker.check("a/model") == (True, [])
+    breaker.record("a/model", failed=True, probe=True)
+    with pytest.raises(CircuitOpenError):
+        breaker.check("a/model")
+
+
+@pytest.mark.parametrize("options", ({}, {"chat_completions": True}))
+def test_circuit_breaker_fails_fast(fake_openrouter, monkeypatch, options):
+    import openai
+
+    monkeypatch.setenv("OPENROUTER_CIRCUIT_BREAKER", "min_requests=2,cooldown=60")
+    fake_openrouter.provider = "Stand-in"
+    model = llm.get_model("openrouter/stand-in/model-0")
+    model.prompt("Say hello", stream=False, **options).text()
+
+    fake_openrouter.error_rate = 1.0
+    fake_openrouter.error_status = 503
+    fake_openrouter.retry_after = 0.01
+    with pytest.raises(openai.InternalServerError):
+        model.prompt("Say hello", **options).text()
+    sent = len(fake_openrouter.requests)
+    with pytest.raises(CircuitOpenError, match="stand-in/model-0 is failing"):
+        model.prompt("Say hello", **options).text()
+    # No request was sent
+    assert len(fake_openrouter.requests) == sent
+
+    result = CliRunner().invoke(cli, ["openrouter", "breakers"])
+    assert result.exit_code == 0, result.output
+    status = json.loads(result.output)["stand-in/model-0"]
+    assert status["circuit"]["state"] == "open"
+    # Successful streamed chats cannot say which provider served them, so
+    # failed ones are not held against their provider either
+    provider_state = "closed" if options else "open"
+    assert status["providers"]["Stand-in"]["state"] == provider_state
+    result = CliRunner().invoke(cli, ["openrouter", "breakers", "--reset"])
+    assert result.exit_code == 0, result.output
+    fake_openrouter.error_rate = 0.0
+    assert model.prompt("Say hello", **options).text()
+
+
+@pytest.mark.parametrize("async_", (False, True))
+@pytest.mark.parametrize("options", ({}, {"chat_completions": True}))
+def test_circuit_breaker_routes_around_providers(
+    fake_openrouter, monkeypatch, options, async_
+):
+    monkeypatch.setenv("OPENROUTER_CIRCUIT_BREAKER", "min_requests=2")
+    breaker = llm_openrouter.get_circuit_breaker()
+    for _ in range(10):
+        breaker.record("stand-in/model-0", failed=False)
+    for _ in range(2):
+        breaker.record("stand-in/model-0", "Groq", failed=True)
+    if async_:
+        model = llm.get_async_model("openrouter/stand-in/model-0")
+        response = model.prompt("Say hello", provider={"order": ["Groq"]}, **options)
+        asyncio.run(response.text())
+    else:
+        model = llm.get_model("openrouter/stand-in/model-0")
+        model.prompt("Say hello", provider={"order": ["Groq"]}, **options).text()
+    method, path, body = fake_openrouter.requests[-1]
+    assert body["provider"] == {"order": ["Groq"], "ignore": ["Groq"]}
+
+
+def test_circuit_breaker_ignores_request_errors(fake_openrouter, monkeypatch):
+    import openai
+
+    monkeypatch.setenv("OPENROUTER_CIRCUIT_BREAKER", "min_requests=1")
+    fake_openrouter.error_rate = 1.0
+    fake_openrouter.error_status = 400
+    model = llm.get_async_model("openrouter/stand-in/model-0")
+    for _ in range(2):
+        with pytest.raises(openai.BadRequestError):
+            asyncio.run(model.prompt("Say hello").text())
+
+
+def test_parse_circuit_breaker():
+    assert parse_circuit_breaker("1") == {}
+    assert parse_circuit_breaker("min_requests=10, slow=2.5") == {
+        "min_requests": 10.0,
+        "slow": 2.5,
+    }
+    with pytest.raises(ValueError, match="Invalid circuit breaker setting"):
+        parse_circuit_breaker("threshold=3")
+
+
+class FakeResponsesAPI:
+    def __init__(self, events, delay=0.0):
+        self.events = events
+        self.delay = delay
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.delay)
+        return self._stream()
+
+    async def _stream(self):
+        for event in self.events:
+            await asyncio.sleep(self.delay)
+            yield event
+
+
+def text_stream_events(text, model="test/model"):
+    final_response = SimpleNamespace(
+        output=[],
+        model_dump=lambda warnings=False: {
+            "model": model,
+            "output": [],
+            "usage": {"input_tokens": 3, "output_tokens": 1},
+        },
+    )
+    return [
+        SimpleNamespace(
+            type="response.output_item.added", item=SimpleNamespace(type="message")
+        ),
+        SimpleNamespace(type="response.output_text.delta", delta=text),
+        SimpleNamespace(type="response.completed", response=final_response),
+    ]
+
+
+@pytest.fixture
+def fake_responses_api(monkeypatch):
+    api = FakeResponsesAPI(text_stream_events("Hello"), delay=0.01)
+    client = SimpleNamespace(responses=api, base_url="https://openrouter.ai/api/v1")
+    monkeypatch.setattr(
+        openai_models._Shared, "get_client", lambda self, key, async_=False: client
+    )
+    return api
+
+
+@pytest.mark.parametrize("coalesce", (True, False))
+def test_coalesce_identical_requests(fake_responses_api, coalesce):
+    model = OpenRouterAsyncResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+
+    async def run():
+        responses = [
+            model.prompt("hello", options={"coalesce": coalesce}) for _ in range(3)
+        ]
+        return await asyncio.gather(*(response.text() for response in responses))
+
+    assert asyncio.run(run()) == ["Hello", "Hello", "Hello"]
+    assert len(fake_responses_api.calls) == (1 if coalesce else 3)
+    assert "_coalesce" not in fake_responses_api.calls[0]
+
+
+@pytest.mark.parametrize("keys", ((KEY_A,), (KEY_A, KEY_B)))
+def test_coalesce_guards_the_shared_request_once(fake_responses_api, monkeypatch, keys):
+    from contextlib import asynccontextmanager
+
+    class CountingLimiter:
+        acquired = 0
+
+        @asynccontextmanager
+        async def acquire_async(self, key):
+            self.acquired += 1
+            yield
+
+    limiter = CountingLimiter()
+    monkeypatch.setattr(llm_openrouter, "get_host_limiter", lambda: limiter)
+    monkeypatch.setenv("OPENROUTER_KEYS", ",".join(keys))
+    # Each request is given a different key when there are several
+    monkeypatch.setenv("OPENROUTER_KEYS_STRATEGY", "round-robin")
+    model = OpenRouterAsyncResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+
+    async def run():
+        responses = [
+            model.prompt("hello", options={"coalesce": True}) for _ in range(3)
+        ]
+        return await asyncio.gather(*(response.text() for response in responses))
+
+    assert asyncio.run(run()) == ["Hello", "Hello", "Hello"]
+    assert len(fake_responses_api.calls) == 1
+    assert limiter.acquired == 1
+    pool = llm_openrouter.get_key_pool()
+    stats = pool.stats()
+    assert sum(stats[llm_openrouter.redact_key(key)]["requests"] for key in keys) == 1
+    # Every key selected by the requests that shared it was released
+    assert not any(pool._reservations[key] for key in keys)
+
+
+def test_coalesce_cancels_request_without_readers(fake_responses_api):
+    fake_responses_api.delay = 0.2
+    model = OpenRouterAsyncResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+
+    async def run():
+        tasks = [
+            asyncio.create_task(
+                model.prompt("hello", options={"coalesce": True}).text()
+            )
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.05)
+        (shared,) = llm_openrouter._in_flight_requests.values()
+        tasks[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not shared.task.done()
+        tasks[1].cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        return shared
+
+    shared = asyncio.run(run())
+    assert shared.task.cancelled()
+    assert not llm_openrouter._in_flight_requests
+
+
+def test_coalesce_only_shares_identical_payloads(fake_responses_api):
+    model = OpenRouterAsyncResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+
+    async def run():
+        responses = [
+            model.prompt(prompt, options={"coalesce": True})
+            for prompt in ("hello", "hello", "goodbye")
+        ]
+        return await asyncio.gather(*(response.text() for response in responses))
+
+    asyncio.run(run())
+    assert len(fake_responses_api.calls) == 2
+
+
+@pytest.mark.parametrize(
+    "model_class", (OpenRouterResponses, OpenRouterAsyncResponses)
+)
+def test_attachments_are_encoded_once(model_class, tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        llm_openrouter, "attachment_cache", llm_openrouter._AttachmentCache(10_000)
+    )
+    # A small read size exercises chunked encoding of files
+    monkeypatch.setattr(llm_openrouter, "_READ_CHUNK_SIZE", 9)
+    pdf_path = tmpdir / "doc.pdf"
+    pdf_path.write_binary(b"%PDF-1.4 pretend pdf content")
+    model = model_class(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+        vision=True,
+    )
+
+    def build():
+        response = model.prompt(
+            "describe",
+            attachments=[
+                llm.Attachment(content=TINY_PNG),
+                llm.Attachment(path=str(pdf_path)),
+            ],
+        )
+        items, _ = model._build_responses_input(response.prompt)
+        return items[0]["content"]
+
+    first = build()
+    assert first[1]["image_url"] == "data:image/png;base64," + base64.b64encode(
+        TINY_PNG
+    ).decode("ascii")
+    assert first[2]["file_data"] == (
+        "data:application/pdf;base64,JVBERi0xLjQgcHJldGVuZCBwZGYgY29udGVudA=="
+    )
+    second = build()
+    assert second == first
+    # The encoded image is reused rather than encoded again
+    assert second[1]["image_url"] is first[1]["image_url"]
+    encoded = first[1]["image_url"] + "JVBERi0xLjQgcHJldGVuZCBwZGYgY29udGVudA=="
+    overhead = 2 * llm_openrouter._AttachmentCache.entry_overhead
+    assert llm_openrouter.attachment_cache.size == len(encoded) + overhead
+
+
+def test_path_hashes_are_bounded(tmpdir, monkeypatch):
+    # Room for two hashes
+    path_hashes = llm_openrouter._AttachmentCache(max_size=400)
+    monkeypatch.setattr(llm_openrouter, "_path_hashes", path_hashes)
+    for i in range(3):
+        content = "content {}".format(i).encode()
+        path = tmpdir / "{}.txt".format(i)
+        path.write_binary(content)
+        digest = llm_openrouter._attachment_id(llm.Attachment(path=str(path)))
+        assert digest == hashlib.sha256(content).hexdigest()
+    assert len(path_hashes._items) == 2
+
+
+def test_attachment_cache_evicts_least_recently_used():
+    # Each entry counts as 100 bytes more than its value
+    cache = llm_openrouter._AttachmentCache(max_size=210)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    assert cache.get("a") == "aaaa"
+    cache.set("c", "cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.size == 208
+    # Values larger than the whole cache are never stored
+    cache.set("d", "d" * 111)
+    assert cache.get("d") is None
+
+
+def test_image_max_edge_downscales_images(tmpdir, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    import io
+
+    monkeypatch.setattr(
+        llm_openrouter, "attachment_cache", llm_openrouter._AttachmentCache(10**7)
+    )
+    image_path = str(tmpdir / "large.png")
+    Image.effect_noise((2000, 1000), 64).convert("RGB").save(image_path)
+    downscale = llm_openrouter._downscale_image
+    downscaled = []
+    monkeypatch.setattr(
+        llm_openrouter,
+        "_downscale_image",
+        lambda *args: downscaled.append(args) or downscale(*args),
+    )
+    model = OpenRouterResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+        vision=True,
+    )
+
+    def build():
+        response = model.prompt(
+            "describe",
+            attachments=[
+                llm.Attachment(path=image_path),
+                llm.Attachment(content=TINY_PNG),
+            ],
+            image_max_edge=500,
+        )
+        items, _ = model._build_responses_input(response.prompt)
+        return items[0]["content"]
+
+    first = build()
+    prefix = "data:image/jpeg;base64,"
+    assert first[1]["image_url"].startswith(prefix)
+    resized = Image.open(
+        io.BytesIO(base64.b64decode(first[1]["image_url"][len(prefix) :]))
+    )
+    assert resized.size == (500, 250)
+    # Images that already fit are sent unchanged
+    assert first[2]["image_url"] == "data:image/png;base64," + base64.b64encode(
+        TINY_PNG
+    ).decode("ascii")
+    # The downscaled image is cached by content hash and size, as is the
+    # decision to send the small image unchanged
+    assert build()[1]["image_url"] is first[1]["image_url"]
+    assert len(downscaled) == 2
+
+
+def test_shell_container_pool(tmpdir, monkeypatch):
+    pool = llm_openrouter.ShellContainerPool(tmpdir / "containers.json", max_size=2)
+    monkeypatch.setattr(llm_openrouter.time, "time", lambda: 1000)
+    pool.checkin("a", "cntr_1", 2000)
+    pool.checkin("a", "cntr_2", 2000)
+    pool.checkin("a", "cntr_3", 2000)
+    # Expiring within the safety margin
+    pool.checkin("b", "cntr_4", 1010)
+    assert pool.checkout("b") is None
+    assert pool.checkout("a") == ("cntr_3", 2000)
+    assert pool.checkout("a") == ("cntr_2", 2000)
+    # Only the two most recent containers are kept
+    assert pool.checkout("a") is None
+
+
+def test_shell_reuse_container(fake_responses_api):
+    shell_call = {
+        "id": "sh_1",
+        "type": "shell_call",
+        "call_id": "shell_call_1",
+        "action": {"commands": ["ls"]},
+        "environment": {"type": "container_reference", "container_id": "cntr_1"},
+    }
+    events = text_stream_events("Done")
+    events[-1].response.model_dump = lambda warnings=False: {
+        "model": "test/model",
+        "output": [shell_call],
+    }
+    fake_responses_api.events = events
+    model = OpenRouterAsyncResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+
+    async def run():
+        for _ in range(2):
+            response = model.prompt(
+                "list files",
+                tools=[Shell(sleep_after_seconds=300, reuse_container=True)],
+            )
+            await response.text()
+
+    asyncio.run(run())
+    first, second = (call["tools"][0] for call in fake_responses_api.calls)
+    assert first == {
+        "type": "openrouter:shell",
+        "parameters": {"sleep_after_seconds": 300},
+    }
+    assert second == {
+        "type": "openrouter:shell",
+        "parameters": {
+            "environment": {"type": "container_reference", "container_id": "cntr_1"},
+            "sleep_after_seconds": 300,
+        },
+    }
+    with pytest.raises(ValueError, match="reuse_container"):
+        Shell(environment=shell_call["environment"], reuse_container=True)
+
+
+def test_shell_containers_are_checked_in_for_each_tool(monkeypatch):
+    checked_in = []
+    pool = SimpleNamespace(checkin=lambda *args: checked_in.append(args))
+    monkeypatch.setattr(llm_openrouter, "get_shell_container_pool", lambda: pool)
+    monkeypatch.setattr(llm_openrouter.time, "time", lambda: 1000)
+    warm = Shell(sleep_after_seconds=300, reuse_container=True).pool_key("sk")
+    cold = Shell(sleep_after_seconds=0, reuse_container=True).pool_key("sk")
+    auto = Shell(reuse_container=True).pool_key("sk")
+    idle = Shell(sleep_after_seconds=60, reuse_container=True).pool_key("sk")
+    response = SimpleNamespace(
+        response_json={
+            "output": [
+                {
+                    "type": "shell_call",
+                    "environment": {
+                        "type": "container_reference",
+                        "container_id": "cntr_warm",
+                    },
+                },
+                {"type": "shell_call_output", "container_id": "cntr_new"},
+            ]
+        }
+    )
+    model = OpenRouterResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+    model._checkin_shell_containers(
+        response,
+        [
+            (warm, "cntr_warm", 1200),
+            (cold, None, None),
+            (auto, None, None),
+            (idle, "cntr_idle", 1500),
+        ],
+    )
+    assert checked_in == [
+        (warm, "cntr_warm", 1300),
+        # sleep_after_seconds=0 is not the default lifetime
+        (cold, "cntr_new", 1000),
+        (idle, "cntr_idle", 1500),
+    ]
+
+
+def test_shell_pool_key_includes_environment():
+    auto = Shell(reuse_container=True)
+    configured = Shell(
+        environment={"type": "container_auto", "file_ids": ["file_1"]},
+        reuse_container=True,
+    )
+    assert auto.pool_key("key") != configured.pool_key("key")
+    reused = configured.with_container("cntr_1")
+    assert reused.environment == {
+        "type": "container_reference",
+        "container_id": "cntr_1",
+    }
+    assert reused.pool_key("key") == configured.pool_key("key")
+
+
+@pytest.mark.parametrize("async_", (False, True))
+def test_shell_containers_return_to_pool_on_error(fake_openrouter, async_):
+    import openai
+
+    tool = Shell(reuse_container=True)
+    pool = llm_openrouter.get_shell_container_pool()
+    pool_key = tool.pool_key(llm.get_key("", "openrouter", "OPENROUTER_KEY"))
+    pool.checkin(pool_key, "cntr_1", time.time() + 600)
+    fake_openrouter.error_rate = 1.0
+    fake_openrouter.error_status = 400
+    with pytest.raises(openai.BadRequestError):
+        if async_:
+            model = llm.get_async_model("openrouter/stand-in/model-0")
+            asyncio.run(model.prompt("list files", tools=[tool]).text())
+        else:
+            model = llm.get_model("openrouter/stand-in/model-0")
+            model.prompt("list files", tools=[tool]).text()
+    body = fake_openrouter.requests[-1][2]
+    assert body["tools"][0]["parameters"]["environment"]["container_id"] == "cntr_1"
+    assert pool.checkout(pool_key)[0] == "cntr_1"
+
+
+@pytest.mark.parametrize(
+    "options,stream",
+    (
+        ({}, True),
+        ({}, False),
+        ({"chat_completions": True}, True),
+        ({"chat_completions": True}, False),
+    ),
+)
+def test_fake_openrouter(fake_openrouter, options, stream):
+    model_ids = [model.model_id for model in llm.get_models()]
+    assert "openrouter/stand-in/model-19" in model_ids
+    model = llm.get_model("openrouter/stand-in/model-0")
+    response = model.prompt("Say hello", stream=stream, **options)
+    assert response.text() == (
+        "the quick brown pelican glides over calm water while a curious heron "
+        "watches from the reeds and the evening light"
+    )
+    assert response.usage().output == 20
+    method, path, body = fake_openrouter.requests[-1]
+    assert path == "/api/v1/" + ("chat/completions" if options else "responses")
+    assert body["model"] == "stand-in/model-0"
+
+
+def test_fake_openrouter_error_injection(fake_openrouter):
+    import openai
+
+    fake_openrouter.error_rate = 1.0
+    fake_openrouter.retry_after = 0.01
+    model = llm.get_async_model("openrouter/stand-in/model-0")
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(model.prompt("Say hello").text())
+    # The OpenAI client retried twice after the first 429
+    assert sum(1 for method, *_ in fake_openrouter.requests if method == "POST") == 3
+
+
+def test_benchmarks_run(capsys):
+    from benchmarks import compare, run_benchmarks
+
+    results = run_benchmarks(quick=True)
+    names = [result["name"] for result in results["benchmarks"]]
+    assert names == [
+        "register_models[20]",
+        "fetch_cached_json_hit[20]",
+        "build_responses_input[5 turns]",
+        "server_tool_events[30 items]",
+        "refresh_server_tool_events[30 items]",
+        "stream_responses[50 tokens]",
+        "stream_chat_completions[50 tokens]",
+    ]
+    assert all(result["median"] > 0 for result in results["benchmarks"])
+    slower = deepcopy(results)
+    slower["benchmarks"][0]["median"] *= 2
+    assert compare(results, slower, threshold=1.25) == ["register_models[20]"]
+
+
+def test_bench_command(fake_openrouter):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "openrouter",
+            "bench",
+            "-m",
+            "stand-in/model-0",
+            "--provider",
+            "groq",
+            "-p",
+            "hi",
+            "-n",
+            "3",
+            "-o",
+            "provider",
+            '{"sort": "throughput"}',
+            "--json",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    (summary,) = json.loads(result.output)
+    assert summary["model"] == "openrouter/stand-in/model-0"
+    assert summary["provider"] == "groq"
+    assert (summary["runs"], summary["errors"]) == (3, 0)
+    assert summary["ttft_p50"] <= summary["latency_p50"]
+    assert summary["cost_per_1k_output_tokens"] > 0
+    bodies = [body for method, _, body in fake_openrouter.requests if body]
+    assert len(bodies) == 3
+    assert all(
+        body["provider"]
+        == {"sort": "throughput", "order": ["groq"], "allow_fallbacks": False}
+        for body in bodies
+    )
+
+    result = runner.invoke(
+        cli,
+        ["openrouter", "bench", "-m", "stand-in/model-0", "--provider", "groq"]
+        + ["-o", "provider", '{"only": ["together"]}'],
+    )
+    assert result.exit_code == 1
+    assert "cannot set only when benchmarking providers" in result.stderr
+
+    fake_openrouter.error_rate = 1.0
+    fake_openrouter.retry_after = 0.01
+    result = runner.invoke(cli, ["openrouter", "bench", "-m", "stand-in/model-0"])
+    assert result.exit_code == 0, result.output
+    assert "9 (100%)" in result.output.splitlines()[1]
+
+
+def test_bench_tokens_per_second(fake_openrouter):
+    fake_openrouter.tokens_per_second = 200
+    (record,) = asyncio.run(llm_openrouter.bench(["stand-in/model-0"], ["hi"]))
+    assert record["error"] is None
+    # Tokens after the first, over the time since the first arrived
+    assert record["tokens_per_second"] == pytest.approx(
+        (record["output_tokens"] - 1) / (record["latency"] - record["ttft"])
+    )
+
+
+def test_percentile():
+    assert llm_openrouter._percentile([], 50) is None
+    assert llm_openrouter._percentile([3, 1, 2], 50) == 2
+    assert llm_openrouter._percentile([1, 2, 3, 4], 90) == pytest.approx(3.7)
+
+
+def test_serve_proxy(fake_openrouter, user_path, monkeypatch):
+    import os
+    import threading
+
+    import httpx
+
+    proxy = llm_openrouter.ServeProxy()
+    threading.Thread(target=proxy.serve_forever, args=(0.05,), daemon=True).start()
+    (user_path / "openrouter-serve.json").write_text(
+        json.dumps(
+            {
+                "pid": os.getpid(),
+                "api_base": proxy.api_base,
+                "upstream": fake_openrouter.api_base,
+            }
+        ),
+        encoding="utf-8",
+    )
+    try:
+        model = llm.get_model("openrouter/stand-in/model-0")
+        assert str(model.get_client("sk-or-test").base_url) == proxy.api_base + "/"
+        for options in ({}, {"chat_completions": True}):
+            assert model.prompt("hi", **options).text().startswith("the quick brown")
+        # The catalog is served from memory
+        catalog_requests = len(fake_openrouter.requests)
+        assert len(httpx.get(proxy.api_base + "/models").json()["data"]) == 20
+        assert len(fake_openrouter.requests) == catalog_requests
+        # Other clients can use llm's model IDs
+        response = httpx.post(
+            proxy.api_base + "/chat/completions",
+            json={"model": "openrouter/stand-in/model-1", "messages": []},
+            headers={"Authorization": "Bearer sk-or-test"},
+        )
+        assert response.json()["model"] == "stand-in/model-1"
+        monkeypatch.setenv("OPENROUTER_SERVE", "0")
+        assert str(model.get_client("sk-or-test").base_url) == (
+            fake_openrouter.api_base + "/"
+        )
+    finally:
+        proxy.shutdown()
+
+
+def test_serve_proxy_forwards_compressed_responses(fake_openrouter):
+    import threading
+
+    import httpx
+
+    fake_openrouter.gzip = True
+    proxy = llm_openrouter.ServeProxy(fake_openrouter.api_base)
+    threading.Thread(target=proxy.serve_forever, args=(0.05,), daemon=True).start()
+    try:
+        response = httpx.post(
+            proxy.api_base + "/chat/completions",
+            json={"model": "stand-in/model-1", "messages": []},
+            headers={"Authorization": "Bearer sk-or-test"},
+        )
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json()["model"] == "stand-in/model-1"
+    finally:
+        proxy.shutdown()
+
+
+def test_serve_api_base_is_cached(user_path, monkeypatch):
+    import os
+
+    state_path = user_path / "openrouter-serve.json"
+    state_path.write_text(
+        json.dumps(
+            {
+                "pid": os.getpid(),
+                "api_base": "http://127.0.0.1:1/api/v1",
+                "upstream": llm_openrouter.get_api_base(),
+            }
+        ),
+        encoding="utf-8",
+    )
+    kills = []
+    monkeypatch.setattr(os, "kill", lambda *args: kills.append(args))
+    for _ in range(3):
+        assert llm_openrouter.get_serve_api_base() == "http://127.0.0.1:1/api/v1"
+    assert len(kills) <= 1
+    state_path.remove()
+    assert llm_openrouter.get_serve_api_base() is None
+
+
+def test_import_time():
+    # Heavy dependencies such as httpx are imported when they are used, so
+    # loading the plugin adds nothing to llm's own startup but this module
+    import os
+    import subprocess
+    import sys
+
+    code = (
+        "import llm, llm.cli, llm.default_plugins.openai_models; "
+        "import llm_openrouter"
+    )
+    env = {**os.environ, "LLM_LOAD_PLUGINS": ""}
+    # The first run compiles the module, which is not being measured
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    lines = [
+        line.split("|")
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:") and "[us]" not in line
+    ]
+    index = next(
+        i for i, (_, _, name) in enumerate(lines) if name.strip() == "llm_openrouter"
+    )
+
+    def depth(name):
+        return len(name) - len(name.lstrip())
+
+    imported = []
+    for _, _, name in reversed(lines[:index]):
+        if depth(name) <= depth(lines[index][2]):
+            break
+        imported.append(name.strip())
+    assert imported == []
+    assert int(lines[index][1]) < 100_000
+
+
+def test_models_share_options_class():
+    first, second = (
+        OpenRouterResponses(
+            model_id="openrouter/test/{}".format(name),
+            model_name="test/{}".format(name),
+            api_base="https://openrouter.ai/api/v1",
+        )
+        for name in ("one", "two")
+    )
+    assert first.Options is second.Options
+
+
+@pytest.mark.parametrize("async_", (False, True))
+def test_tracing(fake_openrouter, tmp_path, monkeypatch, async_):
+    trace_path = tmp_path / "trace.jsonl"
+    monkeypatch.setenv("OPENROUTER_TRACE", str(trace_path))
+    if async_:
+        model = llm.get_async_model("openrouter/stand-in/model-0")
+        response = model.prompt("hi", tools=[Shell()], provider={"order": ["exa"]})
+        asyncio.run(response.text())
+    else:
+        model = llm.get_model("openrouter/stand-in/model-0")
+        response = model.prompt("hi", tools=[Shell()], provider={"order": ["exa"]})
+        response.text()
+    spans = [json.loads(line) for line in trace_path.read_text().splitlines()]
+    by_name = {span["name"]: span for span in spans}
+    assert set(by_name) == {
+        "openrouter.build_input",
+        "openrouter.build_kwargs",
+        "openrouter.http.connect",
+        "openrouter.http.first_byte",
+        "openrouter.server_tool",
+        "openrouter.completion",
+        "openrouter.request",
+    }
+    request = by_name["openrouter.request"]
+    assert request["parent_id"] is None
+    assert {span["trace_id"] for span in spans} == {request["trace_id"]}
+    assert all(
+        span["parent_id"] == request["span_id"] for span in spans if span != request
+    )
+    assert request["attributes"]["llm.model_id"] == "openrouter/stand-in/model-0"
+    assert request["attributes"]["openrouter.provider"] == "exa"
+    assert request["attributes"]["openrouter.generation_id"].startswith("resp")
+    assert request["attributes"]["openrouter.output_tokens"] == 20
+    assert by_name["openrouter.http.first_byte"]["attributes"] == {
+        "http.status_code": 200
+    }
+    assert by_name["openrouter.server_tool"]["attributes"]["openrouter.tool_name"] == (
+        "shell"
+    )
+    assert request["error"] is None
+
+
+def test_tracing_disabled(monkeypatch):
+    monkeypatch.delenv("OPENROUTER_TRACE", raising=False)
+    assert llm_openrouter.get_tracer() is None
+    model = OpenRouterResponses(
+        model_id="openrouter/test/model",
+        model_name="test/model",
+        api_base="https://openrouter.ai/api/v1",
+    )
+    assert "http_client" not in repr(vars(model.get_client("sk-or-test")))
+
+
+def test_metrics(fake_openrouter, monkeypatch):
+    import socket
+
+    import openai
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(5)
+    registry = llm_openrouter.Metrics()
+    monkeypatch.setattr(llm_openrouter, "metrics", registry)
+    monkeypatch.setenv(
+        "OPENROUTER_STATSD", "127.0.0.1:{}".format(receiver.getsockname()[1])
+    )
+    model_id = "openrouter/stand-in/model-0"
+    llm.get_model(model_id).prompt("hi").text()
+    asyncio.run(
+        llm.get_async_model(model_id).prompt("hi", chat_completions=True).text()
+    )
+    fake_openrouter.error_rate = 1.0
+    fake_openrouter.retry_after = 0.01
+    with pytest.raises(openai.RateLimitError):
+        llm.get_model(model_id).prompt("hi", provider={"order": ["groq"]}).text()
+
+    assert registry.get("openrouter_requests_total", model=model_id) == 2
+    assert registry.get("openrouter_in_flight", model=model_id) == 0
+    assert registry.get("openrouter_output_tokens_total", model=model_id) == 40
+    assert registry.get("openrouter_cost_total", model=model_id) > 0
+    duration = registry.get("openrouter_request_duration_seconds", model=model_id)
+    assert duration["count"] == duration["+Inf"] == 2
+    assert (
+        registry.get("openrouter_time_to_first_token_seconds", model=model_id)["count"]
+        == 2
+    )
+    groq = {"model": model_id, "provider": "groq"}
+    assert registry.get("openrouter_errors_total", status="429", **groq) == 1
+    assert registry.get("openrouter_retries_total", **groq) == 2
+
+    text = registry.prometheus_text()
+    assert "# TYPE openrouter_request_duration_seconds histogram" in text
+    assert (
+        'openrouter_requests_total{{model="{}",provider="groq"}} 1'.format(model_id)
+        in text
+    )
+    assert (
+        'openrouter_request_duration_seconds_bucket{{model="{}",provider="",le="+Inf"}} 2'.format(
+            model_id
+        )
+        in text
+    )
+
+    packets = [receiver.recv(4096).decode() for _ in range(3)]
+    assert packets[0].splitlines()[0] == (
+        "openrouter.requests:1|c|#model:{},provider:".format(model_id)
+    )
+    assert "openrouter.output_tokens:20|c|#model:" in packets[0]
+    assert (
+        "openrouter.errors:1|c|#model:{},provider:groq,status:429".format(model_id)
+        in packets[2]
+    )
+
+
+def test_observed_http_client_shared(fake_openrouter, monkeypatch):
+    monkeypatch.setattr(llm_openrouter, "metrics", llm_openrouter.Metrics())
+    monkeypatch.setattr(llm_openrouter, "_observed_http_clients", {})
+    monkeypatch.setenv("OPENROUTER_METRICS", "1")
+    model_id = "openrouter/stand-in/model-0"
+    llm.get_model(model_id).prompt("hi").text()
+    llm.get_model(model_id).prompt("hi").text()
+    assert len(llm_openrouter._observed_http_clients) == 1
+    sync_client = llm_openrouter._observed_http_clients[None][1]
+
+    async def run():
+        model = llm.get_async_model(model_id)
+        await model.prompt("hi", chat_completions=True).text()
+        await model.prompt("hi", chat_completions=True).text()
+
+    asyncio.run(run())
+    asyncio.run(run())
+    # One async client per event loop, the closed loop's one dropped
+    assert len(llm_openrouter._observed_http_clients) == 2
+    assert llm_openrouter._observed_http_clients[None][1] is sync_client
+    assert llm_openrouter._current_request_metrics.get() is None
+    requests = llm_openrouter.metrics.get("openrouter_requests_total", model=model_id)
+    assert requests == 6
+
+
+def test_metrics_served_by_provider(fake_openrouter, monkeypatch):
+    registry = llm_openrouter.Metrics()
+    monkeypatch.setattr(llm_openrouter, "metrics", registry)
+    monkeypatch.setenv("OPENROUTER_METRICS", "1")
+    fake_openrouter.provider = "Groq"
+    model_id = "openrouter/stand-in/model-0"
+    llm.get_model(model_id).prompt("hi", stream=False).text()
+    asyncio.run(
+        llm.get_async_model(model_id)
+        .prompt("hi", stream=False, chat_completions=True)
+        .text()
+    )
+    # Started and finished under the same labels
+    assert registry.get("openrouter_in_flight", model=model_id) == 0
+    assert registry.get("openrouter_requests_total", model=model_id) == 2
+    duration = registry.get("openrouter_request_duration_seconds", model=model_id)
+    assert duration["count"] == 2
+    assert registry.get("openrouter_in_flight", model=model_id, provider="Groq") is None
+    served = registry.get("openrouter_served_total", model=model_id, served_by="Groq")
+    assert served == 2
+
+
+def test_metrics_server(monkeypatch):
+    import httpx
+
+    registry = llm_openrouter.Metrics()
+    monkeypatch.setattr(llm_openrouter, "metrics", registry)
+    registry.request_started("openrouter/test/model", None)
+    server = llm_openrouter.start_metrics_server(port=0)
+    try:
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        response = httpx.get(url + "/metrics")
+        assert 'openrouter_in_flight{model="openrouter/test/model",provider=""} 1' in (
+            response.text
+        )
+        assert httpx.get(url + "/other").status_code == 404
+    finally:
+        server.shutdown()
+
+
+def test_generation_stats_collector(fake_openrouter, user_path, monkeypatch):
+    import time
+
+    import sqlite_utils
+
+    fake_openrouter.generation_delay = 3600
+    db_path = str(user_path / "logs.db")
+    # Left pending by an earlier process that exited
+    sqlite_utils.Database(db_path)["openrouter_generations"].insert(
+        {"id": "gen_missing", "status": "pending", "attempts": 0}, pk="id"
+    )
+    collector = llm_openrouter.GenerationStatsCollector(
+        db_path, fake_openrouter.api_base, max_attempts=4, initial_delay=0.05
+    )
+    monkeypatch.setattr(
+        llm_openrouter, "get_generation_stats_collector", lambda: collector
+    )
+    model = llm.get_model("openrouter/stand-in/model-0")
+    responses = [
+        model.prompt("hi"),
+        model.prompt("hi", chat_completions=True),
+        model.prompt("hi", chat_completions=True, stream=False),
+    ]
+    generation_ids = [response.json()["id"] for response in responses]
+
+    def lookups():
+        return [
+            path
+            for method, path, _ in fake_openrouter.requests
+            if path.startswith("/api/v1/generation")
+        ]
+
+    # Make the stats available once every generation has had a failed lookup
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and not all(
+        "/api/v1/generation?id={}".format(generation_id) in lookups()
+        for generation_id in [*generation_ids, "gen_missing"]
+    ):
+        time.sleep(0.01)
+    fake_openrouter.generation_delay = 0
+    collector.wait(timeout=10)
+
+    rows = {
+        row["id"]: row
+        for row in sqlite_utils.Database(db_path)["openrouter_generations"].rows
+    }
+    assert set(rows) == {"gen_missing", *generation_ids}
+    for generation_id in generation_ids:
+        row = rows[generation_id]
+        assert row["status"] == "done"
+        # The first lookups came before the stats were ready
+        assert row["attempts"] > 1
+        assert row["provider_name"] == "Stand-in"
+        assert row["native_tokens_completion"] == 20
+        assert row["total_cost"] > 0
+        assert json.loads(row["stats"])["id"] == generation_id
+    assert rows["gen_missing"]["status"] == "failed"
+    assert rows["gen_missing"]["attempts"] == 4
+    assert rows["gen_missing"]["error"].startswith("HTTP 404")
+
+
+def test_generation_stats_collector_resumes_with_pool_keys(
+    fake_openrouter, user_path, monkeypatch, caplog
+):
+    import sqlite3
+
+    import sqlite_utils
+
+    monkeypatch.setenv("OPENROUTER_KEYS", "sk-pool-1,sk-pool-2")
+    db_path = str(user_path / "logs.db")
+    key_hash = llm_openrouter._key_hash
+    sqlite_utils.Database(db_path)["openrouter_generations"].insert_all(
+        [
+            {"id": "gen_pool", "status": "pending", "key_hash": key_hash("sk-pool-2")},
+            {"id": "gen_gone", "status": "pending", "key_hash": key_hash("sk-old")},
+            {"id": "gen_done", "status": "done", "key_hash": key_hash("sk-pool-1")},
+        ],
+        pk="id",
+    )
+    collector = llm_openrouter.GenerationStatsCollector(
+        db_path, fake_openrouter.api_base
+    )
+    spawned = []
+    monkeypatch.setattr(collector, "_spawn", lambda *args: spawned.append(args))
+    collector._resume_pending()
+    # Keys no longer configured fall back to the default key
+    assert sorted(spawned) == [("gen_gone", "sk-...", 0), ("gen_pool", "sk-pool-2", 0)]
+
+    def locked():
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(collector, "_table", locked)
+    collector._write("gen_pool", "done", 1)
+    assert "Could not save generation stats for gen_pool" in caplog.text
+
+
+def test_generation_stats_collector_flushes_at_exit(fake_openrouter, user_path):
+    import sqlite_utils
+
+    db_path = str(user_path / "logs.db")
+    rows = sqlite_utils.Database(db_path)["openrouter_generations"]
+    response = llm.get_model("openrouter/stand-in/model-0").prompt("hi")
+    generation_id = response.json()["id"]
+    collector = llm_openrouter.GenerationStatsCollector(
+        db_path, fake_openrouter.api_base, initial_delay=5
+    )
+    collector.submit(generation_id, "sk-...")
+    collector.submit("gen_unknown", "sk-...")
+    # What atexit runs: it saves the lookups for the next process to resume,
+    # without waiting for them
+    start = time.monotonic()
+    collector._flush()
+    assert time.monotonic() - start < 1
+    assert rows.get(generation_id)["status"] == "pending"
+    assert rows.get("gen_unknown")["key_hash"] == llm_openrouter._key_hash("sk-...")
+
+    # Waiting is opt-in
+    collector = llm_openrouter.GenerationStatsCollector(
+        db_path,
+        fake_openrouter.api_base,
+        initial_delay=0.2,
+        max_attempts=1,
+        exit_timeout=5,
+    )
+    collector.submit(generation_id, "sk-...")
+    collector._flush()
+    assert rows.get(generation_id)["status"] == "done"
+
+
+def test_generation_stats_collector_is_opt_in(user_path, monkeypatch):
+    monkeypatch.delenv("OPENROUTER_GENERATION_STATS", raising=False)
+    assert llm_openrouter.get_generation_stats_collector() is None
+    monkeypatch.setenv("OPENROUTER_GENERATION_STATS", "1")
+    collector = llm_openrouter.get_generation_stats_collector()
+    assert collector.db_path == user_path / "logs.db"
+    assert collector is llm_openrouter.get_generation_stats_collector()
+
+
+def test_aget_openrouter_models(fake_openrouter, user_path):
+    async def run():
+        return await asyncio.gather(
+            *(llm_openrouter.aget_openrouter_models(skip_cache=True) for _ in range(5))
+        )
+
+    results = asyncio.run(run())
+    assert [len(models) for models in results] == [20] * 5
+    # The concurrent calls shared one download
+    catalog_requests = [
+        path for method, path, _ in fake_openrouter.requests if path == "/api/v1/models"
+    ]
+    assert len(catalog_requests) == 1
+    # Later calls use the cache, and match the synchronous version
+    models = asyncio.run(llm_openrouter.aget_openrouter_models())
+    assert models == llm_openrouter.get_openrouter_models()
+    assert len(fake_openrouter.requests) == 1
+
+    # Each caller gets a copy it can change without affecting the others
+    models[0]["id"] = "changed"
+    assert llm_openrouter.get_openrouter_models()[0]["id"] != "changed"
+    assert asyncio.run(llm_openrouter.aget_openrouter_models())[0]["id"] != "changed"
+
+    # Without a connection the stale cache is used
+    fake_openrouter.stop()
+    models = asyncio.run(llm_openrouter.aget_openrouter_models(skip_cache=True))
+    assert len(models) == 20
+    llm_openrouter._cached_json.clear()
+    for path in user_path.listdir():
+        path.remove()
+    with pytest.raises(llm_openrouter.DownloadError):
+        asyncio.run(llm_openrouter.aget_openrouter_models())
+
+
+def test_register_models_from_summary(fake_openrouter, monkeypatch):
+    def registered():
+        models = []
+        llm_openrouter.register_models(lambda model, *args: models.append(model))
+        return [(model.model_name, model.vision) for model in models]
+
+    first = registered()
+    assert len(first) == 22
+    # Later runs register from the summary, without loading the catalog
+    with monkeypatch.context() as patch:
+        patch.setattr(llm_openrouter, "get_openrouter_models", None)
+        assert registered() == first
+
+    # A changed catalog is summarized again
+    _, path = llm_openrouter._catalog_location(None)
+    path.write_text(
+        json.dumps({"data": [{"id": "test/new", "architecture": {}}]}),
+        encoding="utf-8",
+    )
+    assert registered() == [
+        ("test/new", False),
+        ("local-router", True),
+        ("cascade", True),
+    ]
+
+
+PELICAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "age": {"type": "integer"},
+                    "kind": {"enum": ["brown", "white"]},
+                },
+                "required": ["name", "age"],
+                "additionalProperties": False,
+            },
+        }
+    },
+    "required": ["items"],
+}
+
+
+def test_json_stream_parser():
+    parser = llm_openrouter.JSONStreamParser(PELICAN_SCHEMA)
+    text = (
+        '{"items": [{"name": "Cleo", "age": 12, "kind": "brown"}, '
+        '{"name": "P \\"P\\" \\u00e9", "age": -3e2}]}'
+    )
+    items = []
+    for char in text[:30]:
+        items.extend(parser.feed(char))
+    # Strings and numbers only appear once they are complete
+    assert parser.value == {"items": [{"name": "Cleo"}]}
+    for char in text[30:]:
+        items.extend(parser.feed(char))
+    assert items == [
+        {"name": "Cleo", "age": 12, "kind": "brown"},
+        {"name": 'P "P" é', "age": -300.0},
+    ]
+    assert parser.close() == json.loads(text)
+
+    # Without a schema the items are those of a top-level array
+    parser = llm_openrouter.JSONStreamParser()
+    assert parser.feed("[1, 2") == [1]
+    assert parser.feed("3, {") == [23]
+    assert parser.feed("}]") == [{}]
+    assert parser.close() == [1, 23, {}]
+
+    # Escapes can be split across chunks
+    parser = llm_openrouter.JSONStreamParser()
+    for chunk in ('["a\\', '"', "\\", "u00e9", "\\", "", '\\"]'):
+        parser.feed(chunk)
+    assert parser.close() == ['a"\u00e9\\']
+
+
+def test_json_stream_parser_long_string():
+    import time
+
+    parser = llm_openrouter.JSONStreamParser()
+    parser.feed('["')
+    start = time.monotonic()
+    # Scanning the whole string again for each chunk would take seconds
+    for _ in range(20000):
+        parser.feed("0123456789")
+    assert time.monotonic() - start < 1
+    parser.feed('"]')
+    assert parser.close() == ["0123456789" * 20000]
+
+
+@pytest.mark.parametrize(
+    "text,error",
+    (
+        ('{"items": [{"name": 5', "$.items[0].name: expected string"),
+        ('{"items": [{"nom"', "$.items[0]: unexpected property 'nom'"),
+        ('{"items": [{"name": "x", "kind": "grey"', "$.items[0].kind: 'grey' is not"),
+        ('{"items": [{"name": "x"}', "$.items[0]: missing required property 'age'"),
+        ('{"items": [{"name": "x", "age": 1.5', "$.items[0].age: expected integer"),
+        ('{"items": {', "$.items: expected array"),
+        ("[", "$: expected object"),
+        ('{"items": [1.]}', "Invalid JSON number"),
+        ('{"items": [{"name": "x\\q"', "Invalid JSON string"),
+        ('{"items": [{"name": "x\ny"', "Invalid JSON string"),
+        ('{"items": [{"name": "x', "Invalid JSON string"),
+        ('{"items": [] ]', "Invalid JSON: unexpected ']' at $"),
+        ('{"items": []} {', "Unexpected data after the JSON value"),
+        ('{"items": [', "Incomplete JSON"),
+    ),
+)
+def test_json_stream_parser_violations(text, error):
+    parser = llm_openrouter.JSONStreamParser(PELICAN_SCHEMA)
+    with pytest.raises(llm_openrouter.SchemaViolation) as ex:
+        for char in text:
+            parser.feed(char)
+        parser.close()
+    assert str(ex.value).startswith(error)
+
+
+GOOD_PELICANS = '{"items": [{"name": "Cleo", "age": 12}, {"name": "Pip", "age": 3}]}'
+BAD_PELICANS = '{"items": [{"name": "Cleo", "age": "twelve"}, ' + " " * 400 + "]}"
+
+
+def test_schema_abort(fake_openrouter):
+    import time
+
+    fake_openrouter.tokens_per_second = 100
+    fake_openrouter.outputs = [BAD_PELICANS]
+    model = llm.get_model("openrouter/stand-in/model-0")
+    response = model.prompt("Pelicans", schema=PELICAN_SCHEMA, schema_abort=True)
+    start = time.monotonic()
+    with pytest.raises(llm_openrouter.SchemaViolation) as ex:
+        response.text()
+    # Streaming all 113 chunks would take over a second
+    assert time.monotonic() - start < 0.5
+    assert str(ex.value) == "$.items[0].age: expected integer"
+
+
+@pytest.mark.parametrize("chat_completions", (False, True))
+def test_schema_retries(fake_openrouter, chat_completions):
+    fake_openrouter.outputs = [BAD_PELICANS, GOOD_PELICANS]
+    model = llm.get_model("openrouter/stand-in/model-0")
+    response = model.prompt(
+        "Pelicans",
+        schema=PELICAN_SCHEMA,
+        schema_retries=1,
+        chat_completions=chat_completions,
+    )
+    assert list(llm_openrouter.schema_items(response)) == [
+        {"name": "Cleo", "age": 12},
+        {"name": "Pip", "age": 3},
+    ]
+    assert response.text() == GOOD_PELICANS
+    assert len([r for r in fake_openrouter.requests if r[0] == "POST"]) == 2
+
+    fake_openrouter.outputs = [BAD_PELICANS, BAD_PELICANS]
+    with pytest.raises(llm_openrouter.SchemaViolation):
+        model.prompt("Pelicans", schema=PELICAN_SCHEMA, schema_retries=1).text()
+
+
+@pytest.mark.parametrize("chat_completions", (False, True))
+def test_schema_retries_count_every_attempt(fake_openrouter, chat_completions):
+    # The first reply streams to the end before it breaks the schema
+    fake_openrouter.outputs = ['{"items": [{"name": "Cleo", "age": 12}', GOOD_PELICANS]
+    model = llm.get_model("openrouter/stand-in/model-0")
+    response = model.prompt(
+        "Pelicans",
+        schema=PELICAN_SCHEMA,
+        schema_retries=1,
+        chat_completions=chat_completions,
+        stream=False,
+    )
+    assert response.text() == GOOD_PELICANS
+    # Four characters per token
+    assert response.usage().output == 10 + 17
+    cost = response.response_json["usage"]["cost"]
+    assert cost == pytest.approx(response.usage().input * 1e-6 + 27 * 2e-6)
+
+
+def test_schema_retries_invalid_escape(fake_openrouter):
+    fake_openrouter.outputs = ['{"items": [{"name": "C\\q"}]}', GOOD_PELICANS]
+    model = llm.get_model("openrouter/stand-in/model-0")
+    response = model.prompt("Pelicans", schema=PELICAN_SCHEMA, schema_retries=1)
+    assert response.text() == GOOD_PELICANS
+
+
+def test_aschema_items(fake_openrouter):
+    fake_openrouter.outputs = [BAD_PELICANS, GOOD_PELICANS]
+    model = llm.get_async_model("openrouter/stand-in/model-0")
+
+    async def run():
+        response = model.prompt("Pelicans", schema=PELICAN_SCHEMA, schema_retries=1)
+        return [item async for item in llm_openrouter.aschema_items(response)]
+
+    assert asyncio.run(run()) == [
+        {"name": "Cleo", "age": 12},
+        {"name": "Pip", "age": 3},
+    ]
+
+
+@pytest.mark.parametrize("chat_completions", (False, True))
+def test_parallel_tool_calls(fake_openrouter, chat_completions):
+    import time
+
+    fake_openrouter.tool_calls = True
+    active = []
+    peak = []
+
+    def enter():
+        active.append(1)
+        peak.append(len(active))
+
+    def lookup_pelican() -> str:
+        "Look up a pelican"
+        enter()
+        time.sleep(0.3)
+        active.pop()
+        return "Cleo"
+
+    async def lookup_heron() -> str:
+        "Look up a heron"
+        enter()
+        await asyncio.sleep(0.3)
+        active.pop()
+        return "Hank"
+
+    def lookup_egret() -> str:
+        "Look up an egret"
+        enter()
+        time.sleep(0.3)
+        active.pop()
+        return "Edna"
+
+    def lookup_crane() -> str:
+        "Look up a crane, slowly"
+        time.sleep(1)
+        return "Cranky"
+
+    model = llm.get_async_model("openrouter/stand-in/model-0")
+
+    async def run(tools, **options):
+        chain = model.chain(
+            "Birds",
+            tools=tools,
+            options=dict(chat_completions=chat_completions, **options),
+        )
+        await chain.text()
+        responses = [response async for response in chain.responses()]
+        return responses[-1].prompt.tool_results
+
+    tools = [lookup_pelican, lookup_heron, lookup_egret]
+    results = asyncio.run(run(tools, tool_concurrency=3))
+    # Results come back in call order, however the tools overlapped
+    assert [result.output for result in results] == ["Cleo", "Hank", "Edna"]
+    assert max(peak) == 3
+
+    peak.clear()
+    results = asyncio.run(run(tools, tool_concurrency=2))
+    assert [result.output for result in results] == ["Cleo", "Hank", "Edna"]
+    assert max(peak) == 2
+
+    results = asyncio.run(run([lookup_pelican, lookup_crane], tool_timeout=0.5))
+    assert results[0].output == "Cleo"
+    assert isinstance(results[1].exception, TimeoutError)
+    assert str(results[1].exception) == "Tool lookup_crane timed out after 0.5 seconds"
+
+    asyncio.run(run(tools, parallel_tool_calls=False))
+    body = fake_openrouter.requests[-1][2]
+    assert body["parallel_tool_calls"] is False
+    assert len(body["tools"]) == 3
+    calls = (
+        body["messages"][-2]["tool_calls"]
+        if chat_completions
+        else [item for item in body["input"] if item.get("type") == "function_call"]
+    )
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("chat_completions", (False, True))
+def test_speculative_tools(fake_openrouter, chat_completions):
+    import time
+
+    # Tool calls stream a quarter of a second apart
+    fake_openrouter.tool_calls = True
+    fake_openrouter.tokens_per_second = 4
+    started = []
+
+    @llm_openrouter.idempotent
+    def lookup_pelican() -> str:
+        "Look up a pelican"
+        started.append(("lookup_pelican", time.monotonic()))
+        return "Cleo"
+
+    @llm_openrouter.idempotent
+    async def lookup_heron() -> str:
+        "Look up a heron"
+        started.append(("lookup_heron", time.monotonic()))
+        return "Hank"
+
+    def book_boat_trip() -> str:
+        "Book a boat trip to see the birds"
+        started.append(("book_boat_trip", time.monotonic()))
+        return "Booked"
+
+    model = llm.get_async_model("openrouter/stand-in/model-0")
+
+    async def run():
+        response = model.prompt(
+            "Birds",
+            tools=[lookup_pelican, lookup_heron, book_boat_trip],
+            speculative_tools=True,
+            chat_completions=chat_completions,
+        )
+        await response.text()
+        finished = time.monotonic()
+        return finished, await response.execute_tool_calls()
+
+    finished, results = asyncio.run(run())
+    assert [result.output for result in results] == ["Cleo", "Hank", "Booked"]
+    # Each tool ran once, the idempotent ones while the response streamed
+    assert [name for name, _ in started] == [
+        "lookup_pelican",
+        "lookup_heron",
+        "book_boat_trip",
+    ]
+    assert started[0][1] < finished - 0.3
+    assert started[1][1] < finished
+    assert started[2][1] > finished
+
+
+def test_speculative_tools_discarded_on_error():
+    @llm_openrouter.idempotent
+    async def lookup_pelican() -> str:
+        "Look up a pelican"
+        await asyncio.sleep(1)
+        return "Cleo"
+
+    speculation = llm_openrouter._SpeculativeTools([llm.Tool.function(lookup_pelican)])
+    started = []
+
+    async def events():
+        yield StreamEvent(
+            type="tool_call_name", chunk="lookup_pelican", tool_call_id="call_1"
+        )
+        for chunk in ("{", " }"):
+            yield StreamEvent(type="tool_call_args", chunk=chunk, tool_call_id="call_1")
+        started.extend(task for _, _, task in speculation.started)
+        raise ConnectionError("Stream interrupted")
+
+    async def run():
+        with pytest.raises(ConnectionError):
+            async for event in speculation.observe(events()):
+                pass
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert len(started) == 1
+    assert started[0].cancelled()
+    assert speculation.started == []
+
+
+def test_replay_command(fake_openrouter, user_path, tmpdir):
+    import sqlite_utils
+    from llm.migrations import migrate
+
+    db = sqlite_utils.Database(str(user_path / "logs.db"))
+    migrate(db)
+    # Logged by llm before 0.32, which only wrote the responses table
+    db["responses"].insert(
+        {
+            "id": "01legacy",
+            "model": "openrouter/stand-in/model-0",
+            "prompt": "An old pelican",
+            "system": "Be brief",
+            "options_json": "{}",
+            "response": "Old answer",
+            "response_json": json.dumps({"usage": {"cost": 0.5}}),
+            "duration_ms": 1500,
+            "datetime_utc": "2024-06-01T12:00:00",
+            "input_tokens": 3,
+            "output_tokens": 2,
+        }
+    )
+    model = llm.get_model("openrouter/stand-in/model-0")
+    conversation = model.conversation()
+    first = conversation.prompt("Name a pelican", temperature=0.5)
+    first.text()
+    first.log_to_db(db)
+    second = conversation.prompt(
+        "Describe it",
+        attachments=[llm.Attachment(content=b"GIF89a", type="image/gif")],
+    )
+    second.text()
+    second.log_to_db(db)
+    other = llm.get_model("openrouter/stand-in/model-1").prompt("Ignore me")
+    other.text()
+    other.log_to_db(db)
+    fake_openrouter.requests.clear()
+
+    output = tmpdir / "pairs.jsonl"
+    result = CliRunner().invoke(
+        cli,
+        [
+            "openrouter",
+            "replay",
+            str(output),
+            "--source",
+            "openrouter/stand-in/model-0",
+            "-m",
+            "stand-in/model-2",
+            "-m",
+            "stand-in/model-3",
+            "--json",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    pairs = [json.loads(line) for line in output.read_text("utf-8").splitlines()]
+    assert sorted((pair["prompt"], pair["model"]) for pair in pairs) == [
+        ("An old pelican", "openrouter/stand-in/model-2"),
+        ("An old pelican", "openrouter/stand-in/model-3"),
+        ("Describe it", "openrouter/stand-in/model-2"),
+        ("Describe it", "openrouter/stand-in/model-3"),
+        ("Name a pelican", "openrouter/stand-in/model-2"),
+        ("Name a pelican", "openrouter/stand-in/model-3"),
+    ]
+    for pair in pairs:
+        assert pair["error"] is None
+        assert pair["original_model"] == "openrouter/stand-in/model-0"
+        assert pair["cost"] > 0 and pair["original_cost"] > 0
+        assert pair["ttft"] <= pair["latency"]
+        if pair["prompt"] == "An old pelican":
+            assert pair["original_response"] == "Old answer"
+            assert pair["original_latency"] == 1.5
+        else:
+            assert pair["original_response"] == pair["response"]
+
+    bodies = {
+        (body["model"], json.dumps(body["input"][-1]["content"])): body
+        for _, _, body in fake_openrouter.requests
+        if body
+    }
+    assert len(bodies) == 6
+    legacy = bodies[("stand-in/model-2", '"An old pelican"')]
+    assert legacy["instructions"] == "Be brief"
+    # Logged options are kept, and later turns include the earlier ones
+    assert bodies[("stand-in/model-3", '"Name a pelican"')]["temperature"] == 0.5
+    (follow_up,) = [
+        body["input"]
+        for (model_name, _), body in bodies.items()
+        if model_name == "stand-in/model-2" and len(body["input"]) > 1
+    ]
+    assert [item["role"] for item in follow_up] == ["user", "assistant", "user"]
+    assert [part["type"] for part in follow_up[-1]["content"]] == [
+        "input_text",
+        "input_image",
+    ]
+
+    summaries = sorted(json.loads(result.output), key=lambda s: s["model"])
+    assert [summary["model"] for summary in summaries] == [
+        "openrouter/stand-in/model-2",
+        "openrouter/stand-in/model-3",
+    ]
+    for summary in summaries:
+        assert (summary["runs"], summary["errors"]) == (3, 0)
+        assert summary["original_latency_p50"] is not None
+        assert summary["cost"] < summary["original_cost"]
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "openrouter",
+            "replay",
+            "-",
+            "--since",
+            "2025-01-01",
+            "--source",
+            "openrouter/stand-in/model-1",
+            "-m",
+            "stand-in/model-2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output.splitlines()[0])["prompt"] == "Ignore me"
+    assert result.output.splitlines()[-1].split()[:2] == [
+        "openrouter/stand-in/model-2",
+        "1",
+    ]
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "openrouter",
+            "replay",
+            "-",
+            "--before",
+            "2024-01-01",
+            "-m",
+            "stand-in/model-2",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "No logged prompts matched" in result.output
+
+
+def test_embedding_models(fake_openrouter, monkeypatch):
+    from fake_openrouter import embedding
+
+    monkeypatch.setenv("OPENROUTER_KEYS", "key-a,key-b")
+    fake_openrouter.embedding_models = 1
+    fake_openrouter.ttft = 0.2
+    model = llm.get_embedding_model("openrouter/stand-in/embed-0")
+    assert isinstance(model, OpenRouterEmbedding)
+    # Embedding models are not registered as chat models too
+    assert "openrouter/stand-in/embed-0" not in {
+        model.model_id for model in llm.get_models()
+    }
+
+    model.request_items = 3
+    texts = ["pelican" + "s" * i for i in range(10)]
+    assert list(model.embed_multi(texts)) == [embedding(text) for text in texts]
+    bodies = [
+        body
+        for method, path, body in fake_openrouter.requests
+        if path == "/api/v1/embeddings"
+    ]
+    assert sorted(body["input"] for body in bodies) == [
+        texts[0:3],
+        texts[3:6],
+        texts[6:9],
+        texts[9:],
+    ]
+    assert bodies[0]["model"] == "stand-in/embed-0"
+    assert bodies[0]["encoding_format"] == "float"
+    assert fake_openrouter.peak_embedding_requests > 1
+    assert model.embed("pelican") == embedding("pelican")
+
+
+def test_embedding_batches_respect_token_budget():
+    batches = list(
+        llm_openrouter._embedding_batches(["a" * 40, "b", "c" * 400, "d"], 100, 20)
+    )
+    # The 400 character item is over budget on its own, so it gets a batch
+    assert batches == [["a" * 40, "b"], ["c" * 400], ["d"]]
+
+
+def router_catalog():
+    from fake_openrouter import synthetic_catalog
+
+    catalog = synthetic_catalog(5)
+    # model-0 can do everything, but is the most expensive
+    catalog[0]["pricing"].update(prompt="0.00001", completion="0.00003")
+    # model-1 is the cheapest, but only handles text
+    catalog[1]["pricing"].update(prompt="0.0000001", completion="0.0000002")
+    catalog[1]["architecture"]["input_modalities"] = ["text"]
+    catalog[1]["supported_parameters"] = ["max_tokens"]
+    # model-2 supports tools and text with a small context window
+    catalog[2]["pricing"].update(prompt="0.0000005", completion="0.000001")
+    catalog[2]["architecture"]["input_modalities"] = ["text"]
+    catalog[2]["top_provider"]["context_length"] = 100
+    # model-3 is free and model-4 is a router without a price of its own
+    catalog[3]["pricing"].update(prompt="0", completion="0")
+    catalog[4]["pricing"].update(prompt="-1", completion="-1")
+    return catalog
+
+
+@pytest.mark.parametrize(
+    ("prompt_kwargs", "options", "expected"),
+    (
+        ({}, {}, "stand-in/model-1"),
+        ({"tools": [llm.Tool.function(len)]}, {}, "stand-in/model-2"),
+        (
+            {"prompt": "x" * 1000, "tools": [llm.Tool.function(len)]},
+            {},
+            "stand-in/model-0",
+        ),
+        ({"attachments": [llm.Attachment(content=TINY_PNG)]}, {}, "stand-in/model-0"),
+        ({"schema": {"type": "object"}}, {}, "stand-in/model-2"),
+        ({}, {"route_free": True}, "stand-in/model-3"),
+        (
+            {},
+            {"route_models": "stand-in/model-0,openrouter/stand-in/model-2"},
+            "stand-in/model-2",
+        ),
+        ({}, {"route_models": "stand-in/model-[02]"}, "stand-in/model-2"),
+    ),
+)
+def test_local_router(fake_openrouter, prompt_kwargs, options, expected):
+    fake_openrouter.catalog = router_catalog
+    model = llm.get_model("openrouter/local-router")
+    prompt_kwargs = {"prompt": "Say hello", **prompt_kwargs}
+    response = model.prompt(**prompt_kwargs, **options)
+    response.text()
+    method, path, body = fake_openrouter.requests[-1]
+    assert body["model"] == expected
+    assert not {"route", "route_models", "route_free"} & set(body)
+    assert response.resolved_model == "openrouter/" + expected
+    route = response.response_json["local_router"]
+    assert route["model"] == expected
+    assert route["strategy"] == "cheapest"
+
+
+def test_local_router_explains_choice(fake_openrouter):
+    fake_openrouter.catalog = router_catalog
+    model = llm.get_async_model("openrouter/local-router")
+    response = model.prompt(
+        "Describe this", attachments=[llm.Attachment(content=TINY_PNG)]
+    )
+    asyncio.run(response.text())
+    assert response.response_json["local_router"] == {
+        "model": "stand-in/model-0",
+        "strategy": "cheapest",
+        "needs": ["image", "text"],
+        "estimated_tokens": 3,
+        "candidates": 1,
+        "context_length": 128000,
+        "price": pytest.approx(0.000015),
+        "latency": None,
+    }
+
+
+def test_local_router_no_model(fake_openrouter):
+    fake_openrouter.catalog = router_catalog
+    model = llm.get_model("openrouter/local-router")
+    response = model.prompt(
+        "Read this",
+        attachments=[llm.Attachment(content=b"%PDF", type="application/pdf")],
+    )
+    with pytest.raises(llm.ModelError, match="needs file, text"):
+        response.text()
+
+
+def test_router_index_is_built_once_per_catalog(fake_openrouter, monkeypatch):
+    fake_openrouter.catalog = router_catalog
+    builds = []
+    monkeypatch.setattr(
+        llm_openrouter, "_logged_latencies", lambda: builds.append(1) or {}
+    )
+    api_base = fake_openrouter.api_base
+    for _ in range(2):
+        catalog = llm_openrouter.get_openrouter_models(api_base=api_base)
+        index = llm_openrouter.get_router_index(catalog, api_base)
+        assert llm_openrouter.get_router_index(catalog, api_base) is index
+    assert len(builds) == 1
+    # A new download of the catalog builds a new index
+    catalog = llm_openrouter.get_openrouter_models(skip_cache=True, api_base=api_base)
+    assert llm_openrouter.get_router_index(catalog, api_base) is not index
+    assert len(builds) == 2
+
+
+def test_router_index_fastest():
+    index = RouterIndex(
+        router_catalog(),
+        latencies={"stand-in/model-0": 0.2, "stand-in/model-2": 0.9},
+    )
+    needs = frozenset({"text"})
+    assert index.select(needs, 10, "fastest")[0].id == "stand-in/model-0"
+    # Too big for model-2's context window
+    assert index.select(needs, 1000, "fastest")[0].id == "stand-in/model-0"
+    # Models without latency stats come last, cheapest first
+    assert [
+        model.id
+        for model in index.candidates(needs, "fastest", ("stand-in/model-[12]",))
+    ] == ["stand-in/model-2", "stand-in/model-1"]
+    assert index.select(frozenset({"audio"}), 10) == (None, 0)
+    # Groups are built once, then reused
+    assert index.candidates(needs, "fastest") is index.candidates(needs, "fastest")
+
+
+def cascade_validator(text, prompt):
+    "Used by test_cascade as a cascade_validator"
+    if "pelican" not in text:
+        raise ValueError("No pelican")
+    return True
+
+
+@pytest.mark.parametrize(
+    ("outputs", "prompt_kwargs", "reasons"),
+    (
+        (["I'm sorry, I can't help with that.", "Sure"], {}, ["refusal", None]),
+        (
+            ['{"name": 1}', '{"name": "Pelly"}'],
+            {
+                "schema": {
+                    "type": "object",
+                    "properties": {"name": {"type": "string"}},
+                }
+            },
+            ["schema: $.name: expected string", None],
+        ),
+        (
+            ["A much longer reply", "Short"],
+            {"max_tokens": 3},
+            ["truncated", None],
+        ),
+        (
+            ["A heron", "A pelican"],
+            {"cascade_validator": "test_llm_openrouter:cascade_validator"},
+            ["validator: No pelican", None],
+        ),
+        (
+            ["Sorry, but I cannot do that", "I'm unable to", "As an AI"],
+            {},
+            ["refusal", "refusal", "refusal"],
+        ),
+        (["I'm sorry to hear that, try this"], {"cascade_refusal": ""}, [None]),
+    ),
+)
+def test_cascade(fake_openrouter, outputs, prompt_kwargs, reasons):
+    fake_openrouter.outputs = list(outputs)
+    model = llm.get_model("openrouter/cascade")
+    response = model.prompt(
+        "Say hello",
+        cascade_models="stand-in/model-0,stand-in/model-1,openrouter/stand-in/model-2",
+        **prompt_kwargs,
+    )
+    # Only the reply that passed, or the last model's, is returned
+    assert response.text() == outputs[len(reasons) - 1]
+    models = ["stand-in/model-{}".format(i) for i in range(len(reasons))]
+    assert [
+        body["model"] for method, path, body in fake_openrouter.requests if body
+    ] == models
+    assert not any(
+        name.startswith("cascade_")
+        for method, path, body in fake_openrouter.requests
+        if body
+        for name in body
+    )
+    assert response.resolved_model == "openrouter/" + models[-1]
+    attempts = response.response_json["cascade"]
+    assert [attempt["model"] for attempt in attempts] == models
+    assert [attempt["reason"] for attempt in attempts] == reasons
+    assert [attempt["passed"] for attempt in attempts] == [
+        reason is None for reason in reasons
+    ]
+    assert all(attempt["cost"] for attempt in attempts)
+    # Usage and cost cover every attempt, not just the reply that was returned
+    assert response.input_tokens == sum(a["input_tokens"] for a in attempts)
+    assert response.output_tokens == sum(a["output_tokens"] for a in attempts)
+    assert response.response_json["usage"]["cost"] == pytest.approx(
+        sum(attempt["cost"] for attempt in attempts)
+    )
+
+
+def test_cascade_async(fake_openrouter):
+    fake_openrouter.outputs = ["I cannot help with that", "Hello"]
+    model = llm.get_async_model("openrouter/cascade")
+    response = model.prompt(
+        "Say hello",
+        cascade_models=["stand-in/model-0", "stand-in/model-1"],
+        chat_completions=True,
+        cascade_refusal="^I cannot",
+    )
+    assert asyncio.run(response.text()) == "Hello"
+    attempts = response.response_json["cascade"]
+    assert [attempt["reason"] for attempt in attempts] == ["refusal", None]
+    assert all(
+        path == "/api/v1/chat/completions"
+        for method, path, body in fake_openrouter.requests
+        if body
+    )
+
+
+def test_cascade_needs_models(fake_openrouter):
+    model = llm.get_model("openrouter/cascade")
+    with pytest.raises(ValueError, match="needs the models to try"):
+        model.prompt("Say hello").text()
+
+
+def test_cascade_stats_command(fake_openrouter):
+    fake_openrouter.outputs = ["I'm sorry, no", "Fine", "Also fine", "I'm sorry"]
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(
+            cli,
+            [
+                "-m",
+                "openrouter/cascade",
+                "-o",
+                "cascade_models",
+                "stand-in/model-0,stand-in/model-1",
+                "Say hello",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+    result = runner.invoke(cli, ["openrouter", "cascade-stats", "--json"])
+    assert result.exit_code == 0, result.output
+    summary = json.loads(result.output)
+    assert summary["prompts"] == 2
+    assert summary["attempts"] == 3
+    assert summary["escalated"] == 1
+    assert summary["unresolved"] == 0
+    assert summary["cost"] > 0
+    assert [
+        (model["model"], model["attempts"], model["passed"], model["answered"])
+        for model in summary["models"]
+    ] == [("stand-in/model-0", 2, 1, 1), ("stand-in/model-1", 1, 1, 1)]
+    assert summary["models"][0]["failures"] == {"refusal": 1}
+
+    result = runner.invoke(cli, ["openrouter", "cascade-stats"])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("2 prompts, 3 attempts, 1 escalated")
+    assert "refusal 1" in result.output
+
+    result = runner.invoke(cli, ["openrouter", "cascade-stats", "--since", "2999"])
+    assert result.exit_code == 1
+    assert "No logged cascade prompts found" in result.output